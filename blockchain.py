@@ -1,34 +1,74 @@
+from bisect import bisect_left
 from collections import defaultdict
 from datetime import datetime
 import hashlib
-import rsa
+import heapq
 import random
-import qrcode
+import time
+import os
+import sys
 import enum
-from typing import Any, TypedDict, Literal
-from collections.abc import Iterable
+from typing import Any, TypedDict, Literal, NotRequired
+from collections.abc import Callable, Iterable, Iterator
 import json
+from signers import Signer, DEFAULT_SIGNER, verification_cache, generateKeys
+import wireformat
+from blockstore import BlockStore, MemoryBlockStore, LRUCache, PruningPolicy
 MAX_TRANSACSIZE = 3
+# maximum number of transactions a node may have in flight as sender (requested or accepted, not yet mined)
+MAX_IN_FLIGHT = 256
+# maximum number of transactions packed into one block, the rest wait for the next block
+MAX_BLOCKSIZE = 100
+# number of decoded block bodies kept in memory by a blockchain
+BODY_CACHE_SIZE = 64
+# deepest reorganisation allowed, undo journals of older blocks are dropped
+REORG_DEPTH = 100
+# seconds a transaction request may wait for the receiver before it expires and its products are released
+REQUEST_TTL = 600.0
+# maximum number of transaction requests waiting for a receiver, new requests are refused beyond it
+MAX_PENDING_REQUESTS = 10000
+# bits per product / node id in a block's bloom filter and number of hash functions (about 1% false positives)
+BLOOM_BITS_PER_ENTRY = 10
+BLOOM_HASHES = 7
 # TODO: Delete trasaction request from sender's side
 
+# Timestamps of transactions and blocks are integer microseconds since the Unix epoch, they are only formatted for display
+def currentTimestamp() -> int:
+  return time.time_ns() // 1000
+
+def toTimestamp(moment: datetime) -> int:
+  return round(moment.timestamp() * 1000000)
+
+def formatTimestamp(timestamp: int) -> str:
+  return datetime.fromtimestamp(timestamp / 1000000).strftime("%d|%m|%Y><%H:%M:%S")
+
 class customEncoder(json.JSONEncoder):
   def default(self, o: Any) -> Any:
+    # rsa is only loaded once an RSA key has been generated, before that o can't be an rsa key
+    rsa = sys.modules.get('rsa')
     if isinstance(o, set):
-      return list(o)
-    elif isinstance(o, rsa.PublicKey):
+      # sorted so that equal sets always hash the same (e.g. after decoding from the wire format)
+      return sorted(o)
+    elif rsa is not None and isinstance(o, rsa.PublicKey):
       return "PublicKey(" + str(o.n) + ', ' + str(o.e) + ')'
-    elif isinstance(o, rsa.PrivateKey):
+    elif rsa is not None and isinstance(o, rsa.PrivateKey):
       return "__private key object"
     elif isinstance(o, bytes):
       return "__signature bytes object"
     elif isinstance(o, MerkleTree):
       return "__merkle tree object"
+    elif isinstance(o, BloomFilter):
+      return o.bits.hex()
+    elif isinstance(o, BlockHeader):
+      return {field: getattr(o, field) for field in BlockHeader.__slots__}
     elif isinstance(o, datetime):
       return o.strftime("%d|%m|%Y><%H:%M:%S")
     elif isinstance(o, Transaction):
       return o.__dict__
     elif isinstance(o, NodeType):
       return o.name
+    elif isinstance(o, Signer):
+      return o.name
     return super().default(o)
 
 """
@@ -47,7 +87,25 @@ class NodePublicInfo(TypedDict):
   stake: int
   stock: set
   type: NodeType
-  public_key: rsa.PublicKey
+  public_key: Any
+
+"""
+Description of a node to register with Blockchain.addNodes, keys (optional) is a key pair made by the chain's signer
+"""
+class NodeSpec(TypedDict):
+  id: int
+  stake: int
+  type: Literal['client', 'distributor']
+  stock: Iterable[int]
+  keys: NotRequired[tuple[Any, Any]]
+
+"""
+Outcome of registering one node with Blockchain.addNodes, error is None if the node was registered
+"""
+class NodeRegistration(TypedDict):
+  id: int
+  registered: bool
+  error: None | str
 
 """
 Represents a Node in the Blockchain (A Node object is private to each running node)
@@ -56,18 +114,45 @@ Represents a Node in the Blockchain (A Node object is private to each running no
   <in>id: unique id of the node (positive integer, less than 53 digits) - specifies the port address number of the node on local host, higher port number => earlier the node joined the chain
   <in>stock: set of all product_id the Node has
   <in>type: type of the node (see NodeType)
-  public_key, __private_key: the public and private keys of the node
+  <in>signer: signature scheme of the node (see signers.py), a blockchain uses the scheme of its manufacturer
+  <in>keys: (public key, private key) pair made by the signer, generated on the first signature if not given
+  public_key, __private_key: the public and private keys of the node (None until generated)
 **Methods**
   sign: return the digital signature of the given data for this node
-  verify: verifies a signature
+  verify: verifies a signature (successful verifications are cached)
+  rotateKeys: replace the key pair of the node
 """
 class Node():
-  def __init__(self,  stake: int, id: int, stock: Iterable[int], type: NodeType) -> None:
-    self.stake = stake
+  def __init__(self,  stake: int, id: int, stock: Iterable[int], type: NodeType, signer: Signer = DEFAULT_SIGNER, keys: None | tuple[Any, Any] = None) -> None:
     self.id = id
-    self.stock = set(stock)
     self.type = type
-    self.public_key, self.__private_key = rsa.newkeys(512)
+    self.signer = signer
+    # key generation is deferred until the node signs something, a node without signatures needs no keys
+    self.public_key, self.__private_key = keys if keys is not None else (None, None)
+    # the public info record is the only copy of the stake and stock, the blockchain updates it directly
+    self.info: NodePublicInfo = {
+      'id': id,
+      'stake': stake,
+      'stock': set(stock),
+      'type': type,
+      'public_key': self.public_key
+    }
+
+  @property
+  def stake(self) -> int:
+    return self.info['stake']
+
+  @stake.setter
+  def stake(self, stake: int) -> None:
+    self.info['stake'] = stake
+
+  @property
+  def stock(self) -> set[int]:
+    return self.info['stock']
+
+  @stock.setter
+  def stock(self, stock: set[int]) -> None:
+    self.info['stock'] = stock
 
   """
   params:
@@ -75,64 +160,129 @@ class Node():
   returns: the created signature (in utf-8)
   """
   def sign(self, data: Any) -> bytes:
-    data = str(data)
-    return rsa.sign(data.encode('utf-8'), self.__private_key, 'SHA-1')
+    if self.__private_key is None:
+      self.rotateKeys()
+    return self.signer.sign(str(data).encode('utf-8'), self.__private_key)
 
   """
   params:
     message: data to verify signature for
     signature: signature as a string (utf-8 decoded)
     key: the public key of the node whose signature it is
+    signer: the signature scheme the signature was made with
   returns: True | False
   """
   @staticmethod
-  def verify(message: Any, signature: bytes, key: rsa.PublicKey) -> bool:
-    return rsa.verify(str(message).encode('utf-8'), signature, key) == 'SHA-1'
+  def verify(message: Any, signature: bytes, key: Any, signer: Signer = DEFAULT_SIGNER) -> bool:
+    if key is None:
+      # the node never signed anything
+      return False
+    data = str(message).encode('utf-8')
+    if verification_cache.lookup(signer, data, signature, key):
+      return True
+    if not signer.verify(data, signature, key):
+      return False
+    verification_cache.add(signer, data, signature, key)
+    return True
 
   """
-  returns: publically available data of this node, the stock set's reference is returned, changing stock returned by getInfo,
+  Generates a new key pair, verifications cached for the old public key are dropped
+  """
+  def rotateKeys(self) -> None:
+    if self.public_key is not None:
+      verification_cache.invalidateKey(self.public_key)
+    self.public_key, self.__private_key = self.signer.newkeys()
+    self.info['public_key'] = self.public_key
+
+  """
+  returns: publically available data of this node, the record itself is returned (shared with the blockchain), changing it changes the node
   """
   def getInfo(self) -> NodePublicInfo:
-    return {
-      'id': self.id,
-      'stake': self.stake,
-      'stock': self.stock,
-      'type': self.type,
-      'public_key': self.public_key
-    }
+    return self.info
   
   def __str__(self) -> str:
-    return json.dumps(self.__dict__, cls=customEncoder, indent=4, separators=(',', ': '))
+    fields = {key: value for key, value in self.__dict__.items() if key != 'info'}
+    return json.dumps(dict(fields, stake=self.stake, stock=self.stock), cls=customEncoder, indent=4, separators=(',', ': '))
 
 """
 Represents a transaction in the blockchain
 **Fields**
   manufacturer_id, sender_id, receiver_id, product_ids: are the respective unique ids
-  timestamp: timestamp when the trasaction was started
-  transaction_id: semi-unique id for signing of the transaction
+  timestamp: timestamp when the trasaction was started (microseconds since the epoch)
+  salt: random value making the ids of otherwise identical transactions differ
+  nonce: sequence number of the transaction among those started by its sender, a sender's transactions are applied in nonce order
+  transaction_id: unique id derived from the contents of the transaction, signed by both parties
   sender_sign: digital signature of the sender using transaction_id
   receiver_sign: digital signature of the receiver using transaction_id
 > a node signs the transaction if it accepts it
 **Methods**
+  calculateId: recompute the transaction id from the contents
+  encode, fromView: convert to and from the binary wire format (see wireformat.py)
   str: returns a str version of the transaction for hashing
 """
 class Transaction():
-  def __init__(self, manufacturer_id: int, product_ids: set[int], sender_id: int, receiver_id: int, sender_sign: bytes) -> None:
+  def __init__(self, manufacturer_id: int, product_ids: set[int], sender_id: int, receiver_id: int, sender_sign: None | bytes = None, nonce: int = 0) -> None:
     self.manufacturer_id = manufacturer_id
     self.product_ids = product_ids
     self.sender_id = sender_id
     self.receiver_id = receiver_id
-    self.timestamp = datetime.now().strftime("%d|%m|%Y><%H:%M:%S")
-    product_xor = 0
-    for i in product_ids:
-      product_xor ^= i
-    self.transaction_id = receiver_id^product_xor^sender_id
-    self.sender_sign: bytes = sender_sign
+    self.timestamp = currentTimestamp()
+    self.salt = os.urandom(8).hex()
+    self.nonce = nonce
+    self.transaction_id = self.calculateId()
+    self.sender_sign: None | bytes = sender_sign
     self.receiver_sign: None | bytes = None
+
+  def calculateId(self) -> str:
+    return Blockchain.calculateHash('|'.join((str(self.manufacturer_id), str(sorted(self.product_ids)), str(self.sender_id), str(self.receiver_id), str(self.timestamp), self.salt, str(self.nonce))))
+
+  def encode(self) -> bytes:
+    return wireformat.encodeTransaction(self)
+
+  """
+  Build a transaction from its encoding (bytes or a TransactionView), the fields are copied out of the buffer
+  """
+  @classmethod
+  def fromView(cls, view: bytes | wireformat.TransactionView) -> 'Transaction':
+    if not isinstance(view, wireformat.TransactionView):
+      view = wireformat.TransactionView(view)
+    txn = cls.__new__(cls)
+    txn.manufacturer_id = view.manufacturer_id
+    txn.product_ids = set(view.product_ids)
+    txn.sender_id = view.sender_id
+    txn.receiver_id = view.receiver_id
+    txn.timestamp = view.timestamp
+    txn.salt = view.salt
+    txn.nonce = view.nonce
+    txn.transaction_id = view.transaction_id
+    sender_sign, receiver_sign = view.sender_sign, view.receiver_sign
+    txn.sender_sign = None if sender_sign is None else bytes(sender_sign)
+    txn.receiver_sign = None if receiver_sign is None else bytes(receiver_sign)
+    return txn
   
   def  __str__(self):
     return json.dumps(self.__dict__, cls=customEncoder, indent=4, separators=(',', ': '))
   
+"""
+Lightweight header of a block, always kept in memory by the blockchain (the transactions are loaded on demand)
+**Fields**
+  previous_hash, merkle_root, height, miner_id, timestamp, bloom, header_hash: same as the block's
+"""
+class BlockHeader():
+  __slots__ = ('previous_hash', 'merkle_root', 'height', 'miner_id', 'timestamp', 'bloom', 'header_hash')
+
+  def __init__(self, previous_hash: str, merkle_root: str, height: int, miner_id: int, timestamp: int, bloom: 'BloomFilter', header_hash: str) -> None:
+    self.previous_hash = previous_hash
+    self.merkle_root = merkle_root
+    self.height = height
+    self.miner_id = miner_id
+    self.timestamp = timestamp
+    self.bloom = bloom
+    self.header_hash = header_hash
+
+  def __str__(self) -> str:
+    return json.dumps(self, cls=customEncoder, indent=4, separators=(',', ': '))
+
 """
 Represents a Block of the blockchain
 **Fields**
@@ -141,27 +291,62 @@ Represents a Block of the blockchain
   merkle_root: merkle tree root hash value (read-only)
   height: block height on the blockchain
   miner_id: miner responsible for adding this block
-  timestamp: timestamp when the block was mined
+  timestamp: timestamp when the block was mined (microseconds since the epoch), defaults to now
+  bloom: bloom filter of the product ids and node ids touched by the transactions
   header_hash: hash of the header of this block (except the header hash itself)
   transactions: transactions in the block
+**Methods**
+  hashHeader: hash of the header fields
+  header: the header of this block
+  encode, fromView: convert to and from the binary wire format (see wireformat.py)
 """
 class Block():
-  def __init__(self, prev_hash: str, height: int, transactions:Iterable[Transaction], miner_id: int) -> None:
+  def __init__(self, prev_hash: str, height: int, transactions:Iterable[Transaction], miner_id: int, timestamp: None | int = None) -> None:
     self.previous_hash = prev_hash
     # the merkle tree and root are read only after creation
     self.merkle_tree = MerkleTree(transactions)
     self.height = height
     self.miner_id = miner_id
-    self.timestamp = datetime.now()
-    self.header_hash = Blockchain.calculateHash(prev_hash + self.merkle_root + str(height) + str(miner_id) + self.timestamp.strftime("%d|%m|%Y><%H:%M:%S"))
+    self.timestamp = timestamp if timestamp is not None else currentTimestamp()
+    self.bloom = BloomFilter.fromTransactions(transactions)
+    self.header_hash = Block.hashHeader(prev_hash, self.merkle_root, height, miner_id, self.timestamp, self.bloom)
     self.transactions:list[Transaction] = list(transactions)
 
+  @staticmethod
+  def hashHeader(previous_hash: str, merkle_root: str, height: int, miner_id: int, timestamp: int, bloom: 'BloomFilter') -> str:
+    return Blockchain.calculateHash(previous_hash + merkle_root + str(height) + str(miner_id) + str(timestamp) + bloom.bits.hex())
+
   """
   read-only property merkle_root
   """
   @property  
   def merkle_root(self):
     return self.merkle_tree.getRootHash()
+
+  def header(self) -> BlockHeader:
+    return BlockHeader(self.previous_hash, self.merkle_root, self.height, self.miner_id, self.timestamp, self.bloom, self.header_hash)
+
+  def encode(self) -> bytes:
+    return wireformat.encodeBlock(self)
+
+  """
+  Build a block from its encoding (bytes or a BlockView); the merkle tree is rebuilt from the transactions, the stored header is kept as is (use validateBlock to check it)
+  """
+  @classmethod
+  def fromView(cls, view: bytes | wireformat.BlockView) -> 'Block':
+    if not isinstance(view, wireformat.BlockView):
+      view = wireformat.BlockView(view)
+    block = cls.__new__(cls)
+    block.previous_hash = view.previous_hash
+    block.transactions = [Transaction.fromView(txn) for txn in view.transactions()]
+    block.merkle_tree = MerkleTree(block.transactions)
+    block.height = view.height
+    block.miner_id = view.miner_id
+    block.timestamp = view.timestamp
+    # records before wireformat version 3 carry no bloom filter
+    block.bloom = BloomFilter(bytes(view.bloom)) if len(view.bloom) else BloomFilter.fromTransactions(block.transactions)
+    block.header_hash = view.header_hash
+    return block
   
   def __str__(self) -> str:
     return json.dumps(self.__dict__, cls=customEncoder, indent=4, separators=(',', ': '))
@@ -170,49 +355,112 @@ class Block():
 Represents the Blockchain copy on a node
 **Fields**
   manufacturer_id: manufacturer id for this supply chain (represented by this blockchain)
+  signer: signature scheme of the chain, taken from the manufacturer node
   product_locations: used to track product_ids before they are used in a transaction
-  blockchain: dictionary containing all blocks in this blockchain copy (header_hash as key)
+  blockchain: dictionary containing the headers of all blocks in this blockchain copy (header_hash as key)
+  store: backing store of the encoded block bodies (see blockstore.py)
+  body_cache: recently used blocks, bodies are loaded from the store on a miss
+  pruning: optional policy moving old block bodies from the store to cold storage
+  archived_height: height of the newest block whose body has been archived (-1 if none)
+  heights: header_hash of the block at each height of the canonical chain (ending at newest_block)
+  weights: cumulative stake weight of the branch ending at each block (header_hash as key)
+  tips: header hashes of the blocks without children, the canonical tip is the heaviest
+  journals: state changes of each block and their undo journal while applied, dropped after REORG_DEPTH blocks
+  transaction_index: (block height, position) of every committed transaction (transaction_id as key)
   nodes: dictionary containing all known nodes public info (id as key)
-  pending_transactions: dictinary containing all transactions yet to be accepted by the second party (receiver_id as key)
+  pending_transactions: dictinary containing all transactions yet to be accepted by the second party (receiver_id as key), each receiver's requests keyed by transaction_id in arrival order
+  request_ttl, max_pending: lifetime (seconds) and maximum number of pending transaction requests
+  clock: monotonic time source for request expiry
+  request_deadlines: expiry time of each pending request (transaction_id as key)
+  expiry_queue: heap of (expiry time, sequence number, transaction) over the pending requests, may hold entries of requests already answered (skipped when popped)
+  listeners: called with (kind, payload) for every change other copies of the chain need (see replication.py):
+    'nodes' (list of new node records), 'extend' (header_hash of the new canonical tip), 'revert' (header_hash of the undone tip), 'state' (changes committed without a block)
   accepted_transactions: list of transactions accepted by both participating nodes,    not verified
+  next_nonce: nonce of the next transaction each node starts (node id as key)
+  in_flight: transactions each node started that are neither mined nor dropped, by nonce (sender id as key); at most MAX_IN_FLIGHT per node
+  reserved: id of the transaction in flight each product is committed to (product id as key), a product can be in one transaction at a time
   newest_block: header_hash of the latest block added to the chain
   parent_node: the node running this blockchain copy
+  last_election: (miner, validator, validator) chosen by the latest mining round, None before the first
 **Methods**
   mineBlock: verify transactions of a block, the block itself and add it to the blockchain, miner and validators chosen based on consensus algorithm (contains the voting function to simulate a round of voting)
   ! consensus algorithm runs here
   validateTransactions: validate a goven transaction
   validateBlock: validate a given block
+  addBlock: add a validated block to the chain (on any branch), indexing its transactions; runs the fork choice
+  switchBranch: reorganise the chain onto another tip using the undo journals
+  getBlock: the full block (with transactions) for a header hash
+  getEncodedBlock: the encoded block for a header hash, not decoded
+  pruneBlocks: archive bodies older than the retention depth of the pruning policy
+  getTransaction: find a committed transaction by its id
+  getBlocksBetween, getTransactionsBetween: headers | transactions of the canonical blocks mined in a time window
+  getBlocksInvolving, getTransactionsInvolving: headers | transactions of the canonical blocks moving a product or involving a node, found with the blocks' bloom filters
   startTransaction: the parent node sends product id to a receiver node; manufacturer can make a transaction to itself to add products to the supply chain
   getPendingTransactions: parent node prints the transactions waiting for its signature
   (accept|reject)TransactionRequest: parent node accepts | rejects an incoming transaction request
+  findRequest: a request from a sender to the parent node (the oldest unless the nonce is given)
+  trackTransaction, settleTransaction: put a transaction in flight, reserving its products | take it out, releasing them
   changeParentNode: make another node parent
   calculate_hash: utility function to find SHA-256 hash of some data
   getProductStatus: given a product id, traverse the block chain to find the most recent transaction the product was present in
   showBlockchain: print all blocks of the blockchain
-  deleteTransactionRequest: delete the pending 
+  deleteTransactionRequest: delete a pending request of the parent node, releasing its products
+  expireRequests: drop the transaction requests past their deadline, releasing their products
 """
 class Blockchain():
-  def __init__(self, manufacturer_node: Node) -> None:
+  def __init__(self, manufacturer_node: Node, store: None | BlockStore = None, cache_size: int = BODY_CACHE_SIZE, pruning: None | PruningPolicy = None,
+               request_ttl: float = REQUEST_TTL, max_pending: int = MAX_PENDING_REQUESTS, clock: Callable[[], float] = time.monotonic) -> None:
     # BROADCAST
     current_active_nodes[manufacturer_node.id] = manufacturer_node
     self.manufacturer_id = manufacturer_node.id
+    # signature scheme used by every node of this chain
+    self.signer = manufacturer_node.signer
     # tracks used product ids and their current locations (before they are used in a transaction)
     self.product_locations: dict[int, int] = dict()
     for product in manufacturer_node.stock:
       self.product_locations[product] = self.manufacturer_id
-    # header_hash => block
-    self.blockchain: dict[str, Block] = dict()
+    # header_hash => block header, the bodies are kept in the store
+    self.blockchain: dict[str, BlockHeader] = dict()
+    self.store = store if store is not None else MemoryBlockStore()
+    self.body_cache = LRUCache(cache_size)
+    self.pruning = pruning
+    self.archived_height = -1
     genesis_block = Block(self.calculateHash(''), 0, [], manufacturer_node.id)
-    self.blockchain[genesis_block.header_hash] = genesis_block
+    self.storeBlock(genesis_block)
+    # header_hash of the block at each height of the canonical chain
+    self.heights: list[str] = [genesis_block.header_hash]
+    # header_hash => cumulative stake weight of the branch ending at the block
+    self.weights: dict[str, int] = {genesis_block.header_hash: 0}
+    # blocks without children
+    self.tips: set[str] = {genesis_block.header_hash}
+    # header_hash => [state changes of the block, undo journal while they are applied]
+    self.journals: dict[str, list] = dict()
+    # transaction_id => (block height, position in the block) of every committed transaction
+    self.transaction_index: dict[str, tuple[int, int]] = dict()
     # node_id => node's public info
     self.nodes: dict[int, NodePublicInfo] = {manufacturer_node.id: manufacturer_node.getInfo()}
-    # the genesis block
-    self.blocked_nodes: set[int] = set()
+    # sender_id => nonce => transaction in flight; product_id => transaction_id reserving it
+    self.next_nonce: defaultdict[int, int] = defaultdict(int)
+    self.in_flight: defaultdict[int, dict[int, Transaction]] = defaultdict(dict)
+    self.reserved: dict[int, str] = dict()
     # receiver_id => unsigned transaction list
-    self.pending_transactions: defaultdict[int, list[Transaction]] = defaultdict(list)
+    self.pending_transactions: defaultdict[int, dict[str, Transaction]] = defaultdict(dict)
+    self.request_ttl = request_ttl
+    self.max_pending = max_pending
+    self.clock = clock
+    # transaction_id => expiry time of the pending request
+    self.request_deadlines: dict[str, float] = dict()
+    self.expiry_queue: list[tuple[float, int, Transaction]] = []
+    self.expiry_sequence = 0
     self.accepted_transactions: list[Transaction] = []
     self.newest_block = genesis_block.header_hash
     self.parent_node = manufacturer_node
+    self.last_election: None | tuple[int, int, int] = None
+    self.listeners: list[Callable[[str, Any], None]] = []
+
+  def notify(self, kind: str, payload: Any) -> None:
+    for listener in self.listeners:
+      listener(kind, payload)
   
   def mineBlock(self) -> None:
     print("Mining initiated\nStarting Voting Process")
@@ -250,86 +498,101 @@ class Blockchain():
       return delegates[0][1], delegates[1][1], delegates[2][1]
 
     miner, validator1, validator2 = voting()
+    self.last_election = (miner, validator1, validator2)
     print('Chosen Miner id:', miner, 'Chosen Validator ids:', validator1, validator2)
     
-    block_txn = self.accepted_transactions
-    # verify all accepted transactions
-    for txn in block_txn.copy():
-      if not self.validateTransaction(txn):
-        block_txn.remove(txn)
+    # all stake and stock changes of this round are applied together at the end
+    journal = StateJournal(self.nodes, self.product_locations)
+    # verify all accepted transactions, packing the valid non conflicting ones into the block
+    assembler = BlockAssembler()
+    for txn in orderByNonce(self.accepted_transactions):
+      if assembler.full() or assembler.conflicts(txn):
+        assembler.defer(txn)
+      elif self.validateTransaction(txn, journal):
+        assembler.add(txn)
+    block_txn = assembler.transactions
+    # deferred transactions stay accepted (and in flight) for the next block
+    self.accepted_transactions = assembler.deferred
     # if there are no transactions, stop mining
     if not block_txn:
-      self.accepted_transactions.clear()
+      changes = list(journal.changes)
+      journal.commit()
+      self.notify('state', changes)
       return print("No valid transactions for this block found")
+    if assembler.deferred:
+      print("Transactions deferred to the next block:", len(assembler.deferred))
 
     print("Valid transactions separated:", block_txn)
-    new_block = Block(self.newest_block, len(self.blockchain), block_txn, miner)
+    # block timestamps never decrease along a branch, so the canonical chain can be binary searched by time
+    new_block = Block(self.newest_block, len(self.heights), block_txn, miner, max(currentTimestamp(), self.blockchain[self.newest_block].timestamp))
 
-    if not self.validateBlock(new_block):
-      print("Block failed verification for 50% validators, applying penalty to the miner and those who voted for him")
-      self.nodes[miner]['stake'] //= 2
-      current_active_nodes[miner].stake //= 2
-      for id in voted[miner]:
-        self.nodes[id]['stake'] -= 20
-        current_active_nodes[id].stake -= 20
-    else:    
-      print("Block Mined, 2 confirmations received, applying valid transaction operations::")
-      for transaction in new_block.transactions:
-        if transaction.sender_id == transaction.receiver_id:
-          print('Transaction from manufacturer to manufacturer')
-        else:
-          # perform the transaction operations
-          self.nodes[transaction.sender_id]['stock'] = self.nodes[transaction.sender_id]['stock'].difference(transaction.product_ids)
-          # BROADCAST
-          current_active_nodes[transaction.sender_id].stock = current_active_nodes[transaction.sender_id].stock.difference(transaction.product_ids)
-        # receiver always gets the goods
-        self.nodes[transaction.receiver_id]['stock'] = self.nodes[transaction.receiver_id]['stock'].union(transaction.product_ids)
-        # BROADCAST
-        for product in transaction.product_ids:
-          self.product_locations[product] = transaction.receiver_id
-        current_active_nodes[transaction.receiver_id].stock = current_active_nodes[transaction.receiver_id].stock.union(transaction.product_ids)
-      
-      print('Rewarding Miner and his voters')
-      self.nodes[miner]['stake'] += 200
-      current_active_nodes[miner].stake += 200
-      for id in voted[miner]:
-        self.nodes[id]['stake'] += 5
-        current_active_nodes[id].stake += 5
+    # the penalties recorded while validating transactions hold even if the block fails
+    savepoint = journal.savepoint()
+    print('Applying valid transaction operations and rewarding Miner and his voters')
+    for transaction in new_block.transactions:
+      if transaction.sender_id == transaction.receiver_id:
+        print('Transaction from manufacturer to manufacturer')
+      journal.transfer(transaction.sender_id, transaction.receiver_id, transaction.product_ids)
+    journal.addStake([miner], 200)
+    journal.addStake(voted[miner], 5)
 
-      # Block is valid, make necessary changes to the blockchain
-      self.accepted_transactions.clear()
-      self.blockchain[new_block.header_hash]=new_block
-      self.newest_block=new_block.header_hash
+    valid = self.validateBlock(new_block)
+    if not valid:
+      print("Block failed verification for 50% validators, applying penalty to the miner and those who voted for him")
+      journal.rollback(savepoint)
+      # the valid transactions are mined again
+      self.accepted_transactions = block_txn + self.accepted_transactions
+      journal.halveStake(miner)
+      journal.addStake(voted[miner], -20)
+    else:
+      print("Block Mined, 2 confirmations received")
     
     print("Rewarding validator and their voters::")
-    self.nodes[validator1]['stake'] += 20
-    current_active_nodes[validator1].stake += 20
-    for id in voted[validator1]:
-      self.nodes[id]['stake'] += 2
-      current_active_nodes[id].stake += 2
-    self.nodes[validator2]['stake'] += 20
-    current_active_nodes[validator2].stake += 20
-    for id in voted[validator2]:
-      self.nodes[id]['stake'] += 2
-      current_active_nodes[id].stake += 2
-
-  """
-  Validate a transaction and perform the operations if it is valid; only manufacturer can make a transaction to oneself. Both sender and receiver are removed from blocked nodes even if transaction is invalid
-  """
-  def validateTransaction(self, transaction:Transaction) -> bool:
-    self.blocked_nodes.remove(transaction.sender_id)
-    if transaction.receiver_id != transaction.sender_id:
-      self.blocked_nodes.remove(transaction.receiver_id)
-    if Node.verify(transaction.transaction_id, transaction.sender_sign, self.nodes[transaction.sender_id]['public_key']) and transaction.receiver_sign:
+    journal.addStake([validator1, validator2], 20)
+    journal.addStake(voted[validator1], 2)
+    journal.addStake(voted[validator2], 2)
+    changes = list(journal.changes)
+    # BROADCAST
+    undo = journal.commit()
+    if valid:
+      # Block is valid, make necessary changes to the blockchain
+      self.addBlock(new_block, changes, undo)
+    else:
+      self.notify('state', changes)
+
+  """
+  Validate a transaction; only manufacturer can make a transaction to oneself. Only transactions in flight are valid (a mined or dropped transaction can't be replayed), an invalid transaction is dropped and its products released. Penalties are recorded in the given journal (applied immediately if there is none)
+  """
+  def validateTransaction(self, transaction:Transaction, journal: 'None | StateJournal' = None) -> bool:
+    if journal is None:
+      journal = StateJournal(self.nodes, self.product_locations)
+      valid = self.validateTransaction(transaction, journal)
+      changes = list(journal.changes)
+      journal.commit()
+      self.notify('state', changes)
+      return valid
+    tracked = self.in_flight[transaction.sender_id].get(transaction.nonce)
+    if tracked is None or tracked.transaction_id != transaction.transaction_id:
+      print("Transaction", transaction.transaction_id, "is not in flight (already mined or dropped)")
+      return False
+    if not self.checkTransaction(transaction, journal):
+      self.settleTransaction(transaction)
+      return False
+    return True
+
+  """
+  Check the signatures of a transaction and the stock of both nodes, recording penalties in the journal
+  """
+  def checkTransaction(self, transaction: Transaction, journal: 'StateJournal') -> bool:
+    if transaction.transaction_id == transaction.calculateId() and transaction.receiver_sign and Node.verify(transaction.transaction_id, transaction.sender_sign, self.nodes[transaction.sender_id]['public_key'], self.signer):
       print("sender_sign verified")
-      if Node.verify(transaction.transaction_id, transaction.receiver_sign, self.nodes[transaction.receiver_id]['public_key']):
+      if Node.verify(transaction.transaction_id, transaction.receiver_sign, self.nodes[transaction.receiver_id]['public_key'], self.signer):
         print("receiver_sign verified")
         if transaction.sender_id == transaction.receiver_id:
           if transaction.sender_id != transaction.manufacturer_id:
             print("Transaction to oneself (not manufacturer) detected")
             print("Penalizing the node")
-            self.nodes[transaction.sender_id]['stake'] //= 2
-            current_active_nodes[transaction.sender_id].stake //= 2
+            journal.halveStake(transaction.sender_id)
             return False
           return True
         elif not transaction.product_ids.difference(self.nodes[transaction.sender_id]['stock']):
@@ -337,8 +600,7 @@ class Blockchain():
           if transaction.product_ids.intersection(self.nodes[transaction.receiver_id]['stock']):
             print('Duplicate Product id in receiver\'s stock')
             print("Penalizing the node")
-            self.nodes[transaction.receiver_id]['stake'] //= 2
-            current_active_nodes[transaction.receiver_id].stake //= 2
+            journal.halveStake(transaction.receiver_id)
             return False
           print('Product id not in receiver\'s stock verified')
           return True
@@ -346,10 +608,162 @@ class Blockchain():
           # Sender does not hacve the requested goods
           print("Node id:", transaction.sender_id, " does not have the mentioned product ids:", transaction.product_ids.difference(self.nodes[transaction.sender_id]['stock']))
           print("Penalizing the node")
-          self.nodes[transaction.sender_id]['stake'] //= 2
-          current_active_nodes[transaction.sender_id].stake //= 2
+          journal.halveStake(transaction.sender_id)
     return False
   
+  """
+  Add a validated block whose parent is any known block, with the state changes (see StateJournal) it makes
+    undo: the undo journal if the changes are already applied (the block extends the canonical chain), None otherwise
+  The block becomes the canonical tip if its branch has the highest cumulative stake weight (ties keep the current tip), the chain is reorganised if it is on another branch
+  """
+  def addBlock(self, block: Block, changes: Iterable[tuple] = (), undo: None | list[tuple] = None) -> None:
+    self.storeBlock(block)
+    # the miner's stake before the block's own changes weighs it (at least 1, so that a child always outweighs its parent), wherever the block comes from
+    stake = self.nodes[block.miner_id]['stake']
+    if undo is not None:
+      stake -= sum(change[2] for change in undo if change[0] == 'stake' and change[1] == block.miner_id)
+    self.weights[block.header_hash] = self.weights[block.previous_hash] + max(stake, 0) + 1
+    self.journals[block.header_hash] = [list(changes), undo]
+    self.tips.discard(block.previous_hash)
+    self.tips.add(block.header_hash)
+    if block.previous_hash == self.newest_block:
+      if undo is None:
+        self.journals[block.header_hash][1] = StateJournal(self.nodes, self.product_locations).apply(changes)
+      self.extendChain(block.header_hash)
+    elif self.weights[block.header_hash] > self.weights[self.newest_block]:
+      self.switchBranch(block.header_hash)
+
+  """
+  Make a block whose parent is the canonical tip the new tip, indexing its transactions
+  """
+  def extendChain(self, header_hash: str) -> None:
+    block = self.getBlock(header_hash)
+    self.heights.append(header_hash)
+    for position, txn in enumerate(block.transactions):
+      self.transaction_index[txn.transaction_id] = (block.height, position)
+      self.settleTransaction(txn)
+      self.next_nonce[txn.sender_id] = max(self.next_nonce[txn.sender_id], txn.nonce + 1)
+    self.newest_block = header_hash
+    self.notify('extend', header_hash)
+    # blocks this deep can no longer be reorganised
+    old_height = len(self.heights) - 2 - REORG_DEPTH
+    if old_height >= 0:
+      self.journals.pop(self.heights[old_height], None)
+    if self.pruning is not None:
+      self.pruneBlocks()
+
+  """
+  Reorganise the chain to end at the given tip: the canonical blocks after the fork point are undone with their undo journals, the blocks of the new branch are applied; transactions left out of the new branch go back to accepted_transactions
+  """
+  def switchBranch(self, tip: str) -> None:
+    branch: list[str] = []
+    cur = tip
+    while not (self.blockchain[cur].height < len(self.heights) and self.heights[self.blockchain[cur].height] == cur):
+      branch.append(cur)
+      cur = self.blockchain[cur].previous_hash
+    fork_height = self.blockchain[cur].height
+    if fork_height < self.archived_height or len(self.heights) - 1 - fork_height > REORG_DEPTH:
+      return print("Fork point too deep, chain not reorganised")
+    print("Reorganising the chain from height", fork_height + 1, "onto tip", tip)
+    journal = StateJournal(self.nodes, self.product_locations)
+    orphaned: list[Transaction] = []
+    for header_hash in reversed(self.heights[fork_height + 1:]):
+      journal.revert(self.journals[header_hash][1])
+      self.journals[header_hash][1] = None
+      self.notify('revert', header_hash)
+      for txn in self.getBlock(header_hash).transactions:
+        del self.transaction_index[txn.transaction_id]
+        orphaned.append(txn)
+    del self.heights[fork_height + 1:]
+    self.newest_block = cur
+    for header_hash in reversed(branch):
+      self.journals[header_hash][1] = journal.apply(self.journals[header_hash][0])
+      self.extendChain(header_hash)
+    for txn in reversed(orphaned):
+      if txn.transaction_id not in self.transaction_index:
+        self.accepted_transactions.append(txn)
+        self.trackTransaction(txn)
+
+  """
+  Move the bodies of blocks deeper than the retention depth to cold storage, headers and indexes stay in memory
+  """
+  def pruneBlocks(self) -> None:
+    cutoff = len(self.heights) - 1 - self.pruning.retention_depth
+    while self.archived_height < cutoff:
+      self.archived_height += 1
+      header_hash = self.heights[self.archived_height]
+      self.pruning.archive.put(header_hash, self.store.pop(header_hash))
+      self.body_cache.discard(header_hash)
+
+  """
+  Find a committed transaction by its id without scanning the chain, None if there is no such transaction
+  """
+  def getTransaction(self, transaction_id: str) -> None | Transaction:
+    if transaction_id not in self.transaction_index:
+      return None
+    height, position = self.transaction_index[transaction_id]
+    return self.getBlock(self.heights[height]).transactions[position]
+
+  """
+  params:
+    start, end: the time window [start, end) in microseconds since the epoch (see toTimestamp)
+  returns: headers of the canonical blocks (genesis excluded) mined in the window, oldest first
+  """
+  def getBlocksBetween(self, start: int, end: int) -> list[BlockHeader]:
+    time_of = lambda header_hash: self.blockchain[header_hash].timestamp
+    first = bisect_left(self.heights, start, 1, key=time_of)
+    last = bisect_left(self.heights, end, first, key=time_of)
+    return [self.blockchain[header_hash] for header_hash in self.heights[first:last]]
+
+  """
+  Transactions committed in the time window [start, end) (by the time of their block), oldest block first; only the bodies of these blocks are loaded
+  """
+  def getTransactionsBetween(self, start: int, end: int) -> list[Transaction]:
+    return [txn for header in self.getBlocksBetween(start, end) for txn in self.getBlock(header.header_hash).transactions]
+
+  """
+  params:
+    product_id, node_id: the product | node (as sender or receiver) looked for, blocks must match both if both are given
+  returns: headers of the canonical blocks (genesis excluded) that may involve them according to their bloom filters, oldest first; only the headers are read
+  """
+  def getBlocksInvolving(self, product_id: None | int = None, node_id: None | int = None) -> list[BlockHeader]:
+    headers = (self.blockchain[header_hash] for header_hash in self.heights[1:])
+    return [header for header in headers
+            if (product_id is None or header.bloom.mayHaveProduct(product_id)) and (node_id is None or header.bloom.mayHaveNode(node_id))]
+
+  """
+  Transactions moving the product | involving the node (as sender or receiver), oldest block first; only the bodies of the blocks passing the bloom filters are loaded
+  """
+  def getTransactionsInvolving(self, product_id: None | int = None, node_id: None | int = None) -> list[Transaction]:
+    return [txn for header in self.getBlocksInvolving(product_id, node_id) for txn in self.getBlock(header.header_hash).transactions
+            if (product_id is None or product_id in txn.product_ids) and (node_id is None or node_id in (txn.sender_id, txn.receiver_id))]
+
+  """
+  Keep the header of a block in memory and its body in the store
+  """
+  def storeBlock(self, block: Block) -> None:
+    self.blockchain[block.header_hash] = block.header()
+    self.store.put(block.header_hash, block.encode())
+    self.body_cache.put(block.header_hash, block)
+
+  """
+  Get the full block for a header hash, decoding its body from the store (or cold storage) if it is not cached
+  """
+  def getBlock(self, header_hash: str) -> Block:
+    block = self.body_cache.get(header_hash)
+    if block is None:
+      block = Block.fromView(self.getEncodedBlock(header_hash))
+      self.body_cache.put(header_hash, block)
+    return block
+
+  """
+  Get the encoding of a block (see wireformat.py) from the store or cold storage, without decoding it
+  """
+  def getEncodedBlock(self, header_hash: str) -> bytes:
+    if header_hash in self.store or self.pruning is None:
+      return self.store.get(header_hash)
+    return self.pruning.archive.get(header_hash)
+
   def validateBlock(self, block: Block) -> bool:
     # check the merkle tree
     temp_tree=MerkleTree(block.transactions)
@@ -362,8 +776,18 @@ class Blockchain():
       return False
     
     print('previous hash verified')
+    # check the timestamp, getBlocksBetween bisects the chain and needs timestamps that never decrease
+    if block.timestamp < self.blockchain[block.previous_hash].timestamp:
+      return False
+
+    print('timestamp verified')
+    # check the bloom filter, a filter missing ids would hide the block from scans
+    if not block.bloom == BloomFilter.fromTransactions(block.transactions):
+      return False
+
+    print('bloom filter verified')
     # check the headerhash
-    header_hash=self.calculateHash(block.previous_hash + block.merkle_root + str(block.height) + str(block.miner_id) + block.timestamp.strftime("%d|%m|%Y><%H:%M:%S"))
+    header_hash=Block.hashHeader(block.previous_hash, block.merkle_root, block.height, block.miner_id, block.timestamp, block.bloom)
     if not header_hash==block.header_hash:
       return False
     
@@ -373,77 +797,159 @@ class Blockchain():
     return True
 
   """
-  The parent node starts a transaction as the sender
+  The parent node starts a transaction as the sender, with its next nonce; the products are reserved for the transaction until it is mined or dropped
   """
   def startTransaction(self, receiver_id: int, product_ids: set[int]) -> None:
     sender_id = self.parent_node.id
-    if self.parent_node.id in self.blocked_nodes: return print("Previous transaction verification pending.\n Next transaction can be requested only after verifying previous one")
-    product_xor = 0
-    for i in product_ids:
-      product_xor ^= i
-    new_txn = Transaction(self.manufacturer_id, product_ids, sender_id, receiver_id, self.parent_node.sign(product_xor^sender_id^receiver_id))
-    self.pending_transactions[receiver_id].append(new_txn)
+    self.expireRequests()
+    if len(self.in_flight[sender_id]) >= MAX_IN_FLIGHT: return print("Too many transactions in flight (" + str(MAX_IN_FLIGHT) + ").\n Next transaction can be requested after the next mining")
+    if len(self.request_deadlines) >= self.max_pending: return print("Too many pending transaction requests in the network, try again later")
+    reserved = product_ids.intersection(self.reserved)
+    if reserved: return print("Products", reserved, "are already part of a transaction in flight")
+    new_txn = Transaction(self.manufacturer_id, product_ids, sender_id, receiver_id, nonce=self.next_nonce[sender_id])
+    new_txn.sender_sign = self.parent_node.sign(new_txn.transaction_id)
+    self.trackTransaction(new_txn)
+    self.addRequest(new_txn)
     if sender_id == receiver_id == self.manufacturer_id:
-      self.acceptTransactionRequest(self.manufacturer_id)
+      self.acceptTransactionRequest(self.manufacturer_id, new_txn.nonce)
       return print("Given products will be added in next mining")
-    self.blocked_nodes.add(sender_id)
     print("Transaction request sent to: ", receiver_id)
-    print("Transaction id:", new_txn.transaction_id)
+    print("Transaction id:", new_txn.transaction_id, "nonce:", new_txn.nonce)
     return print("Wait for receiver's response; and the next mining for the transaction to be completed")
-  
+
   """
-  Deletes a pending transaction sent by the parent node, unblocking it for more transactions
+  Puts a transaction in flight: it holds its sender's nonce and reserves its products; a product already reserved by another transaction
+  keeps that reservation (a transaction orphaned by a reorganisation doesn't take over the products of a newer one, which would lose them when it settles)
   """
-  def deleteTransactionRequest(self) -> None:
-    if self.parent_node.id not in self.blocked_nodes:
+  def trackTransaction(self, txn: Transaction) -> None:
+    self.in_flight[txn.sender_id][txn.nonce] = txn
+    self.next_nonce[txn.sender_id] = max(self.next_nonce[txn.sender_id], txn.nonce + 1)
+    for product in txn.product_ids:
+      self.reserved.setdefault(product, txn.transaction_id)
+
+  """
+  Takes a transaction out of flight (mined, dropped, rejected, deleted or expired), releasing its products; its nonce is not reused
+  """
+  def settleTransaction(self, txn: Transaction) -> None:
+    tracked = self.in_flight[txn.sender_id].get(txn.nonce)
+    if tracked is None or tracked.transaction_id != txn.transaction_id:
+      return
+    del self.in_flight[txn.sender_id][txn.nonce]
+    for product in txn.product_ids:
+      if self.reserved.get(product) == txn.transaction_id:
+        del self.reserved[product]
+
+  """
+  Deletes a pending transaction request sent by the parent node (the latest unless the nonce is given), releasing its products
+  """
+  def deleteTransactionRequest(self, nonce: None | int = None) -> None:
+    self.expireRequests()
+    requests = [txn for txn in self.in_flight[self.parent_node.id].values() if txn.transaction_id in self.request_deadlines and (nonce is None or txn.nonce == nonce)]
+    if not requests:
+      if nonce in self.in_flight[self.parent_node.id]:
+        return print("Transaction has been accepted; it cannot be deleted; its products will be released after verification")
       return print("No Pending Transaction found for parent")
-    for txns in self.pending_transactions.values():
-      for txn in txns:
-        if txn.sender_id == self.parent_node.id:
-          self.blocked_nodes.remove(self.parent_node.id)
-          self.pending_transactions[txn.receiver_id].remove(txn)
-          return print("Transaction deleted; node unblocked for transactions")
-    return print("Transaction has been accepted; it cannot be deleted; node will be unblocked after verification")
+    txn = max(requests, key=lambda txn: txn.nonce)
+    self.removeRequest(txn)
+    self.settleTransaction(txn)
+    return print("Transaction", txn.nonce, "deleted; its products are released")
 
   """
   Get all transaction requests sent TO parent node; this are still to be accepted or rejected
   """
   def getPendingTransactions(self) -> str:
-    return json.dumps(self.pending_transactions[self.parent_node.id], cls=customEncoder, indent=4, separators=(',', ': '))
+    self.expireRequests()
+    return json.dumps(list(self.pending_transactions[self.parent_node.id].values()), cls=customEncoder, indent=4, separators=(',', ': '))
+
+  """
+  The request from the sender to the parent node with the given nonce (the oldest one if None), looked up among the sender's transactions in flight
+  """
+  def findRequest(self, sender_id: int, nonce: None | int = None) -> None | Transaction:
+    pending = self.pending_transactions[self.parent_node.id]
+    if nonce is not None:
+      txn = self.in_flight[sender_id].get(nonce)
+      return txn if txn is not None and txn.transaction_id in pending else None
+    requests = [txn for txn in self.in_flight[sender_id].values() if txn.transaction_id in pending]
+    return min(requests, key=lambda txn: txn.nonce) if requests else None
   
   """
-  Reject a transaction, the initiator is notified and removed from blocked_nodes (products returned to sender)
+  Reject a transaction request (the oldest from the sender unless the nonce is given), the initiator is notified and the products released
   """
-  def rejectTransactionRequest(self, sender_id: int) -> None:
-    for txn in self.pending_transactions[self.parent_node.id]:
-      if txn.sender_id == sender_id:
-        self.pending_transactions[self.parent_node.id].remove(txn)
-        self.blocked_nodes.remove(txn.sender_id)
-        return print("Transaction Rejected")
-    return print("No such transaction")
+  def rejectTransactionRequest(self, sender_id: int, nonce: None | int = None) -> None:
+    self.expireRequests()
+    txn = self.findRequest(sender_id, nonce)
+    if txn is None:
+      return print("No such transaction")
+    self.removeRequest(txn)
+    self.settleTransaction(txn)
+    return print("Transaction Rejected")
 
   """
-  Accept a transaction, the acceptor is added to the blocked_nodes list, transaction moved to accepted_transactions (products will be delivered after verification)
+  Accept a transaction request (the oldest from the sender unless the nonce is given), transaction moved to accepted_transactions (products will be delivered after verification)
   """
-  def acceptTransactionRequest(self, sender_id: int) -> None:
-    if self.parent_node.id in self.blocked_nodes: return print("Previous transaction verification pending.\n Next transaction can be accepted only after verifying previous one")
-    for txn in self.pending_transactions[self.parent_node.id]:
-      if txn.sender_id == sender_id:
-        self.pending_transactions[self.parent_node.id].remove(txn)
-        txn.receiver_sign = self.parent_node.sign(txn.transaction_id)
-        self.accepted_transactions.append(txn)
-        self.blocked_nodes.add(self.parent_node.id)
-        print("Transaction Accepted; wait for the next mining to receive products")
-        if len(self.accepted_transactions) >= MAX_TRANSACSIZE:
-          print("Multiple unverified transactions in the network")
-          print("Other nodes have started mining")
-          return self.mineBlock()
-        return
-    return print("No such transaction for current parent")
+  def acceptTransactionRequest(self, sender_id: int, nonce: None | int = None) -> None:
+    self.expireRequests()
+    txn = self.findRequest(sender_id, nonce)
+    if txn is None:
+      return print("No such transaction for current parent")
+    self.removeRequest(txn)
+    txn.receiver_sign = self.parent_node.sign(txn.transaction_id)
+    self.accepted_transactions.append(txn)
+    print("Transaction Accepted; wait for the next mining to receive products")
+    if len(self.accepted_transactions) >= MAX_TRANSACSIZE:
+      print("Multiple unverified transactions in the network")
+      print("Other nodes have started mining")
+      return self.mineBlock()
+
+  """
+  Adds a transaction request to the receiver's pending list, it expires request_ttl seconds from now
+  """
+  def addRequest(self, txn: Transaction) -> None:
+    deadline = self.clock() + self.request_ttl
+    self.pending_transactions[txn.receiver_id][txn.transaction_id] = txn
+    self.request_deadlines[txn.transaction_id] = deadline
+    heapq.heappush(self.expiry_queue, (deadline, self.expiry_sequence, txn))
+    self.expiry_sequence += 1
+
+  """
+  Removes an answered (or deleted) request from the pending list, its queue entry is skipped when it reaches the top
+  """
+  def removeRequest(self, txn: Transaction) -> None:
+    del self.pending_transactions[txn.receiver_id][txn.transaction_id]
+    del self.request_deadlines[txn.transaction_id]
+    # answered requests far outnumbering pending ones: rebuild the queue so it does not grow with them
+    if len(self.expiry_queue) > 2*len(self.request_deadlines) + 64:
+      self.expiry_queue = [entry for entry in self.expiry_queue if entry[2].transaction_id in self.request_deadlines]
+      heapq.heapify(self.expiry_queue)
+
+  """
+  Drops every pending request whose deadline has passed and releases its products
+  returns: the expired requests
+  """
+  def expireRequests(self) -> list[Transaction]:
+    now = self.clock()
+    expired: list[Transaction] = []
+    while self.expiry_queue and self.expiry_queue[0][0] <= now:
+      _, _, txn = heapq.heappop(self.expiry_queue)
+      if txn.transaction_id not in self.request_deadlines:
+        continue
+      del self.pending_transactions[txn.receiver_id][txn.transaction_id]
+      del self.request_deadlines[txn.transaction_id]
+      self.settleTransaction(txn)
+      print("Transaction request", txn.transaction_id, "from", txn.sender_id, "to", txn.receiver_id, "expired; products released")
+      expired.append(txn)
+    return expired
     
   def changeParentNode(self, node_id: int) -> None:
     self.parent_node = current_active_nodes[node_id]
 
+  """
+  The parent node replaces its key pair and broadcasts the new public key
+  """
+  def rotateParentKeys(self) -> None:
+    # BROADCAST (the public info record is shared)
+    self.parent_node.rotateKeys()
+
   @staticmethod
   def calculateHash(s: Any) -> str:
     return hashlib.sha256(str(s).encode()).hexdigest()
@@ -453,31 +959,82 @@ class Blockchain():
       ntype = NodeType.CLIENT
     else:
       ntype = NodeType.DISTRIBUTOR
-    new_node = Node(10*initial_stake, n_address, n_stock, ntype)
+    new_node = Node(10*initial_stake, n_address, n_stock, ntype, self.signer)
     for product in n_stock:
       self.product_locations[product] = n_address
     self.nodes[new_node.id] = new_node.getInfo()
     # BROADCAST
     current_active_nodes[new_node.id] = new_node
+    self.notify('nodes', [new_node.getInfo()])
+
+  """
+  Registers many nodes at once: the whole batch is checked in one pass, then all valid nodes and their products are committed together
+  params:
+    specs: the nodes to register, a spec is rejected if its id or one of its product ids is already in use (on the chain or earlier in the batch), or its type or stake is invalid
+    generate_keys: generate the key pairs not given in the specs now, in parallel (see signers.generateKeys), instead of on each node's first signature
+    workers: number of key generation processes (None => one per CPU)
+  returns: the outcome for each spec, in order
+  """
+  def addNodes(self, specs: Iterable[NodeSpec], generate_keys: bool = False, workers: None | int = None) -> list[NodeRegistration]:
+    results: list[NodeRegistration] = []
+    accepted: list[NodeSpec] = []
+    # product id => node claiming it in this batch
+    claimed: dict[int, int] = dict()
+    ids: set[int] = set()
+    for spec in specs:
+      stock = set(spec['stock'])
+      error = None
+      if spec['id'] in self.nodes or spec['id'] in ids:
+        error = "node id already in use"
+      elif spec['type'] not in ('client', 'distributor'):
+        error = "invalid node type " + str(spec['type'])
+      elif spec['stake'] <= 0:
+        error = "stake must be positive"
+      else:
+        inuse = {product for product in stock if product in self.product_locations or product in claimed}
+        if inuse:
+          error = "product ids " + str(sorted(inuse)) + " already in use"
+      results.append({'id': spec['id'], 'registered': error is None, 'error': error})
+      if error is None:
+        ids.add(spec['id'])
+        for product in stock:
+          claimed[product] = spec['id']
+        accepted.append(dict(spec, stock=stock))
+    keys = [spec.get('keys') for spec in accepted]
+    if generate_keys:
+      missing = [i for i, pair in enumerate(keys) if pair is None]
+      for i, pair in zip(missing, generateKeys(self.signer, len(missing), workers)):
+        keys[i] = pair
+    new_nodes = [Node(10*spec['stake'], spec['id'], spec['stock'], NodeType(spec['type']), self.signer, pair) for spec, pair in zip(accepted, keys)]
+    self.product_locations.update(claimed)
+    self.nodes.update((node.id, node.getInfo()) for node in new_nodes)
+    # BROADCAST
+    current_active_nodes.update((node.id, node) for node in new_nodes)
+    if new_nodes:
+      self.notify('nodes', [node.getInfo() for node in new_nodes])
+    return results
   
   """
   Saves the product status in a qr image locally, returns the name of the file
   """
   def getProductStatus(self, product_id: int) -> str:
-    cur_block = self.blockchain[self.newest_block]
     ans = ""
-    while cur_block.height != 0:
-      for txn in cur_block.transactions:
-        for pid in txn.product_ids:
-          if pid == product_id:
-            if txn.sender_id == txn.manufacturer_id == txn.receiver_id:
-              ans = "Manufacturer with id: " + str(self.manufacturer_id) + " added the product to the supply chain on: " + txn.timestamp
-            ans = "Product with id: " + str(product_id) + " was sent from: " + self.nodes[txn.sender_id]['type'].name + " id: " + str(txn.sender_id) + " to: " + self.nodes[txn.receiver_id]['type'].name + " id: " + str(txn.receiver_id) + " at: " + txn.timestamp + "."
-      cur_block = self.blockchain[cur_block.previous_hash]
+    # only the blocks whose bloom filter may hold the product are loaded, newest first, until the most recent transaction is found
+    for header in reversed(self.getBlocksInvolving(product_id=product_id)):
+      txn = next((txn for txn in reversed(self.getBlock(header.header_hash).transactions) if product_id in txn.product_ids), None)
+      if txn is None:
+        continue
+      if txn.sender_id == txn.manufacturer_id == txn.receiver_id:
+        ans = "Manufacturer with id: " + str(self.manufacturer_id) + " added the product to the supply chain on: " + formatTimestamp(txn.timestamp)
+      else:
+        ans = "Product with id: " + str(product_id) + " was sent from: " + self.nodes[txn.sender_id]['type'].name + " id: " + str(txn.sender_id) + " to: " + self.nodes[txn.receiver_id]['type'].name + " id: " + str(txn.receiver_id) + " at: " + formatTimestamp(txn.timestamp) + "."
+      break
     if not ans:
       ans = "Product does not exist on the Blockchain."
       if product_id in self.product_locations:
         ans = "Product with id: " + str(product_id) + " found with " + self.nodes[self.product_locations[product_id]]['type'].name + " id: " + str(self.product_locations[product_id]) + ". It has not been used in any transactions."
+    # imported here, qrcode (and PIL) are only needed for this feature
+    import qrcode
     img = qrcode.make(ans)
     file_name = 'MyQRCode' + datetime.now().strftime("%d-%m-%Y--%H-%M-%S") + '.png'
     img.save(file_name)
@@ -485,13 +1042,144 @@ class Blockchain():
 
   def showBlockchain(self) -> None:
     print("###  Printing Blocks in the Blockchain  ###")
-    cur_block = self.blockchain[self.newest_block]
+    cur_block = self.getBlock(self.newest_block)
     while cur_block.height != 0:
+      print("Block", cur_block.height, "mined at", formatTimestamp(cur_block.timestamp))
       print(cur_block)
-      cur_block = self.blockchain[cur_block.previous_hash]
+      cur_block = self.getBlock(cur_block.previous_hash)
     # print genesis block
     return print(cur_block)
 
+"""
+Per-block journal of stake and stock changes: changes are only recorded, commit applies all of them to the node records (the single copy of every node's stake and stock) in one batch
+**Fields**
+  nodes: the node records changed by the journal (id as key)
+  product_locations: product locations updated by transfers
+  changes: the recorded changes, in order
+**Methods**
+  addStake: add an amount (negative for a penalty) to the stake of some nodes
+  halveStake: halve the stake of a node
+  transfer: move products from a sender to a receiver
+  savepoint, rollback: drop the changes recorded after a savepoint
+  commit: apply the recorded changes and empty the journal, returns the undo journal
+  apply: commit the given changes (e.g. those recorded for a block)
+  revert: apply an undo journal returned by commit
+Stake undo entries hold the amount each change added (negative for a penalty or a halving), so reverting a block subtracts its own stake
+changes and keeps those committed outside its journal since (penalties of failed rounds, rewards of rounds without a block)
+"""
+class StateJournal():
+  def __init__(self, nodes: dict[int, NodePublicInfo], product_locations: dict[int, int]) -> None:
+    self.nodes = nodes
+    self.product_locations = product_locations
+    self.changes: list[tuple] = []
+
+  def addStake(self, ids: Iterable[int], amount: int) -> None:
+    self.changes.append(('stake', tuple(ids), amount))
+
+  def halveStake(self, id: int) -> None:
+    self.changes.append(('halve', id))
+
+  def transfer(self, sender_id: int, receiver_id: int, product_ids: set[int]) -> None:
+    self.changes.append(('transfer', sender_id, receiver_id, product_ids))
+
+  def savepoint(self) -> int:
+    return len(self.changes)
+
+  def rollback(self, savepoint: int = 0) -> None:
+    del self.changes[savepoint:]
+
+  def apply(self, changes: Iterable[tuple]) -> list[tuple]:
+    self.changes = list(changes)
+    return self.commit()
+
+  def commit(self) -> list[tuple]:
+    nodes = self.nodes
+    undo: list[tuple] = []
+    for change in self.changes:
+      if change[0] == 'stake':
+        for id in change[1]:
+          undo.append(('stake', id, change[2]))
+          nodes[id]['stake'] += change[2]
+      elif change[0] == 'halve':
+        stake = nodes[change[1]]['stake']
+        undo.append(('stake', change[1], stake // 2 - stake))
+        nodes[change[1]]['stake'] = stake // 2
+      else:
+        _, sender_id, receiver_id, product_ids = change
+        removed = product_ids.intersection(nodes[sender_id]['stock']) if sender_id != receiver_id else set()
+        added = product_ids.difference(nodes[receiver_id]['stock'])
+        undo.append(('transfer', sender_id, receiver_id, removed, added, {product: self.product_locations.get(product) for product in product_ids}))
+        # a manufacturer's transaction to itself only adds products
+        nodes[sender_id]['stock'].difference_update(removed)
+        # receiver always gets the goods
+        nodes[receiver_id]['stock'].update(product_ids)
+        for product in product_ids:
+          self.product_locations[product] = receiver_id
+    self.changes.clear()
+    return undo
+
+  def revert(self, undo: list[tuple]) -> None:
+    for change in reversed(undo):
+      if change[0] == 'stake':
+        self.nodes[change[1]]['stake'] -= change[2]
+      else:
+        _, sender_id, receiver_id, removed, added, locations = change
+        self.nodes[receiver_id]['stock'].difference_update(added)
+        self.nodes[sender_id]['stock'].update(removed)
+        for product, location in locations.items():
+          if location is None:
+            self.product_locations.pop(product, None)
+          else:
+            self.product_locations[product] = location
+
+"""
+Orders each sender's transactions by nonce, keeping the positions its transactions hold in the list (transactions of different senders keep their order)
+Only the given (accepted) transactions are ordered: a later nonce can be mined before an earlier one still waiting for its receiver's answer.
+This is deliberate: nonces are not contiguous anyway (a rejected, deleted or expired request leaves a gap), and waiting for the answer would let
+one unanswered request hold back all the sender's other transfers until it expires
+"""
+def orderByNonce(transactions: list[Transaction]) -> list[Transaction]:
+  queues: defaultdict[int, list[Transaction]] = defaultdict(list)
+  for txn in sorted(transactions, key=lambda txn: txn.nonce, reverse=True):
+    queues[txn.sender_id].append(txn)
+  return [queues[txn.sender_id].pop() for txn in transactions]
+
+"""
+Packs accepted transactions into a candidate block; every transaction is checked against the stock before the block, so a transaction moving a product already moved in this block (a double spend inside the batch) is deferred to the next block instead
+**Fields**
+  max_size: maximum number of transactions in the block
+  touched_products: product ids moved by the transactions in the block
+  transactions: transactions packed into the block
+  deferred: transactions left for the next block, in their original order
+  deferred_senders: senders with a deferred transaction, their later nonces are deferred too so that nonces are applied in order
+**Methods**
+  conflicts: True if the transaction moves a product already moved in this block (O(1) per product) or follows a deferred transaction of its sender
+  full: True if no more transactions fit in the block
+  add: pack a (validated) transaction into the block
+  defer: leave a transaction for the next block
+"""
+class BlockAssembler():
+  def __init__(self, max_size: int = MAX_BLOCKSIZE) -> None:
+    self.max_size = max_size
+    self.touched_products: set[int] = set()
+    self.transactions: list[Transaction] = []
+    self.deferred: list[Transaction] = []
+    self.deferred_senders: set[int] = set()
+
+  def conflicts(self, transaction: Transaction) -> bool:
+    return transaction.sender_id in self.deferred_senders or not self.touched_products.isdisjoint(transaction.product_ids)
+
+  def full(self) -> bool:
+    return len(self.transactions) >= self.max_size
+
+  def add(self, transaction: Transaction) -> None:
+    self.touched_products.update(transaction.product_ids)
+    self.transactions.append(transaction)
+
+  def defer(self, transaction: Transaction) -> None:
+    self.deferred.append(transaction)
+    self.deferred_senders.add(transaction.sender_id)
+
 """
 Class defining a node of the merkle tree
 **Fields**
@@ -537,5 +1225,58 @@ class MerkleTree():
   def getRootHash(self) -> str:
     return self.tree_root.value
 
+"""
+Bloom filter of the product ids and node ids (senders and receivers) touched by the transactions of a block, sized for the block: a negative answer is certain,
+a positive one means the block may hold the id (about 1% false positives)
+**Fields**
+  bits: the filter, BLOOM_BITS_PER_ENTRY bits per id and at least 64 bits (read-only after creation)
+**Methods**
+  fromTransactions: build the filter of a block's transactions
+  mayHaveProduct, mayHaveNode: test a product | node id
+"""
+class BloomFilter():
+  __slots__ = ('bits',)
+
+  def __init__(self, bits: bytes) -> None:
+    self.bits = bits
+
+  # products and nodes share the filter, the key tells them apart
+  @staticmethod
+  def key(kind: bytes, id: int) -> bytes:
+    return kind + id.to_bytes(8, 'little', signed=True)
+
+  # double hashing: BLOOM_HASHES positions out of one 128 bit digest
+  @staticmethod
+  def positions(key: bytes, size: int) -> Iterator[int]:
+    digest = hashlib.blake2b(key, digest_size=16).digest()
+    h1, h2 = int.from_bytes(digest[:8], 'little'), int.from_bytes(digest[8:], 'little') | 1
+    return ((h1 + i*h2) % size for i in range(BLOOM_HASHES))
+
+  @classmethod
+  def fromTransactions(cls, transactions: Iterable[Transaction]) -> 'BloomFilter':
+    keys: set[bytes] = set()
+    for txn in transactions:
+      keys.update(cls.key(b'p', product) for product in txn.product_ids)
+      keys.add(cls.key(b'n', txn.sender_id))
+      keys.add(cls.key(b'n', txn.receiver_id))
+    bits = bytearray(max(8, -(-len(keys)*BLOOM_BITS_PER_ENTRY // 8)))
+    for key in keys:
+      for position in cls.positions(key, len(bits)*8):
+        bits[position >> 3] |= 1 << (position & 7)
+    return cls(bytes(bits))
+
+  def mayContain(self, key: bytes) -> bool:
+    bits = self.bits
+    return all(bits[position >> 3] >> (position & 7) & 1 for position in self.positions(key, len(bits)*8))
+
+  def mayHaveProduct(self, product_id: int) -> bool:
+    return self.mayContain(self.key(b'p', product_id))
+
+  def mayHaveNode(self, node_id: int) -> bool:
+    return self.mayContain(self.key(b'n', node_id))
+
+  def __eq__(self, other: object) -> bool:
+    return isinstance(other, BloomFilter) and self.bits == other.bits
+
 # pool of all active nodes
 current_active_nodes: dict[int, Node] = dict()
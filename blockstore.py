@@ -0,0 +1,204 @@
+import os
+import struct
+import zlib
+from collections import OrderedDict
+from typing import Any
+
+"""
+Backing stores for encoded block bodies (see wireformat.py), keyed by header hash
+**Methods**
+  put: store the encoding of a block
+  get: return the encoding of a block (KeyError if it is not stored)
+  pop: remove a block from the store, returning its encoding
+  __contains__: True if a block is stored
+"""
+class BlockStore():
+  def put(self, header_hash: str, data: bytes) -> None:
+    raise NotImplementedError
+
+  def get(self, header_hash: str) -> bytes:
+    raise NotImplementedError
+
+  def pop(self, header_hash: str) -> bytes:
+    raise NotImplementedError
+
+  def __contains__(self, header_hash: str) -> bool:
+    raise NotImplementedError
+
+"""
+Keeps the encoded bodies in memory; compact, but still grows with the chain
+"""
+class MemoryBlockStore(BlockStore):
+  def __init__(self) -> None:
+    self.bodies: dict[str, bytes] = dict()
+
+  def put(self, header_hash: str, data: bytes) -> None:
+    self.bodies[header_hash] = data
+
+  def get(self, header_hash: str) -> bytes:
+    return self.bodies[header_hash]
+
+  def pop(self, header_hash: str) -> bytes:
+    return self.bodies.pop(header_hash)
+
+  def __contains__(self, header_hash: str) -> bool:
+    return header_hash in self.bodies
+
+"""
+Appends the encoded bodies to a file; only the (offset, length) of each body stays in memory. Popped bodies are forgotten but their space in the file is not reclaimed
+**Fields**
+  path: the file holding the bodies
+  offsets: header_hash => (offset, length) of the body in the file
+"""
+class FileBlockStore(BlockStore):
+  def __init__(self, path: str) -> None:
+    self.path = path
+    self.file = open(path, 'w+b')
+    self.offsets: dict[str, tuple[int, int]] = dict()
+
+  def put(self, header_hash: str, data: bytes) -> None:
+    offset = self.file.seek(0, os.SEEK_END)
+    self.file.write(data)
+    self.offsets[header_hash] = (offset, len(data))
+
+  def get(self, header_hash: str) -> bytes:
+    offset, length = self.offsets[header_hash]
+    self.file.seek(offset)
+    return self.file.read(length)
+
+  def pop(self, header_hash: str) -> bytes:
+    data = self.get(header_hash)
+    del self.offsets[header_hash]
+    return data
+
+  def __contains__(self, header_hash: str) -> bool:
+    return header_hash in self.offsets
+
+  def close(self) -> None:
+    self.file.close()
+
+# entry of a segment index: header hash (32 raw bytes), offset and length of the body in the decompressed segment
+INDEX_ENTRY = struct.Struct('<32sII')
+
+"""
+Cold storage for old block bodies: bodies are grouped into segments of segment_blocks bodies, each written to its own zlib compressed file
+with an index file next to it (header hash, offset, length of each body), so an archive reopened on the same directory finds the bodies
+archived before
+**Fields**
+  directory: where the segment files are written
+  segment_blocks: number of bodies per segment
+  pending: bodies of the segment being filled (still in memory), header_hash => encoding
+  locations: header_hash => (segment number, offset, length) of archived bodies inside the decompressed segment
+  segments: number of segments written (including those found in the directory when opened)
+  segment_cache: recently decompressed segments
+**Methods**
+  put: archive a body, writing a segment once enough bodies are collected
+  get: return an archived body, decompressing its segment if needed
+  flush: write the bodies collected so far as a (smaller) segment
+  load: rebuild the locations from the index files of the directory
+"""
+class SegmentArchive():
+  def __init__(self, directory: str, segment_blocks: int = 64, cached_segments: int = 2) -> None:
+    os.makedirs(directory, exist_ok=True)
+    self.directory = directory
+    self.segment_blocks = segment_blocks
+    self.pending: dict[str, bytes] = dict()
+    self.locations: dict[str, tuple[int, int, int]] = dict()
+    self.segments = 0
+    self.segment_cache = LRUCache(cached_segments)
+    self.load()
+
+  def segmentPath(self, segment: int) -> str:
+    return os.path.join(self.directory, 'segment-%06d.z' % segment)
+
+  def indexPath(self, segment: int) -> str:
+    return os.path.join(self.directory, 'segment-%06d.idx' % segment)
+
+  def load(self) -> None:
+    for name in sorted(os.listdir(self.directory)):
+      if not (name.startswith('segment-') and name.endswith('.z')):
+        continue
+      segment = int(name[len('segment-'):-len('.z')])
+      self.segments = max(self.segments, segment + 1)
+      # a segment without its index was not completely written
+      if not os.path.exists(self.indexPath(segment)):
+        continue
+      with open(self.indexPath(segment), 'rb') as f:
+        for raw_hash, offset, length in INDEX_ENTRY.iter_unpack(f.read()):
+          self.locations[raw_hash.hex()] = (segment, offset, length)
+
+  def put(self, header_hash: str, data: bytes) -> None:
+    self.pending[header_hash] = data
+    if len(self.pending) >= self.segment_blocks:
+      self.flush()
+
+  def flush(self) -> None:
+    if not self.pending:
+      return
+    offset = 0
+    index = []
+    for header_hash, data in self.pending.items():
+      self.locations[header_hash] = (self.segments, offset, len(data))
+      index.append(INDEX_ENTRY.pack(bytes.fromhex(header_hash), offset, len(data)))
+      offset += len(data)
+    with open(self.segmentPath(self.segments), 'wb') as f:
+      f.write(zlib.compress(b''.join(self.pending.values())))
+    # the index is written last (and renamed into place), so an index always describes a complete segment
+    with open(self.indexPath(self.segments) + '.tmp', 'wb') as f:
+      f.write(b''.join(index))
+    os.replace(self.indexPath(self.segments) + '.tmp', self.indexPath(self.segments))
+    self.segments += 1
+    self.pending.clear()
+
+  def get(self, header_hash: str) -> bytes:
+    if header_hash in self.pending:
+      return self.pending[header_hash]
+    segment, offset, length = self.locations[header_hash]
+    data = self.segment_cache.get(segment)
+    if data is None:
+      with open(self.segmentPath(segment), 'rb') as f:
+        data = zlib.decompress(f.read())
+      self.segment_cache.put(segment, data)
+    return data[offset:offset + length]
+
+  def __contains__(self, header_hash: str) -> bool:
+    return header_hash in self.pending or header_hash in self.locations
+
+"""
+When to archive block bodies: bodies of blocks more than retention_depth blocks below the newest block are moved from the blockchain's store into the archive
+"""
+class PruningPolicy():
+  def __init__(self, retention_depth: int, archive: SegmentArchive) -> None:
+    self.retention_depth = retention_depth
+    self.archive = archive
+
+"""
+Bounded cache evicting the least recently used entry
+**Fields**
+  maxsize: maximum number of entries
+  entries: key => value, in least to most recently used order
+  hits, misses: lookup counters
+"""
+class LRUCache():
+  def __init__(self, maxsize: int) -> None:
+    self.maxsize = maxsize
+    self.entries: OrderedDict[Any, Any] = OrderedDict()
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, key: Any) -> Any:
+    if key not in self.entries:
+      self.misses += 1
+      return None
+    self.hits += 1
+    self.entries.move_to_end(key)
+    return self.entries[key]
+
+  def put(self, key: Any, value: Any) -> None:
+    self.entries[key] = value
+    self.entries.move_to_end(key)
+    if len(self.entries) > self.maxsize:
+      self.entries.popitem(last=False)
+
+  def discard(self, key: Any) -> None:
+    self.entries.pop(key, None)
@@ -0,0 +1,157 @@
+import argparse
+import csv
+import os
+import sys
+import time
+from array import array
+from collections.abc import Iterator
+import wireformat
+from blockchain import Blockchain
+
+# optional: columns can be returned as NumPy arrays (without copying) if NumPy is installed
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+"""
+Bulk export of the canonical chain for analytics, as columns of 64 bit integers built in chunks straight from the encoded blocks
+(no Block / Transaction objects are created)
+
+Transfer rows (one per product moved by a transaction):
+  height, block_timestamp, miner_id: of the block holding the transaction
+  position: index of the transaction in its block, (height, position) identifies the transaction
+  timestamp, sender_id, receiver_id: of the transaction
+  product_id: the product moved
+Block rows (one per block, genesis excluded):
+  height, timestamp, miner_id, transaction_count
+Timestamps are microseconds since the Unix epoch
+"""
+TRANSFER_COLUMNS = ('height', 'block_timestamp', 'miner_id', 'position', 'timestamp', 'sender_id', 'receiver_id', 'product_id')
+BLOCK_COLUMNS = ('height', 'timestamp', 'miner_id', 'transaction_count')
+# rows per chunk, bounds the memory used by an export
+CHUNK_ROWS = 65536
+
+def newChunk(columns: tuple[str, ...]) -> dict[str, array]:
+  return {column: array('q') for column in columns}
+
+"""
+Views of the canonical blocks with height in [start, end) (end = None => up to the newest block)
+"""
+def blockViews(bc: Blockchain, start: int = 1, end: None | int = None) -> Iterator[wireformat.BlockView]:
+  for header_hash in bc.heights[start:end]:
+    yield wireformat.BlockView(bc.getEncodedBlock(header_hash))
+
+"""
+Transfer rows of the canonical blocks with height in [start, end), as chunks of at most chunk_rows rows (column name => array)
+"""
+def transferChunks(bc: Blockchain, start: int = 1, end: None | int = None, chunk_rows: int = CHUNK_ROWS) -> Iterator[dict[str, array]]:
+  chunk = newChunk(TRANSFER_COLUMNS)
+  height, block_timestamp, miner_id, position, timestamp, sender_id, receiver_id, product_id = chunk.values()
+  for block in blockViews(bc, start, end):
+    for index, txn in enumerate(block.transactions()):
+      products = txn.product_ids
+      count = len(products)
+      height.extend((block.height,)*count)
+      block_timestamp.extend((block.timestamp,)*count)
+      miner_id.extend((block.miner_id,)*count)
+      position.extend((index,)*count)
+      timestamp.extend((txn.timestamp,)*count)
+      sender_id.extend((txn.sender_id,)*count)
+      receiver_id.extend((txn.receiver_id,)*count)
+      product_id.extend(products)
+      if len(product_id) >= chunk_rows:
+        yield chunk
+        chunk = newChunk(TRANSFER_COLUMNS)
+        height, block_timestamp, miner_id, position, timestamp, sender_id, receiver_id, product_id = chunk.values()
+  if len(product_id):
+    yield chunk
+
+"""
+Block rows of the canonical blocks with height in [start, end), as chunks of at most chunk_rows rows (column name => array)
+"""
+def blockChunks(bc: Blockchain, start: int = 1, end: None | int = None, chunk_rows: int = CHUNK_ROWS) -> Iterator[dict[str, array]]:
+  chunk = newChunk(BLOCK_COLUMNS)
+  for block in blockViews(bc, start, end):
+    chunk['height'].append(block.height)
+    chunk['timestamp'].append(block.timestamp)
+    chunk['miner_id'].append(block.miner_id)
+    chunk['transaction_count'].append(block.transaction_count)
+    if len(chunk['height']) >= chunk_rows:
+      yield chunk
+      chunk = newChunk(BLOCK_COLUMNS)
+  if len(chunk['height']):
+    yield chunk
+
+"""
+A chunk as NumPy int64 arrays sharing the chunk's memory
+"""
+def toNumpy(chunk: dict[str, array]) -> dict[str, 'numpy.ndarray']:
+  if numpy is None:
+    raise ImportError("toNumpy needs the numpy package")
+  return {column: numpy.frombuffer(values, dtype=numpy.int64) for column, values in chunk.items()}
+
+"""
+Writes the chunks to a CSV file with a header row, returns the number of rows written
+"""
+def writeCSV(chunks: Iterator[dict[str, array]], columns: tuple[str, ...], path: str) -> int:
+  rows = 0
+  with open(path, 'w', newline='') as f:
+    writer = csv.writer(f)
+    writer.writerow(columns)
+    for chunk in chunks:
+      writer.writerows(zip(*chunk.values()))
+      rows += len(chunk[columns[0]])
+  return rows
+
+"""
+Writes each column to <directory>/<column>.i64 as raw little endian int64 values, returns the number of rows written
+(load with numpy.fromfile(path, dtype='<i8') or loadColumns)
+"""
+def writeColumns(chunks: Iterator[dict[str, array]], columns: tuple[str, ...], directory: str) -> int:
+  os.makedirs(directory, exist_ok=True)
+  files = {column: open(os.path.join(directory, column + '.i64'), 'wb') for column in columns}
+  rows = 0
+  try:
+    for chunk in chunks:
+      for column, values in chunk.items():
+        if values.itemsize != 8:
+          raise ValueError("columns must hold 64 bit integers")
+        if sys.byteorder != 'little':
+          values = array('q', values)
+          values.byteswap()
+        values.tofile(files[column])
+      rows += len(chunk[columns[0]])
+  finally:
+    for f in files.values():
+      f.close()
+  return rows
+
+"""
+Reads the columns written by writeColumns as NumPy arrays (memory mapped, nothing is read until used)
+"""
+def loadColumns(directory: str, columns: tuple[str, ...]) -> dict[str, 'numpy.ndarray']:
+  if numpy is None:
+    raise ImportError("loadColumns needs the numpy package")
+  return {column: numpy.memmap(os.path.join(directory, column + '.i64'), dtype='<i8', mode='r') for column in columns}
+
+if __name__ == '__main__':
+  from simulation import WorkloadDriver
+  parser = argparse.ArgumentParser(description="Builds a chain with the workload driver and exports it")
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--nodes', type=int, default=20)
+  parser.add_argument('--products', type=int, default=1000)
+  parser.add_argument('--steps', type=int, default=5000)
+  parser.add_argument('--csv', help="CSV file to write the transfers to")
+  parser.add_argument('--columns', help="directory to write the transfer columns to")
+  args = parser.parse_args()
+  driver = WorkloadDriver(args.seed, args.nodes, args.products)
+  driver.run(args.steps)
+  bc = driver.bc
+  for name, target, write in (('csv', args.csv, writeCSV), ('columns', args.columns, writeColumns)):
+    if target is None:
+      continue
+    start = time.perf_counter()
+    rows = write(transferChunks(bc), TRANSFER_COLUMNS, target)
+    elapsed = time.perf_counter() - start
+    print("%-8s %d transfer rows from %d blocks in %.3f s (%.0f rows/s)" % (name, rows, len(bc.heights) - 1, elapsed, rows / elapsed if elapsed else 0))
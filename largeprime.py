@@ -0,0 +1,110 @@
+import secrets
+from functools import lru_cache
+
+# small primes used to discard most candidates before running miller-rabin
+SMALL_PRIMES = [p for p in range(3, 1000) if all(p % d for d in range(2, int(p ** 0.5) + 1))]
+GROUP_BITS = 128 # default size of the safe prime p used for ownership proofs
+
+
+def is_probable_prime(n, rounds=32): # miller-rabin primality test
+    if n < 2:
+        return False
+    if n in (2, 3):
+        return True
+    if n % 2 == 0:
+        return False
+    for p in SMALL_PRIMES:
+        if n % p == 0:
+            return n == p
+    d, r = n - 1, 0
+    while d % 2 == 0:
+        d //= 2
+        r += 1
+    for _ in range(rounds):
+        a = secrets.randbelow(n - 3) + 2
+        x = pow(a, d, n)
+        if x == 1 or x == n - 1:
+            continue
+        for _ in range(r - 1):
+            x = pow(x, 2, n)
+            if x == n - 1:
+                break
+        else:
+            return False
+    return True
+
+
+def generate_large_prime(bits): # random safe prime p = 2q + 1 (q prime) with the given number of bits
+    while True:
+        q = secrets.randbits(bits - 1) | (1 << (bits - 2)) | 1
+        p = 2 * q + 1
+        # cheap sieve on both q and p before the expensive tests
+        if any(q % s == 0 or p % s == 0 for s in SMALL_PRIMES):
+            continue
+        if is_probable_prime(q) and is_probable_prime(p):
+            return p
+
+
+def find_generator(p): # generator of the prime order (q = (p-1)/2) subgroup of a safe prime p
+    q = (p - 1) // 2
+    while True:
+        h = secrets.randbelow(p - 3) + 2
+        g = pow(h, 2, p) # squares always lie in the order q subgroup
+        if g != 1 and pow(g, q, p) == 1:
+            return g
+
+
+@lru_cache(maxsize=None)
+def schnorr_group(bits=GROUP_BITS): # (p, q, g) generated once per size and reused for every proof
+    p = generate_large_prime(bits)
+    return p, (p - 1) // 2, find_generator(p)
+
+
+class OwnershipProof(object):
+    """
+    Schnorr proof of knowledge of x for y = g^x mod p
+    y: public value, h: commitment g^r, b: verifier challenge, s: response r + b*x mod q
+    """
+    __slots__ = ('y', 'h', 'b', 's')
+
+    def __init__(self, y, h, b, s):
+        self.y = y
+        self.h = h
+        self.b = b
+        self.s = s
+
+
+def prove(x, group): # prover commits, the verifier's random challenge is simulated, prover responds
+    p, q, g = group
+    y = pow(g, x, p)
+    r = secrets.randbelow(q)
+    h = pow(g, r, p)
+    b = secrets.randbelow(q)
+    s = (r + b * x) % q
+    return OwnershipProof(y, h, b, s)
+
+
+def verify(proof, group): # g^s == h * y^b (mod p)
+    p, q, g = group
+    return pow(g, proof.s, p) == (proof.h * pow(proof.y, proof.b, p)) % p
+
+
+def batch_verify(proofs, group):
+    """
+    Verifies many proofs with one exponentiation of g: every equation is raised to a random
+    weight and all of them are multiplied together, a single invalid proof makes the product fail
+    (except with probability ~1/q). Returns the list of results, falling back to one by one
+    verification only when the combined check fails.
+    """
+    if not proofs:
+        return []
+    p, q, g = group
+    s_total = 0
+    rhs = 1
+    for proof in proofs:
+        w = secrets.randbits(64) | 1
+        s_total += w * proof.s
+        rhs = rhs * pow(proof.h, w, p) * pow(proof.y, (w * proof.b) % q, p) % p
+    if pow(g, s_total % q, p) == rhs:
+        return [True] * len(proofs)
+    return [verify(proof, group) for proof in proofs]
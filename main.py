@@ -1,6 +1,6 @@
 import time
+import csv
 from blockchain import *
-import cv2
 import pprint
 
 def getInt(prompt: str) -> int:
@@ -21,6 +21,14 @@ def getIntArr(prompt: str) -> list[int]:
       print("Input not a space-separeated integer array, please enter again")
   return list(inp)
 
+# nonce of the request to answer, asked only if the sender has several requests pending for the current node (None => the oldest)
+def getNonce(sender_id: int) -> None | int:
+  nonces = sorted(txn.nonce for txn in bc.pending_transactions[bc.parent_node.id].values() if txn.sender_id == sender_id)
+  if len(nonces) < 2:
+    return None
+  print("Requests pending from this sender (nonces):", nonces)
+  return getInt("Enter the nonce of the transaction: ")
+
 print("Creating Blockchain")
 stock = {1, 2, 3}
 print("Initial products with manufacturer:", stock)
@@ -33,38 +41,59 @@ print("Blockchain Created")
 address = 9992
 
 ######  Initializing some data for demo  ######
+# key pairs of the demo nodes, built from fixed primes (RSASigner, 512 bits) instead of being generated: generating them dominated the
+# startup time. Demo only, these private keys are public
+DEMO_PRIMES = {
+  9998: (4800079799160784271158233873868277150152096232971535232361875139639264725654103901,
+         1707240018147598561161774650440443412874147513711029952305007887623530449),
+  9997: (5133023245569876221826057462889405735431049575471033023043073440465395851497363409,
+         1409081173748666708785446626476823678548834076166900562162510574656111993),
+  9996: (7578165555107745894583975476547305718152851774727911435508683574175722363502546241,
+         1126937235795686826961572367992389193209563394833052509908884703146687383),
+  9995: (7244433806982194113810911845714085592656284397323944509799004757569673691719187633,
+         1574844607931437299244750754203257445495147560398845537541705655292309837),
+  9994: (7085919463425176781674431572482640284965808077862088198443406010683032806837184629,
+         1083521934259170502863853816128934428034987782172572400428067134336187423),
+  9993: (5270549435354841401179057664300475509181140530376002406348687181992847383373260909,
+         1406564004569795652295441086460920834700403666632391625335799238372092041),
+}
+
+def demoKeys(id: int) -> tuple[Any, Any]:
+  import rsa
+  p, q = DEMO_PRIMES[id]
+  n, e = p*q, 65537
+  return rsa.PublicKey(n, e), rsa.PrivateKey(n, e, pow(e, -1, (p - 1)*(q - 1)), p, q)
+
 # 7 nodes (including manufacturer) added in advance with some stock
-bc.addNode(9998, 100, 'distributor', {7, 33})
-bc.addNode(9997, 120, 'client', {12, 9})
-bc.addNode(9996, 300, 'distributor', {660,})
-bc.addNode(9995, 800, 'distributor', {80, 90})
-bc.addNode(9994, 50, 'client', {70, 20})
-bc.addNode(9993, 1000, 'client', {30, 40})
+bc.addNodes([{'id': id, 'stake': stake, 'type': type, 'stock': stock, 'keys': demoKeys(id)} for id, stake, type, stock in (
+  (9998, 100, 'distributor', {7, 33}),
+  (9997, 120, 'client', {12, 9}),
+  (9996, 300, 'distributor', {660,}),
+  (9995, 800, 'distributor', {80, 90}),
+  (9994, 50, 'client', {70, 20}),
+  (9993, 1000, 'client', {30, 40}),
+)])
 # 3 accepted transations (1 unverified and 2 in blocks) added in advance
-t1 = Transaction(
-  9999, {9,}, 9998, 9997, current_active_nodes[9998].sign(9^9998^9997)
-)
-t1.receiver_sign = current_active_nodes[9997].sign(9^9998^9997)
-t2 = Transaction(
-  9999, {90,}, 9996, 9995, current_active_nodes[9996].sign(90^9996^9995)
-)
-t2.receiver_sign = current_active_nodes[9995].sign(90^9996^9995)
-t3 = Transaction(
-  9999, {70, 20}, 9994, 9993, current_active_nodes[9994].sign(70^20^9994^9993)
-)
-t3.receiver_sign = current_active_nodes[9993].sign(70^20^9994^9993)
+t1 = Transaction(9999, {9,}, 9998, 9997)
+t1.sender_sign = current_active_nodes[9998].sign(t1.transaction_id)
+t1.receiver_sign = current_active_nodes[9997].sign(t1.transaction_id)
+t2 = Transaction(9999, {90,}, 9996, 9995)
+t2.sender_sign = current_active_nodes[9996].sign(t2.transaction_id)
+t2.receiver_sign = current_active_nodes[9995].sign(t2.transaction_id)
+t3 = Transaction(9999, {70, 20}, 9994, 9993)
+t3.sender_sign = current_active_nodes[9994].sign(t3.transaction_id)
+t3.receiver_sign = current_active_nodes[9993].sign(t3.transaction_id)
 # two blocks (1 transaction each) added in advance
 b1 = Block(bc.newest_block, 1, [t1, ], 9999)
-bc.blockchain[b1.header_hash] = b1
+bc.addBlock(b1)
 b2 = Block(b1.header_hash, 2, [t2, ], 9998)
-bc.blockchain[b2.header_hash] = b2
-bc.newest_block = b2.header_hash
+bc.addBlock(b2)
 # changing state of blockchain to show the last unverified transaction
 bc.accepted_transactions.append(t3)
-bc.blocked_nodes.add(9994)
-bc.blocked_nodes.add(9993)
+bc.trackTransaction(t3)
 
-wait = 3
+# the countdown runs from wait down to 0, no countdown before the first menu
+wait = -1
 # Main thread loop
 while(True):
   for i in range(wait, -1, -1):
@@ -73,17 +102,14 @@ while(True):
   print('-'*100, end = '\n\n')
 
   print("Current Node: ", bc.parent_node.type.name, bc.parent_node.id)
-  # A Transaction can only be started or accepted if a node is unblocked
-  b = 'BLOCKED' if bc.parent_node.id in bc.blocked_nodes else 'UNBLOCKED'
-  print("Transaction Status: ", b)
-  if b == 'BLOCKED':
-    t = 'Transaction Accepted: Waiting for Validation (Mining)'
-    
-    for rid in bc.pending_transactions:
-      for txn in bc.pending_transactions[rid]:
-        if txn.sender_id == bc.parent_node.id:
-          t = 'Transaction Request Sent: Waiting for Receiver id: ' + str(txn.receiver_id) + '\'s Response'
-    print(t)
+  # transactions started by the node and not mined yet, their products are reserved
+  in_flight = sorted(bc.in_flight[bc.parent_node.id].values(), key=lambda txn: txn.nonce)
+  print("Transactions in flight: ", len(in_flight))
+  for txn in in_flight:
+    if txn.transaction_id in bc.request_deadlines:
+      print(" Nonce", txn.nonce, ': Transaction Request Sent: Waiting for Receiver id: ' + str(txn.receiver_id) + '\'s Response')
+    else:
+      print(" Nonce", txn.nonce, ': Transaction Accepted: Waiting for Validation (Mining)')
   print("::::::::Option Menu::::::::")
   print("To Add Node: 1")
   print("Change Current Node: 2")
@@ -99,6 +125,8 @@ while(True):
   if bc.parent_node.id == bc.manufacturer_id:
     print("Add product to Blockchain (Manufacturer's stock): 12")
   print("Delete Started Transaction: 13")
+  print("Find a Transaction by id: 14")
+  print("Register Nodes from a CSV File: 15")
   selection = getInt("Chooose an Operation to Perform: ")
   print()
   if   selection == 1:
@@ -138,6 +166,9 @@ while(True):
       print("id not Found on the Network, Stopping")
       continue
     print("Your current stock:", bc.parent_node.stock)
+    reserved = bc.parent_node.stock.intersection(bc.reserved)
+    if reserved:
+      print("Reserved by your transactions in flight:", reserved)
     product_ids = set(getIntArr("Enter Space Separated Product-ids to send, enter nothing or invalid id to stop (repeated ids will be considered only once): "))
     if not product_ids: continue
     if product_ids.difference(bc.parent_node.stock):
@@ -150,6 +181,8 @@ while(True):
     product_id = getInt("Enter the product id: ")
     file_name = bc.getProductStatus(product_id)
     print("Press any key to close qr code window and continue execution::")
+    # OpenCV is slow to import and only needed here, load it on first use
+    import cv2
     # Read qr_code
     img = cv2.imread(file_name)
     
@@ -187,12 +220,12 @@ while(True):
   
   elif selection == 9:
     sender_id = getInt("Enter the id of the sender of the transaction: ")
-    bc.acceptTransactionRequest(sender_id)
+    bc.acceptTransactionRequest(sender_id, getNonce(sender_id))
     wait = 3
   
   elif selection == 10:
     sender_id = getInt("Enter the id of the sender of the transaction: ")
-    bc.rejectTransactionRequest(sender_id)
+    bc.rejectTransactionRequest(sender_id, getNonce(sender_id))
     wait = 1
 
   elif selection == 11:
@@ -210,9 +243,41 @@ while(True):
     wait = 1
   
   elif selection == 13:
-    bc.deleteTransactionRequest()
+    pending = sorted(txn.nonce for txn in bc.in_flight[bc.parent_node.id].values() if txn.transaction_id in bc.request_deadlines)
+    nonce = None
+    if len(pending) > 1:
+      print("Pending requests (nonces):", pending)
+      nonce = getInt("Enter the nonce of the transaction to delete: ")
+    bc.deleteTransactionRequest(nonce)
     wait = 1
 
+  elif selection == 14:
+    transaction_id = input("Enter the Transaction id: ").strip()
+    txn = bc.getTransaction(transaction_id)
+    if txn is None:
+      print("No committed transaction with id", transaction_id)
+    else:
+      print("Found in block at height", bc.transaction_index[transaction_id][0])
+      print("Started at", formatTimestamp(txn.timestamp))
+      print(txn)
+    wait = 3
+
+  elif selection == 15:
+    file_name = input("Enter the CSV file name (one node per row: type (client or distributor), stake, space separated product-ids): ").strip()
+    try:
+      with open(file_name, newline='') as f:
+        rows = [row for row in csv.reader(f) if row]
+      specs = [{'id': address - i, 'type': row[0].strip(), 'stake': int(row[1]), 'stock': [int(p) for p in row[2].split()] if len(row) > 2 else []} for i, row in enumerate(rows)]
+    except (OSError, ValueError, IndexError) as e:
+      print("Could not read the file:", e)
+      continue
+    address -= len(specs)
+    results = bc.addNodes(specs)
+    for result in results:
+      print("Node", result['id'], "registered" if result['registered'] else "rejected: " + result['error'])
+    print(sum(result['registered'] for result in results), "of", len(results), "nodes registered")
+    wait = 3
+
   else:
     print("Incorrect input; please choose again")
     wait = 2
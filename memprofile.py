@@ -0,0 +1,159 @@
+import argparse
+import gc
+import multiprocessing
+import sys
+import tracemalloc
+from collections.abc import Callable
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any
+from blockchain import Blockchain, Block, MerkleTree, Node, NodeType, Transaction, current_active_nodes
+import signers
+from signers import SIGNERS, DEFAULT_SIGNER
+from simulation import WorkloadDriver, quiet
+
+# default budgets: retained bytes per object, exceeding one makes the profiler exit with status 1
+BUDGETS = {
+  'transaction': 1200,
+  'block': 2200,
+  'merkle_tree': 1700,
+  'node': 1700,
+  'product': 250,
+  'chain_per_block': 7000,
+  'chain_per_transaction': 3500,
+}
+# number of objects built for each per-object measurement
+SAMPLE = 2000
+# workload steps a chain is grown by before it is measured (about 160 blocks): one-time costs (lazy imports, first use) and the bounded
+# structures (body cache, undo journals of the last REORG_DEPTH blocks) are paid before the measurement, which then sees the steady growth
+WARMUP_STEPS = 1500
+
+"""
+Retained memory (bytes) of whatever build() returns, measured with tracemalloc after a garbage collection; the result is kept alive until measured
+"""
+def retained(build: Callable[[], Any]) -> tuple[int, Any]:
+  gc.collect()
+  before = tracemalloc.get_traced_memory()[0]
+  result = build()
+  gc.collect()
+  return tracemalloc.get_traced_memory()[0] - before, result
+
+"""
+Clears the state shared by the whole process (registered nodes, cached signature verifications), so that a measurement neither counts
+what an earlier one left behind nor gets credited for it being evicted
+"""
+def resetGlobals() -> None:
+  current_active_nodes.clear()
+  signers.verification_cache.clear()
+  gc.collect()
+
+def newChain() -> Blockchain:
+  resetGlobals()
+  return Blockchain(Node(100000000, 9999, set(), NodeType.MANUFACTURER, DEFAULT_SIGNER))
+
+"""
+Bytes retained per object of each type, built through the public constructors and the Blockchain API; key pairs are generated on a
+node's first signature, so the node figure excludes them
+"""
+def perObject(sample: int = SAMPLE) -> dict[str, float]:
+  costs: dict[str, float] = dict()
+  with quiet():
+    size, txns = retained(lambda: [Transaction(9999, {i}, 9998, 9997) for i in range(sample)])
+    costs['transaction'] = size / sample
+    size, _ = retained(lambda: [MerkleTree(txns[i:i + 2]) for i in range(0, sample, 2)])
+    costs['merkle_tree'] = size / (sample // 2)
+    size, _ = retained(lambda: [Block('00'*32, 1, txns[i:i + 2], 9999) for i in range(0, sample, 2)])
+    # the transactions already exist, only the block itself (with its merkle tree) is counted
+    costs['block'] = size / (sample // 2)
+    bc = newChain()
+    size, _ = retained(lambda: bc.addNodes([{'id': i, 'stake': 10, 'type': 'client', 'stock': ()} for i in range(sample)]))
+    # without key pairs, the nodes never sign anything here
+    costs['node'] = size / sample
+    size, _ = retained(lambda: bc.addNodes([{'id': sample + i, 'stake': 10, 'type': 'client', 'stock': range(i*100, (i + 1)*100)} for i in range(sample // 100)]))
+    # nodes with 100 products each, minus the cost of the nodes themselves
+    costs['product'] = (size - costs['node'] * (sample // 100)) / sample
+  resetGlobals()
+  return costs
+
+"""
+Retained memory added by growing a chain by the given number of steps with the workload driver, after WARMUP_STEPS steps of warm-up;
+meant to run in a fresh process. The verification cache is left out, it is bounded
+returns: (steps, blocks, transactions, bytes) added after the warm-up and the top allocation sites of the growth
+"""
+def measureChain(steps: int, nodes: int, products: int, seed: int, signer_name: str) -> tuple[tuple[int, int, int, int], list[str]]:
+  resetGlobals()
+  # traced from the start, so that evicting what the warm-up cached is subtracted from the growth
+  tracemalloc.start()
+  with quiet():
+    driver = WorkloadDriver(seed, nodes, products, signer=SIGNERS[signer_name]())
+    driver.run(WARMUP_STEPS)
+    blocks, transactions = driver.blocks, driver.transactions
+    signers.verification_cache.clear()
+    before = tracemalloc.take_snapshot()
+    grown, _ = retained(lambda: (driver.run(steps), signers.verification_cache.clear()))
+  # the baseline snapshot itself is allocated during the growth
+  own = [tracemalloc.Filter(False, tracemalloc.__file__)]
+  sites = [str(stat) for stat in tracemalloc.take_snapshot().filter_traces(own).compare_to(before.filter_traces(own), 'lineno')[:5]]
+  tracemalloc.stop()
+  return (steps, driver.blocks - blocks, driver.transactions - transactions, grown), sites
+
+"""
+Retained memory of chains grown by the workload driver by each number of steps after the warm-up; the marginal cost per block /
+transaction between the smallest and largest growth excludes the fixed cost of the nodes and products
+Each chain is grown in its own fresh process: state shared by a process (registered nodes, the verification cache, one-time allocations
+of the first run) would otherwise be counted in one size and freed, hence subtracted, in the next
+returns: (steps, blocks, transactions, bytes) for each size, the marginal costs, and the top allocation sites of the largest chain
+"""
+def chainGrowth(sizes: list[int], nodes: int, products: int, seed: int, signer_name: str) -> tuple[list[tuple[int, int, int, int]], dict[str, float], list[str]]:
+  rows = []
+  sites: list[str] = []
+  for steps in sizes:
+    with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+      row, sites = executor.submit(measureChain, steps, nodes, products, seed, signer_name).result()
+    rows.append(row)
+  (_, blocks0, txns0, bytes0), (_, blocks1, txns1, bytes1) = rows[0], rows[-1]
+  marginal = {
+    'chain_per_block': (bytes1 - bytes0) / (blocks1 - blocks0) if blocks1 > blocks0 else 0.0,
+    'chain_per_transaction': (bytes1 - bytes0) / (txns1 - txns0) if txns1 > txns0 else 0.0,
+  }
+  return rows, marginal, sites
+
+def parseBudget(text: str) -> tuple[str, int]:
+  name, _, value = text.partition('=')
+  if name not in BUDGETS or not value.isdigit():
+    raise argparse.ArgumentTypeError("expected one of " + ', '.join(BUDGETS) + " as name=bytes")
+  return name, int(value)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Measures retained memory per object type and per block as the chain grows, and checks it against budgets")
+  parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 2000, 4000], help="workload steps of the chains to grow")
+  parser.add_argument('--nodes', type=int, default=20)
+  parser.add_argument('--products', type=int, default=1000)
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--signer', choices=SIGNERS, default=DEFAULT_SIGNER.name)
+  parser.add_argument('--budget', type=parseBudget, action='append', default=[], help="override a budget, e.g. --budget block=4000")
+  args = parser.parse_args()
+  if len(args.sizes) < 2:
+    parser.error("at least two sizes are needed for the marginal costs")
+  budgets = dict(BUDGETS, **dict(args.budget))
+
+  tracemalloc.start()
+  costs = perObject()
+  tracemalloc.stop()
+  rows, marginal, sites = chainGrowth(sorted(args.sizes), args.nodes, args.products, args.seed, args.signer)
+  costs.update(marginal)
+
+  print("%8s %8s %12s %14s" % ('steps', 'blocks', 'transactions', 'retained bytes'))
+  for steps, blocks, txns, size in rows:
+    print("%8d %8d %12d %14d" % (steps, blocks, txns, size))
+  print("\nLargest allocation sites of the largest chain:")
+  for site in sites:
+    print(" ", site)
+  print()
+  failed = False
+  for name, cost in costs.items():
+    # a larger chain can't retain less than a smaller one, a non-positive marginal cost means the measurement is broken
+    invalid = name in marginal and cost <= 0
+    over = cost > budgets[name]
+    failed |= over or invalid
+    print("%-22s %10.1f bytes  (budget %d)  %s" % (name, cost, budgets[name], 'INVALID' if invalid else 'OVER BUDGET' if over else 'ok'))
+  sys.exit(1 if failed else 0)
@@ -0,0 +1,403 @@
+import argparse
+import heapq
+import math
+import random
+import time
+from collections.abc import Callable, Iterable
+from typing import Any, TypedDict
+from blockchain import Blockchain, Node, NodeType, Transaction, current_active_nodes, MAX_IN_FLIGHT, MAX_TRANSACSIZE
+from signers import Signer, SIGNERS, DEFAULT_SIGNER
+from simulation import MANUFACTURER_ID, quiet
+
+"""
+Discrete-event simulation of the supply chain network on a virtual clock: the Blockchain API is driven by timed events (transaction requests,
+answers, mining rounds) and every message between nodes is delayed by the link it crosses, so finality and propagation are measured in
+seconds of simulated time, independently of the speed of the machine running the simulation
+
+A mining round:
+  election: every node sends its vote to the delegates, then the winner is announced to the validators
+  production: the miner waits for the accepted transactions it packs to reach it, then verifies them
+  validation: the block is sent to both validators, they verify it and send back their confirmation; the block is final with both confirmations
+  propagation: the final block is flooded over the peer overlay, every node verifies it before relaying it
+The next round starts one block interval after the previous one, but never before the previous block is final; a round also starts when
+accepting a transaction fills a block (acceptTransactionRequest mines), so an answer that would fill a block is only applied once the previous
+block is final
+"""
+
+"""
+Parameters of a simulation
+**Fields**
+  latency: mean one-way latency of a link (seconds), each link gets a latency within 50% of it
+  jitter: relative variation of the latency of each message
+  bandwidth: bandwidth of a link (bytes per second)
+  loss: probability that a message is lost, a lost message is sent again after the retransmission timeout
+  retransmit: retransmission timeout (seconds)
+  peers: number of peers each node relays blocks to
+  tx_rate: transaction requests started per second (Poisson arrivals)
+  response_time: mean time a receiver takes to answer a request (seconds)
+  accept_rate: share of requests the receivers accept
+  request_timeout: time after which a sender withdraws a request that is still unanswered (seconds)
+  block_interval: time between the start of two mining rounds (seconds)
+  verify_time: time to verify one transaction (signatures and stock, seconds)
+  block_overhead: fixed time to verify a block (merkle tree, bloom filter, header hash; seconds)
+  window: length of the windows the throughput distribution is measured over (seconds)
+"""
+class SimulationConfig(TypedDict):
+  latency: float
+  jitter: float
+  bandwidth: float
+  loss: float
+  retransmit: float
+  peers: int
+  tx_rate: float
+  response_time: float
+  accept_rate: float
+  request_timeout: float
+  block_interval: float
+  verify_time: float
+  block_overhead: float
+  window: float
+
+DEFAULT_CONFIG: SimulationConfig = {
+  'latency': 0.05,
+  'jitter': 0.1,
+  'bandwidth': 1250000.0,
+  'loss': 0.0,
+  'retransmit': 1.0,
+  'peers': 4,
+  'tx_rate': 2.0,
+  'response_time': 5.0,
+  'accept_rate': 0.8,
+  'request_timeout': 30.0,
+  'block_interval': 10.0,
+  'verify_time': 0.0005,
+  'block_overhead': 0.002,
+  'window': 60.0,
+}
+# size of a vote, an election announcement or a block confirmation (ids and a signature), in bytes
+VOTE_SIZE = 160
+
+"""
+Report returned by a simulation run; distributions are nearest-rank percentiles (50, 90, 99) in seconds of simulated time
+**Fields**
+  duration: simulated time (seconds)
+  elapsed: wall time of the run (seconds)
+  speedup: simulated seconds per wall second
+  events: number of events processed
+  blocks, transactions: blocks and transactions made final
+  tps: final transactions per simulated second
+  throughput: distribution of the transactions made final per second, over windows of the configured length
+  finality: distribution of the time from starting a transaction to its block being final
+  election: distribution of the duration of the elections
+  propagation: distribution of the time for a final block to reach every node
+"""
+class SimulationReport(TypedDict):
+  duration: float
+  elapsed: float
+  speedup: float
+  events: int
+  blocks: int
+  transactions: int
+  tps: float
+  throughput: dict[int, float]
+  finality: dict[int, float]
+  election: dict[int, float]
+  propagation: dict[int, float]
+
+def percentiles(values: Iterable[float], points: tuple[int, ...] = (50, 90, 99)) -> dict[int, float]:
+  ordered = sorted(values)
+  if not ordered:
+    return dict.fromkeys(points, 0.0)
+  return {point: ordered[max(math.ceil(point / 100 * len(ordered)) - 1, 0)] for point in points}
+
+"""
+A link between two nodes
+**Fields**
+  latency: one-way latency (seconds)
+  bandwidth: bytes per second
+  loss: probability of losing a message
+"""
+class LinkProfile(TypedDict):
+  latency: float
+  bandwidth: float
+  loss: float
+
+"""
+Links between nodes and the peer overlay blocks are flooded on; any two nodes can exchange messages directly
+**Fields**
+  links: (lower id, higher id) => profile of the link, drawn when first used unless set with setLink (links are symmetric)
+  peers: node id => ids of its peers in the overlay (a ring plus random peers, so the overlay is connected)
+**Methods**
+  setLink: set the profile of a link
+  delay: time for a message of the given size to cross a link
+  flood: arrival time at every node of a message flooded from a node, each node processing it before relaying it
+"""
+class Network():
+  def __init__(self, node_ids: Iterable[int], rng: random.Random, config: SimulationConfig = DEFAULT_CONFIG) -> None:
+    self.rng = rng
+    self.config = config
+    self.links: dict[tuple[int, int], LinkProfile] = dict()
+    ids = sorted(node_ids)
+    self.peers: dict[int, set[int]] = {id: set() for id in ids}
+    for i, id in enumerate(ids):
+      others = ids[:i] + ids[i + 1:]
+      for peer in [ids[(i + 1) % len(ids)]] + rng.sample(others, min(config['peers'], len(others))):
+        if peer != id:
+          self.peers[id].add(peer)
+          self.peers[peer].add(id)
+
+  def link(self, a: int, b: int) -> LinkProfile:
+    key = (a, b) if a < b else (b, a)
+    profile = self.links.get(key)
+    if profile is None:
+      profile = {'latency': self.config['latency'] * self.rng.uniform(0.5, 1.5), 'bandwidth': self.config['bandwidth'], 'loss': self.config['loss']}
+      self.links[key] = profile
+    return profile
+
+  def setLink(self, a: int, b: int, latency: float, bandwidth: float, loss: float = 0.0) -> None:
+    self.links[(a, b) if a < b else (b, a)] = {'latency': latency, 'bandwidth': bandwidth, 'loss': loss}
+
+  def delay(self, a: int, b: int, size: int) -> float:
+    if a == b:
+      return 0.0
+    profile = self.link(a, b)
+    jitter = self.config['jitter']
+    delay = profile['latency'] * self.rng.uniform(1 - jitter, 1 + jitter) + size / profile['bandwidth']
+    while self.rng.random() < profile['loss']:
+      delay += self.config['retransmit']
+    return delay
+
+  def flood(self, source: int, size: int, processing: float = 0.0) -> dict[int, float]:
+    # shortest arrival times over the overlay (Dijkstra), a node relays a message once, after processing it
+    arrival = {source: 0.0}
+    queue = [(0.0, source)]
+    done: set[int] = set()
+    while queue:
+      at, id = heapq.heappop(queue)
+      if id in done:
+        continue
+      done.add(id)
+      sent = at + (processing if id != source else 0.0)
+      for peer in self.peers[id]:
+        if peer in done:
+          continue
+        reached = sent + self.delay(id, peer, size)
+        if reached < arrival.get(peer, math.inf):
+          arrival[peer] = reached
+          heapq.heappush(queue, (reached, peer))
+    return arrival
+
+"""
+Runs a blockchain on a virtual clock: events are processed in time order and the clock jumps from one event to the next, the same seed and
+parameters always produce the same run
+**Fields**
+  now: the virtual time (seconds), also the clock of the blockchain (request expiry)
+  events: heap of (time, sequence number, action, arguments)
+  bc: the blockchain under simulation
+  network: links and overlay between its nodes
+  started, accepted: transaction_id => time the transaction was started | accepted, until it is final or dropped
+  deferred: accepted transactions waiting for the previous block to be final before being applied to the chain
+  finality, elections, propagation: samples of the report distributions
+  commits: (time, number of transactions) of every final block
+  final_at: time the newest block is final
+**Methods**
+  schedule: run an action after a delay
+  run: process the events of the given simulated time, returns the report of the whole simulation so far
+  arrival, respond, accept, withdraw, slot, finalize: event actions (a transaction request, the receiver's answer, its acceptance on the chain,
+    the sender's timeout, a mining round, a block becoming final)
+  mined: time a mining round that just ran on the chain
+"""
+class NetworkSimulator():
+  def __init__(self, seed: int, node_count: int, product_count: int, config: SimulationConfig = DEFAULT_CONFIG, signer: Signer = DEFAULT_SIGNER) -> None:
+    if node_count < 4:
+      raise ValueError("the voting round needs at least 4 nodes")
+    random.seed(seed)
+    self.rng = random.Random(seed)
+    self.config = config
+    self.now = 0.0
+    self.events: list[tuple[float, int, Callable[..., None], tuple]] = []
+    self.sequence = 0
+    self.processed = 0
+    self.elapsed = 0.0
+    stocks: list[set[int]] = [set() for _ in range(node_count)]
+    for product in range(1, product_count + 1):
+      stocks[self.rng.randrange(node_count)].add(product)
+    current_active_nodes.clear()
+    with quiet():
+      self.bc = Blockchain(Node(100000000, MANUFACTURER_ID, stocks[0], NodeType.MANUFACTURER, signer), clock=self.clock)
+      self.bc.addNodes([{'id': MANUFACTURER_ID - i, 'stake': self.rng.randint(50, 1000), 'type': self.rng.choice(('client', 'distributor')), 'stock': stocks[i]}
+                        for i in range(1, node_count)])
+    self.network = Network(self.bc.nodes, self.rng, config)
+    self.started: dict[str, float] = dict()
+    self.accepted: dict[str, float] = dict()
+    self.deferred: set[str] = set()
+    self.finality: list[float] = []
+    self.elections: list[float] = []
+    self.propagation: list[float] = []
+    self.commits: list[tuple[float, int]] = []
+    self.final_at = 0.0
+    self.schedule(self.rng.expovariate(config['tx_rate']), self.arrival)
+    self.schedule(config['block_interval'], self.slot)
+
+  def clock(self) -> float:
+    return self.now
+
+  def schedule(self, delay: float, action: Callable[..., None], *args: Any) -> None:
+    heapq.heappush(self.events, (self.now + delay, self.sequence, action, args))
+    self.sequence += 1
+
+  def run(self, duration: float) -> SimulationReport:
+    end = self.now + duration
+    begin = time.perf_counter()
+    with quiet():
+      while self.events and self.events[0][0] <= end:
+        self.now, _, action, args = heapq.heappop(self.events)
+        action(*args)
+        self.processed += 1
+    self.now = end
+    self.elapsed += time.perf_counter() - begin
+    return self.report()
+
+  def report(self) -> SimulationReport:
+    window = self.config['window']
+    windows = [0] * max(int(self.now // window), 1)
+    for at, count in self.commits:
+      windows[min(int(at // window), len(windows) - 1)] += count
+    transactions = sum(count for _, count in self.commits)
+    return {
+      'duration': self.now,
+      'elapsed': self.elapsed,
+      'speedup': self.now / self.elapsed if self.elapsed else 0.0,
+      'events': self.processed,
+      'blocks': len(self.commits),
+      'transactions': transactions,
+      'tps': transactions / self.now if self.now else 0.0,
+      'throughput': percentiles(count / window for count in windows),
+      'finality': percentiles(self.finality),
+      'election': percentiles(self.elections),
+      'propagation': percentiles(self.propagation),
+    }
+
+  def forget(self, transaction_id: str) -> None:
+    self.started.pop(transaction_id, None)
+    self.accepted.pop(transaction_id, None)
+
+  def arrival(self) -> None:
+    self.schedule(self.rng.expovariate(self.config['tx_rate']), self.arrival)
+    reserved = self.bc.reserved
+    available = {id: [product for product in sorted(node.stock) if product not in reserved]
+                 for id, node in current_active_nodes.items() if len(self.bc.in_flight[id]) < MAX_IN_FLIGHT}
+    senders = sorted(id for id, stock in available.items() if stock)
+    if not senders:
+      return
+    sender = self.rng.choice(senders)
+    receiver = self.rng.choice(sorted(id for id in current_active_nodes if id != sender))
+    stock = available[sender]
+    products = set(self.rng.sample(stock, self.rng.randint(1, min(3, len(stock)))))
+    pending = len(self.bc.pending_transactions[receiver])
+    self.bc.changeParentNode(sender)
+    self.bc.startTransaction(receiver, products)
+    if len(self.bc.pending_transactions[receiver]) == pending:
+      return
+    txn = next(reversed(self.bc.pending_transactions[receiver].values()))
+    self.started[txn.transaction_id] = self.now
+    self.schedule(self.network.delay(sender, receiver, len(txn.encode())) + self.rng.expovariate(1 / self.config['response_time']), self.respond, txn)
+    self.schedule(self.config['request_timeout'], self.withdraw, txn)
+
+  def respond(self, txn: Transaction) -> None:
+    # the request may have expired meanwhile
+    if txn.transaction_id not in self.bc.pending_transactions[txn.receiver_id]:
+      return self.forget(txn.transaction_id)
+    self.bc.changeParentNode(txn.receiver_id)
+    if self.rng.random() >= self.config['accept_rate']:
+      self.bc.rejectTransactionRequest(txn.sender_id, txn.nonce)
+      return self.forget(txn.transaction_id)
+    self.accepted[txn.transaction_id] = self.now
+    self.accept(txn)
+
+  def accept(self, txn: Transaction) -> None:
+    self.deferred.discard(txn.transaction_id)
+    if txn.transaction_id not in self.bc.pending_transactions[txn.receiver_id]:
+      return self.forget(txn.transaction_id)
+    # accepting it fills a block: the round it starts can't start before the previous block is final either
+    if self.now < self.final_at and len(self.bc.accepted_transactions) + 1 >= MAX_TRANSACSIZE:
+      self.deferred.add(txn.transaction_id)
+      return self.schedule(self.final_at - self.now, self.accept, txn)
+    self.bc.changeParentNode(txn.receiver_id)
+    election = self.bc.last_election
+    tip = self.bc.newest_block
+    self.bc.acceptTransactionRequest(txn.sender_id, txn.nonce)
+    if self.bc.last_election is not election:
+      self.mined(tip)
+
+  def withdraw(self, txn: Transaction) -> None:
+    if txn.transaction_id not in self.bc.pending_transactions[txn.receiver_id]:
+      return
+    self.bc.changeParentNode(txn.sender_id)
+    self.bc.deleteTransactionRequest(txn.nonce)
+    self.forget(txn.transaction_id)
+
+  def slot(self) -> None:
+    # a round can't start before the previous block is final
+    if self.now < self.final_at:
+      return self.schedule(self.final_at - self.now, self.slot)
+    tip = self.bc.newest_block
+    self.bc.mineBlock()
+    self.mined(tip)
+    self.schedule(self.config['block_interval'], self.slot)
+
+  def mined(self, tip: str) -> None:
+    config = self.config
+    miner, *validators = self.bc.last_election
+    # votes reach the delegates, then the result reaches the validators
+    election = max(self.network.delay(id, miner, VOTE_SIZE) for id in self.bc.nodes) + max(self.network.delay(miner, id, VOTE_SIZE) for id in validators)
+    self.elections.append(election)
+    waiting = {txn.transaction_id for txn in self.bc.accepted_transactions} | self.deferred
+    if self.bc.newest_block == tip:
+      for transaction_id in [key for key in self.accepted if key not in waiting]:
+        self.forget(transaction_id)
+      return
+    block = self.bc.getBlock(self.bc.newest_block)
+    mined = {txn.transaction_id for txn in block.transactions}
+    # transactions dropped as invalid are never final
+    for transaction_id in [key for key in self.accepted if key not in waiting and key not in mined]:
+      self.forget(transaction_id)
+    # the miner packs transactions once they have reached it
+    ready = election
+    for txn in block.transactions:
+      if txn.transaction_id in self.accepted:
+        ready = max(ready, self.accepted[txn.transaction_id] - self.now + self.network.delay(txn.receiver_id, miner, len(txn.encode())))
+    verify = config['block_overhead'] + config['verify_time'] * len(block.transactions)
+    size = len(self.bc.getEncodedBlock(block.header_hash))
+    produced = ready + verify
+    final = max(produced + self.network.delay(miner, id, size) + verify + self.network.delay(id, miner, VOTE_SIZE) for id in validators)
+    self.final_at = max(self.final_at, self.now + final)
+    self.schedule(final, self.finalize, block.header_hash, miner, size, verify)
+
+  def finalize(self, header_hash: str, miner: int, size: int, verify: float) -> None:
+    transactions = self.bc.getBlock(header_hash).transactions
+    for txn in transactions:
+      if txn.transaction_id in self.started:
+        self.finality.append(self.now - self.started[txn.transaction_id])
+      self.forget(txn.transaction_id)
+    self.commits.append((self.now, len(transactions)))
+    self.propagation.append(max(self.network.flood(miner, size, verify).values()))
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Simulates the network on a virtual clock and reports finality, throughput and propagation in simulated seconds")
+  parser.add_argument('--seed', default=0, type=int, help='seed for all random choices')
+  parser.add_argument('--nodes', default=20, type=int, help='number of nodes, including the manufacturer (at least 4)')
+  parser.add_argument('--products', default=1000, type=int, help='number of products initially spread among the nodes')
+  parser.add_argument('--duration', default=3600.0, type=float, help='simulated seconds')
+  parser.add_argument('--signer', default=DEFAULT_SIGNER.name, choices=SIGNERS, help='signature scheme of the chain')
+  for key, value in DEFAULT_CONFIG.items():
+    parser.add_argument('--' + key.replace('_', '-'), default=value, type=type(value), help='default %(default)s')
+  args = parser.parse_args()
+  config: SimulationConfig = {key: getattr(args, key) for key in DEFAULT_CONFIG}  # type: ignore[assignment]
+  simulator = NetworkSimulator(args.seed, args.nodes, args.products, config, SIGNERS[args.signer]())
+  report = simulator.run(args.duration)
+  print("Simulated %.0f s in %.3f s of wall time (%.0fx), %d events" % (report['duration'], report['elapsed'], report['speedup'], report['events']))
+  print("Blocks final: %d, transactions final: %d (%.3f transactions/s)" % (report['blocks'], report['transactions'], report['tps']))
+  for name in ('throughput', 'finality', 'election', 'propagation'):
+    unit = 'transactions/s' if name == 'throughput' else 's'
+    print("%-12s " % name + "  ".join("p%d %.3f" % (point, value) for point, value in report[name].items()) + " " + unit)
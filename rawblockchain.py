@@ -1,16 +1,98 @@
 from audioop import add
 import errno
 import hashlib
+from bisect import bisect_left, insort
+from collections import defaultdict, deque
+from contextlib import contextmanager
+import threading
 import json
+import time
 from typing import List
-from datetime import datetime as dt
 from urllib.parse import urlparse
 import requests
 from random import randint
-# from largeprime import toret, find_generator, generate_large_prime
+from largeprime import schnorr_group, prove, batch_verify
 
 # from blockchain.main import delegates
 
+PAGE_SIZE = 20 # default number of transactions returned per page by the history endpoints
+EVENT_LOG_SIZE = 10000 # number of past events kept for subscribers resuming from a cursor
+
+
+class RWLock(object): # many concurrent readers or one writer; waiting writers go first so readers can't starve them
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.readers = 0  # readers holding the lock
+        self.writing = False
+        self.waiting_writers = 0
+
+    @contextmanager
+    def read(self):
+        with self.cond:
+            while self.writing or self.waiting_writers:
+                self.cond.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.readers -= 1
+                if not self.readers:
+                    self.cond.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self.cond:
+            self.waiting_writers += 1
+            while self.writing or self.readers:
+                self.cond.wait()
+            self.waiting_writers -= 1
+            self.writing = True
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.writing = False
+                self.cond.notify_all()
+
+
+class EventLog(object): # bounded log of chain events (new blocks, delegate elections, ownership changes) pushed to subscribers
+    def __init__(self, size=EVENT_LOG_SIZE):
+        self.events = deque(maxlen=size)  # most recent events, each with its index (the resume cursor)
+        self.next_index = 0  # index of the next published event
+        self.changed = threading.Condition()  # notified whenever an event is published
+
+    def publish(self, kind, data, products=(), nodes=()): # products / nodes involved are kept for filtering
+        with self.changed:
+            self.events.append({
+                'index': self.next_index,
+                'type': kind,
+                'data': data,
+                'products': set(products),
+                'nodes': set(nodes)
+            })
+            self.next_index += 1
+            self.changed.notify_all()
+
+    @staticmethod
+    def matches(event, products, nodes): # an event matches if it involves any of the requested products / nodes (no filter => everything)
+        if products and not (event['products'] & products):
+            return False
+        if nodes and not (event['nodes'] & nodes):
+            return False
+        return True
+
+    def since(self, cursor, products=None, nodes=None): # matching events with index >= cursor (older events may have been dropped) and the cursor to continue from
+        with self.changed:
+            oldest = self.next_index - len(self.events)
+            start = max(cursor, oldest) - oldest
+            events = [self.events[i] for i in range(start, len(self.events))]
+            return [event for event in events if self.matches(event, products, nodes)], max(cursor, self.next_index)
+
+    def wait(self, cursor, timeout): # block until an event with index >= cursor exists, returns False on timeout
+        with self.changed:
+            return self.changed.wait_for(lambda: self.next_index > cursor, timeout)
+
 
 class Blockchain(object):
     def __init__(self):
@@ -38,63 +120,107 @@ class Blockchain(object):
 
         self.unverified_hash = []  # list of unverified hashes
 
-        self.txns_seller = []  # list of all the transactions
-        self.txns_buyer = []
+        # seller / buyer id => verified transactions sorted by timestamp, filled as transactions get verified
+        self.seller_index = defaultdict(list)
+        self.buyer_index = defaultdict(list)
 
         self.mapping = {}
 
+        self.group = schnorr_group()  # (p, q, g) for the ownership proofs, generated once and shared by all blocks
+
+        self.events = EventLog()  # pushed to the /stream subscribers
+
+        # shared by the server's threads: readers take lock.read(), state changes lock.write();
+        # writer serializes whole write requests, so slow work (ownership proofs) can run outside lock.write()
+        self.lock = RWLock()
+        self.writer = threading.Lock()
+
         self.add_block(
             previous_hash="0x4cd1e910c3d74780000000000000000000000000000000000000000000000000")
 
     # includes timestamp, previous_hash and merkle root as a part of block header
-    def add_block(self, previous_hash):
-        txn_hash_adding = self.test()
+    def add_block(self, previous_hash, batch=None): # batch: (transactions, hashes) from take_pending, all unverified transactions if None
+        if batch is None:
+            batch = self.take_pending()
+        txns, hashes = batch
+        txn_hash_adding = self.test(hashes)
         hashh = self.conv(txn_hash_adding, previous_hash)
-        now = dt.now()
+        now = time.time()  # seconds since the epoch, never before the previous block so the chain stays sorted by time
         if len(self.chain) == 0:
             x = "0x4cd1e910c3d74780000000000000000000000000000000000000000000000000"
         else:
             y = self.last_block()
             x = y['hash']
+            now = max(now, y['timestamp'])
         block_info = {'index': len(self.chain) + 1,  # represnts index of block (position with 1 indexing) in linear blockchain
-                 'timestamp': now.strftime("%d/%m/%Y %H:%M:%S"),
-                 'transactions': self.unverified_txn,
+                 'timestamp': now,
+                 'transactions': txns,
                  'merkle_root': txn_hash_adding,  # list of transactions corresponding to the block
                  'hash': hashh,
                  'previous_hash': x,
 
                  }
         self.chain.append(block_info)
-        # current list of unverified transactions verified, therefore emptied unverified transactions
+        self.events.publish('block', {key: block_info[key] for key in ('index', 'timestamp', 'merkle_root', 'hash', 'previous_hash')} | {'transactions': len(block_info['transactions'])},
+                            products=[txn['Property ID'] for txn in block_info['transactions']],
+                            nodes=[txn[party] for txn in block_info['transactions'] for party in ('Buyer ID', 'Seller ID')])
+        return block_info
+
+    def take_pending(self): # removes the unverified transactions (and their hashes) for mining, new transactions go to the next block
+        batch = (self.unverified_txn, self.unverified_hash)
         self.unverified_txn = []
         self.unverified_hash = []
-        return block_info
+        return batch
 
-    def test(self):
-        elems = self.unverified_hash
+    def test(self, hashes):
+        elems = hashes
         mtree = MerkleTree(elems)
         print(elems)
         return mtree.getRootHash()
 
-    def validate_txn(self):  # unverifed transactions corresponding to a block are verified
-        
-            for i in range(len(self.unverified_txn)):
-                prop_id = self.unverified_txn[i]['Property ID']
-                sell_id_prop= self.unverified_txn[i]['Seller ID']
-                sell_id = self.mapping[prop_id]
-                
-                p = generate_large_prime(20)
-                g  = find_generator(p)
-                x = prop_id
-                y = pow(g,x)%p
-                r = randint(0,p-2)
-                h = pow(g,r)%p 
-                b = randint(0,1)
-                s = (r+b*x)%(p-1)
-                alice = pow(g,s)%p
-                bob  = (h*pow(y,b))%p
-                if(alice == bob and sell_id == sell_id_prop):       
-                    self.verified_txn.append(self.unverified_txn[i])
+    def validate_txn(self, txns=None):  # unverifed transactions corresponding to a block are verified
+        if txns is None:
+            txns = self.unverified_txn
+        self.record_verified(self.check_ownership(txns, self.owners(txns)))
+
+    def owners(self, txns): # property id => current owner, for the properties of the given transactions
+        return {txn['Property ID']: self.mapping.get(txn['Property ID']) for txn in txns}
+
+    def check_ownership(self, txns, owners): # the transactions passing the ownership check; reads no shared state, so it can run without holding the chain's lock
+        # ownership of every pending transaction is proven first, then all proofs are checked in one batch
+        proofs = [prove(txn['Property ID'], self.group) for txn in txns]
+        results = batch_verify(proofs, self.group)
+        return [txn for txn, valid in zip(txns, results) if valid and owners[txn['Property ID']] == txn['Seller ID']]
+
+    def record_verified(self, txns):
+        for txn in txns:
+            self.verified_txn.append(txn)
+            self.index_txn(txn)
+            self.events.publish('ownership', {'property_ID': txn['Property ID'], 'owner': txn['Buyer ID'], 'previous_owner': txn['Seller ID'], 'timestamp': txn['timestamp']},
+                                products=[txn['Property ID']], nodes=[txn['Buyer ID'], txn['Seller ID']])
+
+    def index_txn(self, txn): # add a verified transaction to the seller and buyer indexes, keeping them sorted by timestamp
+        insort(self.seller_index[txn['Seller ID']], txn, key=self.txn_time)
+        insort(self.buyer_index[txn['Buyer ID']], txn, key=self.txn_time)
+
+    @staticmethod
+    def txn_time(txn):
+        return txn['timestamp']
+
+    def blocks_between(self, start, end): # blocks mined in [start, end) (seconds since the epoch), found by binary search over the chain
+        first = bisect_left(self.chain, start, key=lambda block: block['timestamp'])
+        last = bisect_left(self.chain, end, first, key=lambda block: block['timestamp'])
+        return self.chain[first:last]
+
+    @staticmethod
+    def paginate(txns, page, page_size): # slice one page out of an index, only the page is copied
+        start = page * page_size
+        return {
+            'page': page,
+            'page_size': page_size,
+            'total': len(txns),
+            'transactions': txns[start:start + page_size]
+        }
         
     def conv(self,txn,prev):
         an_integer = int(txn, 16)
@@ -105,7 +231,7 @@ class Blockchain(object):
     
 
     def new_txn(self, buyer_ID,seller_ID, property_ID, rent): #new transaction data for a particular property 
-        now = dt.now()
+        now = time.time()
         x = randint(1,1000)
         y = randint(2000,3000)
         self.mapping[property_ID] = seller_ID
@@ -116,7 +242,7 @@ class Blockchain(object):
             'Seller ID': seller_ID,
             'Property ID': property_ID,
             'Amount': rent,
-            'timestamp': now.strftime("%d-%m-%Y %H:%M:%S")
+            'timestamp': now
         }
         self.unverified_txn.append(txn_info)
         txn_hash_curr = self.calc_hash_txns(txn_info)
@@ -126,24 +252,18 @@ class Blockchain(object):
 
     
     def calc_hash(self, block_info): #hash calculated using SHA256 
-        block_string = json.dumps(block_info.__dict__, sort_keys=True)
+        block_string = json.dumps(block_info, sort_keys=True)
         return hashlib.sha256(block_string.encode()).hexdigest()
     
     def calc_hash_txns(self, txn_info): # hash calculated for transactions as well for merkle root implementation
         block_string = json.dumps(txn_info, sort_keys=True)
         return hashlib.sha256(block_string.encode()).hexdigest()
     
-    def show_seller(self, prop_ID): #list of transactions sorted by timestamp, corresponding to a particular PROPERTY_ID
-        for i in range(len(self.verified_txn)):
-            if self.verified_txn[i]['Seller ID'] == prop_ID:
-                self.txns_seller.append(self.verified_txn[i])
-        return self.txns_seller
+    def show_seller(self, seller_ID, page=0, page_size=PAGE_SIZE): #page of transactions sorted by timestamp, corresponding to a particular SELLER_ID
+        return self.paginate(self.seller_index.get(seller_ID, []), page, page_size)
     
-    def show_buyer(self, prop_ID1): #list of transactions sorted by timestamp, corresponding to a particular PROPERTY_ID
-        for i in range(len(self.verified_txn)):
-            if self.verified_txn[i]['Buyer ID'] == prop_ID1:
-                self.txns_buyer.append(self.verified_txn[i])
-        return self.txns_buyer
+    def show_buyer(self, buyer_ID, page=0, page_size=PAGE_SIZE): #page of transactions sorted by timestamp, corresponding to a particular BUYER_ID
+        return self.paginate(self.buyer_index.get(buyer_ID, []), page, page_size)
 
     def last_block(self): # most recently added block
         return self.chain[-1]
@@ -191,6 +311,7 @@ class Blockchain(object):
                 self.delegates.append(y[0])
             
         print(self.delegates)
+        self.events.publish('delegates', {'delegates': list(self.delegates)}, nodes=self.delegates)
         
     # def resolve_chain(self):
     #     neighbours = self.nodes
@@ -216,13 +337,22 @@ class Blockchain(object):
    
     
     def broadcast(self):
+        delegates = self.fetch_delegates()
+        if delegates is not None:
+            self.set_delegates(delegates)
+
+    def fetch_delegates(self): # delegates elected by the election node (port 5000), None if the request failed
         r = requests.get('http://localhost:5000/show/delegates')
         print(r)
 
         if(r.status_code == 200):
-            delegates = r.json()['delegates']
-            self.delegates = delegates[0:3]
-            print(self.delegates)
+            return r.json()['delegates']
+        return None
+
+    def set_delegates(self, delegates):
+        self.delegates = delegates[0:3]
+        print(self.delegates)
+        self.events.publish('delegates', {'delegates': list(self.delegates)}, nodes=self.delegates)
             
 
 
@@ -1,52 +1,67 @@
 
 
 from urllib import response
-from flask import Flask, jsonify, request
+import json
+import os
+from flask import Flask, Response, jsonify, request
 
-from bchain import Blockchain
+from rawblockchain import Blockchain, PAGE_SIZE
 
+# Concurrency: all state lives in this process, so run a single process with several threads,
+# e.g. `python rawflask.py -p 5000` (threaded) or `gunicorn -w 1 --threads 8 rawflask:app`.
+# Multiple worker processes would each get their own chain.
+# Read endpoints copy what they need under bchain.lock.read() and build the response outside it;
+# write endpoints hold bchain.writer for the whole request and bchain.lock.write() only while changing state.
 app = Flask(__name__)
 bchain = Blockchain()
+port = int(os.environ.get('PORT', 5000))  # overridden by --port when run directly
 
 @app.route('/mine', methods=['GET'])
 def mine(): 
     current_port = "localhost:"+ str(port)
-    if(current_port in bchain.delegates):
-        # response = {
-        #         'message': "New block mined!",
-        #         'index': "",
-        #         'transactions': "",
-        #         'previous_hash': ""
-        #     }
-        # return jsonify(response),200
-        if len(bchain.unverified_txn) >= 2: #mining the block only if number of transactions exceed 2
-            last_block = bchain.last_block
-            previous_hash = bchain.calc_hash(last_block) #previous block hash included in the block header
-            ver_txn = bchain.validate_txn() #all the unverified transactions are verified and added to the block
-            block = bchain.add_block(previous_hash)
-             
-            response = {
-                'message': "New block mined!",
-                'index': block['index'],
-                'transactions': block['transactions'],
-                'previous_hash': block['previous_hash']
-            }
-            print(len(bchain.unverified_txn))
-            return jsonify(response), 200
-
-        else:
-            response = {
-                'message' : 'Not enough transactions to mine a new block and add to chain!'
-            }
-            print(len(bchain.unverified_txn))
-            return jsonify(response),400
-
-    
+    # response = {
+    #         'message': "New block mined!",
+    #         'index': "",
+    #         'transactions': "",
+    #         'previous_hash': ""
+    #     }
+    # return jsonify(response),200
+    with bchain.writer:
+        with bchain.lock.write():
+            # checked under the lock, so the delegate set can't be replaced by an election meanwhile
+            authorised = current_port in bchain.delegates
+            if not authorised or len(bchain.unverified_txn) < 2: #mining the block only if number of transactions exceed 2
+                batch = None
+            else:
+                batch = bchain.take_pending()
+                owners = bchain.owners(batch[0])
+        if batch is not None:
+            valid = bchain.check_ownership(batch[0], owners) # the slow part, readers are not blocked meanwhile
+            with bchain.lock.write():
+                last_block = bchain.last_block()
+                previous_hash = bchain.calc_hash(last_block) #previous block hash included in the block header
+                ver_txn = bchain.record_verified(valid) #all the unverified transactions are verified and added to the block
+                block = bchain.add_block(previous_hash, batch)
+    if not authorised:
+        response = {
+            'message': 'You are not authorised to mine block! Only delegates can mine.'
+        }
+        return jsonify(response),400
+    if batch is not None:
+        response = {
+            'message': "New block mined!",
+            'index': block['index'],
+            'transactions': block['transactions'],
+            'previous_hash': block['previous_hash']
+        }
+        print(len(bchain.unverified_txn))
+        return jsonify(response), 200
 
     else:
         response = {
-            'message': 'You are not authorised to mine block! Only delegates can mine.'
+            'message' : 'Not enough transactions to mine a new block and add to chain!'
         }
+        print(len(bchain.unverified_txn))
         return jsonify(response),400
 
 
@@ -59,11 +74,13 @@ def add_nodes(): #using API calls to add nodes the to the network
         return 'Error',400
 
     
-    bchain.add_node(values['nodes'], values['stake'])
+    with bchain.writer, bchain.lock.write():
+        bchain.add_node(values['nodes'], values['stake'])
+        total_nodes = list(bchain.nodes)
     
     response = {
         'message': 'New nodes have been added.',
-        'total_nodes': list(bchain.nodes)
+        'total_nodes': total_nodes
     }
     print(bchain.nodes)
     return jsonify(response), 201
@@ -77,7 +94,8 @@ def new_txn(): #new transactions using the given required attributes to enable p
     if not all(value in values for value in required):
         return 'Please enter buyer_ID,seller_ID, property_ID and rent.', 400
     
-    idx = bchain.new_txn(values['buyer_ID'], values['seller_ID'], values['property_ID'], values['rent'])
+    with bchain.writer, bchain.lock.write():
+        idx = bchain.new_txn(values['buyer_ID'], values['seller_ID'], values['property_ID'], values['rent'])
 
     response = {
         'message': f'Transaction will be added to block {idx}'
@@ -87,25 +105,29 @@ def new_txn(): #new transactions using the given required attributes to enable p
 
 @app.route('/show_full_chain', methods=['GET'])
 def show_chain(): #prints entire blockchain chain
+    with bchain.lock.read():
+        chain = list(bchain.chain)  # blocks are never modified once added, copying the list is enough
     response = {
-        'chain': bchain.chain,
-        'length': len(bchain.chain)
+        'chain': chain,
+        'length': len(chain)
     }
-    print(bchain.chain)
+    print(chain)
     return response, 200
 
 
 @app.route('/voting',methods=['GET'])
 def voting(): #API cals for voting for the delegates in the DPOS consensus algorithm
-    bchain.vote_grp = []
-    bchain.star_grp = []
-    bchain.super_grp = []
     if(port == 5000):
-        show_votes = bchain.voting_power()
+        with bchain.writer, bchain.lock.write():
+            bchain.vote_grp = []
+            bchain.star_grp = []
+            bchain.super_grp = []
+            show_votes = bchain.voting_power()
+            vote_grp = list(bchain.vote_grp)
 
         response ={
             'message': 'Voting Results: ',
-            'nodes': bchain.vote_grp
+            'nodes': vote_grp
             }
         
         return jsonify(response),200
@@ -119,23 +141,30 @@ def voting(): #API cals for voting for the delegates in the DPOS consensus algor
 
 @app.route('/show/delegates',methods=['GET'])
 def delegates(): #maximum of 3 delgates for mining the block in blockchain
-    bchain.delegates = []
-    show_delegates = bchain.delegates_selection()
+    with bchain.writer, bchain.lock.write():
+        bchain.delegates = []
+        show_delegates = bchain.delegates_selection()
+        delegates = list(bchain.delegates)
 
     response={
         'message': 'The 3 delegate nodes selected for block mining are: ',
-        'delegates': bchain.delegates
+        'delegates': delegates
     }
     return jsonify(response),200
 
 
 @app.route('/broadcast',methods=['GET'])
 def syncro_delegates():
-    bdelegates = bchain.broadcast()
+    # no lock while fetching: on the election node the request is answered by this same server
+    bdelegates = bchain.fetch_delegates()
+    with bchain.writer, bchain.lock.write():
+        if bdelegates is not None:
+            bchain.set_delegates(bdelegates)
+        delegates = list(bchain.delegates)
 
     response ={
         'message': 'The delegate nodes are: ',
-        'delegates': bchain.delegates
+        'delegates': delegates
     }
     return jsonify(response),200
 # @app.route('/chain/resolve', methods=['GET'])
@@ -157,14 +186,31 @@ def syncro_delegates():
 
 @app.route('/chain/valid', methods = ['GET'])
 def is_chain():
-    res = bchain.is_chain_valid()
+    with bchain.lock.read():
+        res = bchain.is_chain_valid()
     response={
         'message': res
     }
     return jsonify(response) , 200
 
+@app.route('/show/range',methods=['GET'])
+def time_range(): #blocks mined between start (inclusive) and end (exclusive), both in seconds since the epoch
+    values = request.get_json()
+    if not values or not all(isinstance(values.get(key), (int, float)) for key in ('start', 'end')):
+        return 'Please enter start and end (seconds since the epoch).', 400
+
+    with bchain.lock.read():
+        blocks = bchain.blocks_between(values['start'], values['end'])
+    response ={
+        'message': 'Blocks in range: ',
+        'blocks': blocks,
+        'transactions': sum(len(block['transactions']) for block in blocks)
+    }
+    return jsonify(response),200
+
+
 @app.route('/show/seller',methods=['GET'])
-def seller(): #prints entire history corresponding to a given Property_ID
+def seller(): #prints one page of the history corresponding to a given Seller_ID, sorted by timestamp
     values = request.get_json()
     required = 'Seller_ID'
     
@@ -172,17 +218,25 @@ def seller(): #prints entire history corresponding to a given Property_ID
     #     return 'Please enter property_ID.', 400
     
     id = values[required]
+    page = values.get('page', 0)
+    page_size = values.get('page_size', PAGE_SIZE)
+    if page < 0 or page_size <= 0:
+        return 'page must be non-negative and page_size positive.', 400
     
-    txns_seller= bchain.show_seller(id)
+    with bchain.lock.read():
+        txns_seller = bchain.show_seller(id, page, page_size)
     response ={
         'message': 'Seller history: ',
-        'transactions_details': txns_seller
+        'page': txns_seller['page'],
+        'page_size': txns_seller['page_size'],
+        'total': txns_seller['total'],
+        'transactions_details': txns_seller['transactions']
     }
     return jsonify(response),200
 
 
 @app.route('/show/buyer',methods=['GET'])
-def buyer(): #prints entire history corresponding to a given Property_ID
+def buyer(): #prints one page of the history corresponding to a given Buyer_ID, sorted by timestamp
     values = request.get_json()
     required = 'Buyer_ID'
     
@@ -190,17 +244,60 @@ def buyer(): #prints entire history corresponding to a given Property_ID
     #     return 'Please enter property_ID.', 400
     
     id = values[required]
+    page = values.get('page', 0)
+    page_size = values.get('page_size', PAGE_SIZE)
+    if page < 0 or page_size <= 0:
+        return 'page must be non-negative and page_size positive.', 400
     
-    txns_buyer = bchain.show_buyer(id)
+    with bchain.lock.read():
+        txns_buyer = bchain.show_buyer(id, page, page_size)
     response ={
         'message': 'Buyer history: ',
-        'transactions_details': txns_buyer
+        'page': txns_buyer['page'],
+        'page_size': txns_buyer['page_size'],
+        'total': txns_buyer['total'],
+        'transactions_details': txns_buyer['transactions']
     }
     return jsonify(response),200
 
 
 
 
+KEEP_ALIVE = 15 # seconds between keep-alive comments on an idle stream
+
+
+def parse_ids(arg): # comma separated ids from a query parameter, None if absent
+    value = request.args.get(arg)
+    if not value:
+        return None
+    return {int(x) if x.strip().lstrip('-').isdigit() else x.strip() for x in value.split(',')}
+
+
+@app.route('/stream', methods=['GET'])
+def stream(): #server-sent events for new blocks, delegate elections and ownership changes; filters: product, node; resume: cursor or Last-Event-ID
+    try:
+        products = parse_ids('product')
+        nodes = parse_ids('node')
+        if 'cursor' in request.args:
+            cursor = int(request.args['cursor'])
+        elif 'Last-Event-ID' in request.headers:
+            cursor = int(request.headers['Last-Event-ID']) + 1  # reconnecting client, resume after the last event it received
+        else:
+            cursor = bchain.events.next_index  # new subscribers only get future events
+    except ValueError:
+        return 'cursor must be an integer.', 400
+
+    def events(cursor):
+        while True:
+            matching, cursor = bchain.events.since(cursor, products, nodes)
+            for event in matching:
+                yield 'id: %d\nevent: %s\ndata: %s\n\n' % (event['index'], event['type'], json.dumps(event['data']))
+            if not bchain.events.wait(cursor, KEEP_ALIVE):
+                yield ': keep-alive\n\n'
+
+    return Response(events(cursor), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+
 if __name__ == '__main__':
     from argparse import ArgumentParser
 
@@ -208,4 +305,4 @@ if __name__ == '__main__':
     parser.add_argument('-p', '--port', default=5000, type=int, help='Listening on port')
     args = parser.parse_args()
     port = args.port
-    app.run(host = '0.0.0.0', port = port)
\ No newline at end of file
+    app.run(host = '0.0.0.0', port = port, threaded = True)
\ No newline at end of file
@@ -0,0 +1,282 @@
+import argparse
+import struct
+import time
+from typing import Any
+import wireformat
+from blockchain import Blockchain, Block, BloomFilter, NodePublicInfo, NodeType, StateJournal, REORG_DEPTH
+from blockstore import MemoryBlockStore
+
+"""
+Per-node replicas of a blockchain kept in sync with compact binary deltas
+
+Delta record (little endian):
+  header: magic 'SCDL', version (u8), kind (u8), payload length (u32)
+  EXTEND payload: encoded block length (u32), the encoded block (wireformat.py), then its state changes
+  REVERT payload: header_hash of the block to undo (32 raw bytes)
+  STATE payload: state changes committed without a block (penalties of a failed round)
+  NODES payload: node count (u32), then per node: id (q), stake (q), type (u8), stock count (u32), product ids (q each)
+State changes: count (u32), then per change its kind (u8) and
+  stake: id count (u32), ids (q each), amount (q)
+  halve: id (q)
+  transfer: sender_id, receiver_id (q), product count (u32), product ids (q each)
+Public keys are not replicated, replicas check the integrity of blocks (previous hash, timestamp, merkle root, bloom filter, header hash) but not the signatures
+"""
+DELTA_MAGIC = b'SCDL'
+DELTA_VERSION = 1
+DELTA_HEADER = struct.Struct('<4sBBI')
+EXTEND, REVERT, STATE, NODES = 1, 2, 3, 4
+CHANGE_KINDS = {'stake': 1, 'halve': 2, 'transfer': 3}
+NODE_TYPES = list(NodeType)
+COUNT = struct.Struct('<I')
+ID = struct.Struct('<q')
+
+def packIds(ids: Any) -> bytes:
+  ids = sorted(ids)
+  return COUNT.pack(len(ids)) + struct.pack('<%dq' % len(ids), *ids)
+
+def unpackIds(buf: memoryview, offset: int) -> tuple[list[int], int]:
+  count, = COUNT.unpack_from(buf, offset)
+  offset += COUNT.size
+  return list(struct.unpack_from('<%dq' % count, buf, offset)), offset + count*ID.size
+
+def encodeChanges(changes: list[tuple]) -> bytes:
+  parts = [COUNT.pack(len(changes))]
+  for change in changes:
+    parts.append(bytes((CHANGE_KINDS[change[0]],)))
+    if change[0] == 'stake':
+      parts += [packIds(change[1]), ID.pack(change[2])]
+    elif change[0] == 'halve':
+      parts.append(ID.pack(change[1]))
+    else:
+      parts += [ID.pack(change[1]), ID.pack(change[2]), packIds(change[3])]
+  return b''.join(parts)
+
+def decodeChanges(buf: memoryview, offset: int) -> list[tuple]:
+  count, = COUNT.unpack_from(buf, offset)
+  offset += COUNT.size
+  changes: list[tuple] = []
+  for _ in range(count):
+    kind = buf[offset]
+    offset += 1
+    if kind == CHANGE_KINDS['stake']:
+      ids, offset = unpackIds(buf, offset)
+      amount, = ID.unpack_from(buf, offset)
+      offset += ID.size
+      changes.append(('stake', tuple(ids), amount))
+    elif kind == CHANGE_KINDS['halve']:
+      id, = ID.unpack_from(buf, offset)
+      offset += ID.size
+      changes.append(('halve', id))
+    else:
+      sender_id, receiver_id = struct.unpack_from('<qq', buf, offset)
+      products, offset = unpackIds(buf, offset + 2*ID.size)
+      changes.append(('transfer', sender_id, receiver_id, set(products)))
+  return changes
+
+def encodeNodes(infos: list[NodePublicInfo]) -> bytes:
+  parts = [COUNT.pack(len(infos))]
+  for info in infos:
+    parts += [ID.pack(info['id']), ID.pack(info['stake']), bytes((NODE_TYPES.index(info['type']),)), packIds(info['stock'])]
+  return b''.join(parts)
+
+def delta(kind: int, payload: bytes) -> bytes:
+  return DELTA_HEADER.pack(DELTA_MAGIC, DELTA_VERSION, kind, len(payload)) + payload
+
+"""
+The copy of the chain owned by one node: block headers and encoded bodies, node records (stake, stock) and product locations, updated only by applying deltas
+**Fields**
+  node_id: the node owning the replica
+  blockchain, heights, newest_block: headers, canonical chain and tip (as in Blockchain)
+  store: encoded block bodies
+  nodes, product_locations: the replica's own state
+  undo: undo journal of the state changes of each recent block (None for blocks received without their changes, which can't be undone)
+  deltas, bytes_received, apply_time: number of deltas applied, their total size and the time spent decoding and applying them (seconds)
+**Methods**
+  receive: apply one delta, raises ValueError if it doesn't fit the replica (e.g. a block not extending the tip)
+"""
+class Replica():
+  def __init__(self, node_id: int) -> None:
+    self.node_id = node_id
+    self.blockchain: dict[str, Any] = dict()
+    self.heights: list[str] = []
+    self.newest_block: None | str = None
+    self.store = MemoryBlockStore()
+    self.nodes: dict[int, NodePublicInfo] = dict()
+    self.product_locations: dict[int, int] = dict()
+    self.undo: dict[str, None | list[tuple]] = dict()
+    self.deltas = 0
+    self.bytes_received = 0
+    self.apply_time = 0.0
+
+  def receive(self, data: bytes) -> None:
+    start = time.perf_counter()
+    buf = memoryview(data)
+    magic, version, kind, length = DELTA_HEADER.unpack_from(buf)
+    if magic != DELTA_MAGIC or version != DELTA_VERSION:
+      raise ValueError("not a version " + str(DELTA_VERSION) + " delta")
+    payload = buf[DELTA_HEADER.size:DELTA_HEADER.size + length]
+    if kind == EXTEND:
+      self.extend(payload)
+    elif kind == REVERT:
+      self.revert(payload.hex())
+    elif kind == STATE:
+      StateJournal(self.nodes, self.product_locations).apply(decodeChanges(payload, 0))
+    elif kind == NODES:
+      self.addNodes(payload)
+    else:
+      raise ValueError("unknown delta kind " + str(kind))
+    self.deltas += 1
+    self.bytes_received += len(data)
+    self.apply_time += time.perf_counter() - start
+
+  def extend(self, payload: memoryview) -> None:
+    length, = COUNT.unpack_from(payload)
+    encoded = payload[COUNT.size:COUNT.size + length]
+    block = Block.fromView(encoded)
+    if self.newest_block is not None and block.previous_hash != self.newest_block:
+      raise ValueError("block " + block.header_hash + " does not extend the replica's tip")
+    if self.newest_block is not None and block.timestamp < self.blockchain[self.newest_block].timestamp:
+      raise ValueError("block " + block.header_hash + " is older than its parent")
+    # fromView rebuilds the merkle tree from the transactions
+    if block.merkle_root != wireformat.BlockView(encoded).merkle_root:
+      raise ValueError("merkle root mismatch in block " + block.header_hash)
+    if block.bloom != BloomFilter.fromTransactions(block.transactions):
+      raise ValueError("bloom filter mismatch in block " + block.header_hash)
+    if Block.hashHeader(block.previous_hash, block.merkle_root, block.height, block.miner_id, block.timestamp, block.bloom) != block.header_hash:
+      raise ValueError("header hash mismatch in block " + block.header_hash)
+    changes = decodeChanges(payload, COUNT.size + length)
+    self.store.put(block.header_hash, bytes(encoded))
+    self.blockchain[block.header_hash] = block.header()
+    self.heights.append(block.header_hash)
+    self.newest_block = block.header_hash
+    self.undo[block.header_hash] = StateJournal(self.nodes, self.product_locations).apply(changes)
+    # same reorganisation depth as the chain
+    if len(self.heights) > REORG_DEPTH + 1:
+      self.undo.pop(self.heights[-REORG_DEPTH - 2], None)
+
+  def revert(self, header_hash: str) -> None:
+    if header_hash != self.newest_block:
+      raise ValueError("only the tip can be undone")
+    undo = self.undo.pop(header_hash, None)
+    if undo is None:
+      raise ValueError("block " + header_hash + " can't be undone by this replica")
+    StateJournal(self.nodes, self.product_locations).revert(undo)
+    self.heights.pop()
+    self.newest_block = self.heights[-1] if self.heights else None
+
+  def addNodes(self, payload: memoryview) -> None:
+    count, = COUNT.unpack_from(payload)
+    offset = COUNT.size
+    for _ in range(count):
+      id, stake = struct.unpack_from('<qq', payload, offset)
+      type = NODE_TYPES[payload[offset + 2*ID.size]]
+      stock, offset = unpackIds(payload, offset + 2*ID.size + 1)
+      self.nodes[id] = {'id': id, 'stake': stake, 'stock': set(stock), 'type': type, 'public_key': None}
+      for product in stock:
+        self.product_locations[product] = id
+
+"""
+Ships every change of a blockchain to the replicas as deltas; each delta is encoded once and delivered to every replica
+**Fields**
+  bc: the chain changes are taken from (through its listeners)
+  replicas: node_id => replica
+  deltas, bytes_sent: number of deltas delivered and their total size over all replicas
+  encode_time: time spent encoding deltas (seconds)
+**Methods**
+  attach: create the replica of a node from a snapshot of the chain (current node records, canonical blocks)
+  replicateAll: attach a replica for every node of the chain
+  diverged: ids of the replicas whose tip or state differ from the chain
+  stats: the sync counters
+"""
+class Replicator():
+  def __init__(self, bc: Blockchain) -> None:
+    self.bc = bc
+    self.replicas: dict[int, Replica] = dict()
+    self.deltas = 0
+    self.bytes_sent = 0
+    self.encode_time = 0.0
+    bc.listeners.append(self.publish)
+
+  def extendDelta(self, header_hash: str, changes: None | list[tuple]) -> bytes:
+    encoded = self.bc.getEncodedBlock(header_hash)
+    return delta(EXTEND, COUNT.pack(len(encoded)) + encoded + encodeChanges(changes or []))
+
+  def publish(self, kind: str, payload: Any) -> None:
+    if kind == 'state' and not payload:
+      return
+    start = time.perf_counter()
+    if kind == 'extend':
+      data = self.extendDelta(payload, self.bc.journals[payload][0])
+    elif kind == 'revert':
+      data = delta(REVERT, bytes.fromhex(payload))
+    elif kind == 'state':
+      data = delta(STATE, encodeChanges(payload))
+    else:
+      data = delta(NODES, encodeNodes(payload))
+    self.encode_time += time.perf_counter() - start
+    self.deliver(data, self.replicas.values())
+
+  def deliver(self, data: bytes, replicas: Any) -> None:
+    for replica in replicas:
+      replica.receive(data)
+      self.deltas += 1
+      self.bytes_sent += len(data)
+
+  def attach(self, node_id: int) -> Replica:
+    replica = Replica(node_id)
+    # blocks that can still be reorganised are sent with their changes (so that the replica can undo them) on top of the node records
+    # rewound to before them; older blocks are sent without changes, their effect is already in the records
+    recent = [header_hash for header_hash in self.bc.heights if self.bc.journals.get(header_hash, (None, None))[1] is not None]
+    nodes = {id: {**info, 'stock': set(info['stock'])} for id, info in self.bc.nodes.items()}
+    journal = StateJournal(nodes, dict(self.bc.product_locations))
+    for header_hash in reversed(recent):
+      journal.revert(self.bc.journals[header_hash][1])
+    snapshot = [delta(NODES, encodeNodes(list(nodes.values())))]
+    recent_set = set(recent)
+    snapshot += [self.extendDelta(header_hash, self.bc.journals[header_hash][0] if header_hash in recent_set else None) for header_hash in self.bc.heights]
+    for data in snapshot:
+      self.deliver(data, (replica,))
+    for header_hash in self.bc.heights:
+      if header_hash not in recent_set:
+        replica.undo[header_hash] = None
+    self.replicas[node_id] = replica
+    return replica
+
+  def replicateAll(self) -> None:
+    for node_id in self.bc.nodes:
+      if node_id not in self.replicas:
+        self.attach(node_id)
+
+  def diverged(self) -> list[int]:
+    state = {id: (info['stake'], info['stock']) for id, info in self.bc.nodes.items()}
+    return [node_id for node_id, replica in self.replicas.items()
+            if replica.heights != self.bc.heights or {id: (info['stake'], info['stock']) for id, info in replica.nodes.items()} != state
+            or replica.product_locations != self.bc.product_locations]
+
+  def stats(self) -> dict[str, float]:
+    return {
+      'replicas': len(self.replicas),
+      'deltas': self.deltas,
+      'bytes_sent': self.bytes_sent,
+      'encode_time': self.encode_time,
+      'apply_time': sum(replica.apply_time for replica in self.replicas.values()),
+    }
+
+if __name__ == '__main__':
+  from simulation import WorkloadDriver
+  parser = argparse.ArgumentParser(description="Runs a workload with a replica per node and reports the replication overhead")
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--nodes', type=int, default=20)
+  parser.add_argument('--products', type=int, default=300)
+  parser.add_argument('--steps', type=int, default=2000)
+  args = parser.parse_args()
+  driver = WorkloadDriver(args.seed, args.nodes, args.products)
+  replicator = Replicator(driver.bc)
+  replicator.replicateAll()
+  report = driver.run(args.steps)
+  stats = replicator.stats()
+  print("Blocks mined:", report['blocks'], "in %.3f s" % report['elapsed'])
+  print("Replicas: %d, deltas delivered: %d, bytes: %d (%.1f per replica per block)" % (stats['replicas'], stats['deltas'], stats['bytes_sent'],
+        stats['bytes_sent'] / max(stats['replicas'], 1) / max(report['blocks'], 1)))
+  print("Encoding: %.3f s, applying (all replicas): %.3f s" % (stats['encode_time'], stats['apply_time']))
+  print("Diverged replicas:", replicator.diverged() or 'none')
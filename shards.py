@@ -0,0 +1,229 @@
+import argparse
+import multiprocessing
+import random
+import time
+from collections.abc import Iterable
+from typing import Any, Literal, TypedDict
+from blockchain import Blockchain, Node, NodeType, NodeSpec, NodeRegistration, current_active_nodes, MAX_IN_FLIGHT
+from signers import SIGNERS, DEFAULT_SIGNER, generateKeys
+from simulation import quiet
+
+"""
+Sharding: one chain per manufacturer (product line), each hosted by its own worker process. The module level current_active_nodes
+of blockchain.py only allows one chain per process, so every shard gets a process of its own and they mine in parallel.
+A node identity (id, type, key pair) is shared by all the shards the node joins; products are identified by (manufacturer_id, product id)
+"""
+
+"""
+A node known to the router, the same identity is registered in every shard the node joins
+"""
+class NodeIdentity(TypedDict):
+  id: int
+  stake: int
+  type: Literal['client', 'distributor']
+  keys: None | tuple[Any, Any]
+  shards: set[int]
+
+"""
+The chain of one manufacturer, driven by node ids instead of a parent node (runs inside the shard's worker process)
+**Methods**
+  register: add nodes to the chain (see Blockchain.addNodes)
+  transfer: sender requests a transfer of products, the receiver accepts it; returns the transaction id, None if it was refused
+  mine: mine a block, returns the new chain height
+  holdings: stock of every node that can start a transaction, without the products reserved by transactions in flight
+  locate: node currently holding a product (None if unknown)
+  height: height of the newest block
+"""
+class Shard():
+  def __init__(self, manufacturer_id: int, stake: int, stock: Iterable[int], signer_name: str) -> None:
+    # a forked worker starts with a copy of its parent's nodes
+    current_active_nodes.clear()
+    self.bc = Blockchain(Node(stake, manufacturer_id, stock, NodeType.MANUFACTURER, SIGNERS[signer_name]()))
+
+  def register(self, specs: list[NodeSpec]) -> list[NodeRegistration]:
+    return self.bc.addNodes(specs)
+
+  def transfer(self, sender_id: int, receiver_id: int, product_ids: set[int]) -> None | str:
+    if sender_id not in current_active_nodes or receiver_id not in current_active_nodes:
+      return None
+    pending = len(self.bc.pending_transactions[receiver_id])
+    self.bc.changeParentNode(sender_id)
+    self.bc.startTransaction(receiver_id, product_ids)
+    if len(self.bc.pending_transactions[receiver_id]) == pending:
+      return None
+    txn = next(reversed(self.bc.pending_transactions[receiver_id].values()))
+    self.bc.changeParentNode(receiver_id)
+    self.bc.acceptTransactionRequest(sender_id, txn.nonce)
+    if txn.transaction_id in self.bc.pending_transactions[receiver_id]:
+      # the receiver could not accept, withdraw the request
+      self.bc.changeParentNode(sender_id)
+      self.bc.deleteTransactionRequest(txn.nonce)
+      return None
+    return txn.transaction_id
+
+  def mine(self) -> int:
+    self.bc.mineBlock()
+    return self.height()
+
+  def holdings(self) -> dict[int, list[int]]:
+    holdings = {id: sorted(node.stock.difference(self.bc.reserved)) for id, node in current_active_nodes.items() if len(self.bc.in_flight[id]) < MAX_IN_FLIGHT}
+    return {id: stock for id, stock in holdings.items() if stock}
+
+  def locate(self, product_id: int) -> None | int:
+    return self.bc.product_locations.get(product_id)
+
+  def height(self) -> int:
+    return len(self.bc.heights) - 1
+
+# methods of Shard callable from the router
+SHARD_METHODS = ('register', 'transfer', 'mine', 'holdings', 'locate', 'height')
+
+"""
+Worker process of a shard: executes (method, args) requests from the router until it receives None, replying (True, result) or (False, error)
+"""
+def serveShard(conn: Any, manufacturer_id: int, stake: int, stock: list[int], signer_name: str) -> None:
+  with quiet():
+    shard = Shard(manufacturer_id, stake, stock, signer_name)
+    while True:
+      request = conn.recv()
+      if request is None:
+        break
+      method, args = request
+      try:
+        if method not in SHARD_METHODS:
+          raise AttributeError("unknown shard method " + method)
+        conn.send((True, getattr(shard, method)(*args)))
+      except Exception as e:
+        conn.send((False, repr(e)))
+  conn.close()
+
+"""
+Raised by the router when a shard fails to execute a request
+"""
+class ShardError(Exception):
+  pass
+
+"""
+Hosts one shard per manufacturer in worker processes and routes requests to them
+**Fields**
+  signer_name: signature scheme of every shard
+  shards: manufacturer_id => (process, connection) of its shard
+  identities: node_id => identity shared across shards
+**Methods**
+  addShard: start the shard of a manufacturer
+  registerNode: create a node identity and register it in the shards it holds stock in
+  joinShard: register a known node in another shard, with the same id and keys
+  transfer: route a transfer to the shard of the product line (manufacturer)
+  mineAll: mine every shard in parallel
+  request, requestAll: call a shard method on one | all shards (requestAll sends to every shard before waiting for any reply)
+  close: stop the workers
+"""
+class ShardRouter():
+  def __init__(self, signer_name: str = DEFAULT_SIGNER.name) -> None:
+    self.signer_name = signer_name
+    self.signer = SIGNERS[signer_name]()
+    self.shards: dict[int, tuple[multiprocessing.Process, Any]] = dict()
+    self.identities: dict[int, NodeIdentity] = dict()
+
+  def addShard(self, manufacturer_id: int, stake: int, stock: Iterable[int]) -> None:
+    if manufacturer_id in self.shards:
+      raise ValueError("manufacturer " + str(manufacturer_id) + " already has a shard")
+    conn, child = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=serveShard, args=(child, manufacturer_id, stake, list(stock), self.signer_name), daemon=True)
+    process.start()
+    child.close()
+    self.shards[manufacturer_id] = (process, conn)
+
+  def request(self, manufacturer_id: int, method: str, *args: Any) -> Any:
+    conn = self.shards[manufacturer_id][1]
+    conn.send((method, args))
+    return self.reply(manufacturer_id, conn)
+
+  def requestAll(self, method: str, *args: Any) -> dict[int, Any]:
+    for _, conn in self.shards.values():
+      conn.send((method, args))
+    return {manufacturer_id: self.reply(manufacturer_id, conn) for manufacturer_id, (_, conn) in self.shards.items()}
+
+  @staticmethod
+  def reply(manufacturer_id: int, conn: Any) -> Any:
+    ok, result = conn.recv()
+    if not ok:
+      raise ShardError("shard " + str(manufacturer_id) + ": " + result)
+    return result
+
+  """
+  params:
+    stocks: manufacturer_id => products the node holds in that product line, the node joins each of these shards
+  returns: the registration outcome in each shard
+  """
+  def registerNode(self, node_id: int, stake: int, type: Literal['client', 'distributor'], stocks: dict[int, Iterable[int]]) -> dict[int, NodeRegistration]:
+    if node_id in self.identities:
+      raise ValueError("node " + str(node_id) + " already registered")
+    # keys that can be sent to the workers are made once and shared, otherwise every shard generates its own on first use
+    keys = generateKeys(self.signer, 1)[0] if self.signer.picklable_keys else None
+    self.identities[node_id] = {'id': node_id, 'stake': stake, 'type': type, 'keys': keys, 'shards': set()}
+    return {manufacturer_id: self.joinShard(node_id, manufacturer_id, stock) for manufacturer_id, stock in stocks.items()}
+
+  def joinShard(self, node_id: int, manufacturer_id: int, stock: Iterable[int] = ()) -> NodeRegistration:
+    identity = self.identities[node_id]
+    spec: NodeSpec = {'id': node_id, 'stake': identity['stake'], 'type': identity['type'], 'stock': list(stock)}
+    if identity['keys'] is not None:
+      spec['keys'] = identity['keys']
+    result = self.request(manufacturer_id, 'register', [spec])[0]
+    if result['registered']:
+      identity['shards'].add(manufacturer_id)
+    return result
+
+  def transfer(self, manufacturer_id: int, sender_id: int, receiver_id: int, product_ids: Iterable[int]) -> None | str:
+    return self.request(manufacturer_id, 'transfer', sender_id, receiver_id, set(product_ids))
+
+  def mineAll(self) -> dict[int, int]:
+    return self.requestAll('mine')
+
+  def close(self) -> None:
+    for process, conn in self.shards.values():
+      conn.send(None)
+      conn.close()
+    for process, _ in self.shards.values():
+      process.join()
+    self.shards.clear()
+
+  def __enter__(self) -> 'ShardRouter':
+    return self
+
+  def __exit__(self, *exc: Any) -> None:
+    self.close()
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Runs one shard per manufacturer in worker processes and measures mining throughput")
+  parser.add_argument('--shards', type=int, default=4)
+  parser.add_argument('--nodes', type=int, default=10, help="nodes shared by all shards (at least 4)")
+  parser.add_argument('--products', type=int, default=100, help="products per shard")
+  parser.add_argument('--rounds', type=int, default=20, help="rounds of transfers followed by mining every shard")
+  parser.add_argument('--transfers', type=int, default=3, help="transfers per shard and round")
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--signer', choices=SIGNERS, default=DEFAULT_SIGNER.name)
+  args = parser.parse_args()
+  rng = random.Random(args.seed)
+  manufacturers = [10000*(i + 1) for i in range(args.shards)]
+  with ShardRouter(args.signer) as router:
+    for manufacturer_id in manufacturers:
+      router.addShard(manufacturer_id, 100000000, ())
+    for node_id in range(1, args.nodes + 1):
+      stocks = {m: [p for p in range(args.products) if p % args.nodes == node_id - 1] for m in manufacturers}
+      router.registerNode(node_id, rng.randint(50, 1000), rng.choice(('client', 'distributor')), stocks)
+    committed = 0
+    start = time.perf_counter()
+    for _ in range(args.rounds):
+      for manufacturer_id, holdings in router.requestAll('holdings').items():
+        senders = sorted(holdings)
+        rng.shuffle(senders)
+        for sender in senders[:args.transfers]:
+          receiver = rng.choice([node for node in router.identities if node != sender])
+          if router.transfer(manufacturer_id, sender, receiver, [rng.choice(holdings[sender])]) is not None:
+            committed += 1
+      router.mineAll()
+    elapsed = time.perf_counter() - start
+    heights = router.requestAll('height')
+  print("Shards:", len(heights), "heights:", heights)
+  print("%d transfers accepted, %d blocks in %.3f s (%.2f blocks/s)" % (committed, sum(heights.values()), elapsed, sum(heights.values()) / elapsed))
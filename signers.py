@@ -0,0 +1,218 @@
+import hashlib
+import hmac
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, TYPE_CHECKING
+# rsa is imported by RSASigner on first use, so processes using other schemes never load it
+if TYPE_CHECKING:
+  import rsa
+
+# optional fast backend: Ed25519 from cryptography, or from PyNaCl if cryptography is not installed
+try:
+  from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey, Ed25519PublicKey
+  from cryptography.exceptions import InvalidSignature
+except ImportError:
+  Ed25519PrivateKey = None
+try:
+  import nacl.signing
+  import nacl.exceptions
+except ImportError:
+  nacl = None
+
+"""
+Base class of the signature schemes a blockchain can use; every node of a chain uses the chain's signer
+**Methods**
+  newkeys: returns a new (public key, private key) pair
+  sign: returns the signature of the given bytes
+  verify: returns True if the signature over the given bytes was made by the owner of the public key, False otherwise
+**Fields**
+  picklable_keys: True if key pairs can be sent between processes (see generateKeys)
+"""
+class Signer():
+  name = 'abstract'
+  picklable_keys = False
+
+  def newkeys(self) -> tuple[Any, Any]:
+    raise NotImplementedError
+
+  def sign(self, data: bytes, private_key: Any) -> bytes:
+    raise NotImplementedError
+
+  def verify(self, data: bytes, signature: bytes, public_key: Any) -> bool:
+    raise NotImplementedError
+
+"""
+Pure python RSA (the original scheme); keys are rsa.PublicKey / rsa.PrivateKey
+"""
+class RSASigner(Signer):
+  name = 'rsa'
+  picklable_keys = True
+
+  def __init__(self, bits: int = 512, hash_method: str = 'SHA-1') -> None:
+    self.bits = bits
+    self.hash_method = hash_method
+
+  def newkeys(self) -> tuple['rsa.PublicKey', 'rsa.PrivateKey']:
+    import rsa
+    return rsa.newkeys(self.bits)
+
+  def sign(self, data: bytes, private_key: 'rsa.PrivateKey') -> bytes:
+    import rsa
+    return rsa.sign(data, private_key, self.hash_method)
+
+  def verify(self, data: bytes, signature: bytes, public_key: 'rsa.PublicKey') -> bool:
+    import rsa
+    try:
+      return rsa.verify(data, signature, public_key) == self.hash_method
+    except rsa.VerificationError:
+      return False
+
+"""
+Ed25519 signatures; the public key is kept as its 32 raw bytes
+"""
+class Ed25519Signer(Signer):
+  name = 'ed25519'
+
+  def __init__(self) -> None:
+    if Ed25519PrivateKey is None and nacl is None:
+      raise ImportError("Ed25519Signer needs the cryptography or PyNaCl package")
+
+  def newkeys(self) -> tuple[bytes, Any]:
+    if Ed25519PrivateKey is not None:
+      private_key = Ed25519PrivateKey.generate()
+      return private_key.public_key().public_bytes_raw(), private_key
+    private_key = nacl.signing.SigningKey.generate()
+    return bytes(private_key.verify_key), private_key
+
+  def sign(self, data: bytes, private_key: Any) -> bytes:
+    if Ed25519PrivateKey is not None:
+      return private_key.sign(data)
+    return private_key.sign(data).signature
+
+  def verify(self, data: bytes, signature: bytes, public_key: bytes) -> bool:
+    if Ed25519PrivateKey is not None:
+      try:
+        Ed25519PublicKey.from_public_bytes(public_key).verify(signature, data)
+        return True
+      except InvalidSignature:
+        return False
+    try:
+      nacl.signing.VerifyKey(public_key).verify(data, signature)
+      return True
+    except nacl.exceptions.BadSignatureError:
+      return False
+
+"""
+HMAC-SHA256 stand-in for simulations: the "public" key is the shared secret itself, so anyone who can verify can also sign. Never use outside simulations
+"""
+class HMACSigner(Signer):
+  name = 'hmac'
+  picklable_keys = True
+
+  def newkeys(self) -> tuple[bytes, bytes]:
+    secret = os.urandom(32)
+    return secret, secret
+
+  def sign(self, data: bytes, private_key: bytes) -> bytes:
+    return hmac.new(private_key, data, hashlib.sha256).digest()
+
+  def verify(self, data: bytes, signature: bytes, public_key: bytes) -> bool:
+    return hmac.compare_digest(hmac.new(public_key, data, hashlib.sha256).digest(), signature)
+
+# name => signer class, for selecting a scheme by name
+SIGNERS: dict[str, type[Signer]] = {signer.name: signer for signer in (RSASigner, Ed25519Signer, HMACSigner)}
+DEFAULT_SIGNER: Signer = RSASigner()
+
+"""
+Bounded LRU cache of successful verifications, a signature found here is not verified again
+**Fields**
+  maxsize: maximum number of cached verifications, the least recently used one is evicted first
+  hits, misses: lookup counters
+  entries: (scheme, message, signature, public key) => None, in least to most recently used order
+  by_key: public key => cached entries made with that key (for invalidation)
+**Methods**
+  lookup: True if the verification is cached (counts a hit or a miss)
+  add: cache a successful verification
+  invalidateKey: drop all verifications made with a public key, called when a node replaces its keys
+"""
+class VerificationCache():
+  def __init__(self, maxsize: int = 4096) -> None:
+    self.maxsize = maxsize
+    self.hits = 0
+    self.misses = 0
+    self.entries: OrderedDict[tuple, None] = OrderedDict()
+    self.by_key: dict[Any, set[tuple]] = dict()
+
+  def lookup(self, signer: Signer, data: bytes, signature: bytes, public_key: Any) -> bool:
+    entry = (signer.name, data, signature, public_key)
+    if entry in self.entries:
+      self.entries.move_to_end(entry)
+      self.hits += 1
+      return True
+    self.misses += 1
+    return False
+
+  def add(self, signer: Signer, data: bytes, signature: bytes, public_key: Any) -> None:
+    entry = (signer.name, data, signature, public_key)
+    self.entries[entry] = None
+    self.entries.move_to_end(entry)
+    self.by_key.setdefault(public_key, set()).add(entry)
+    if len(self.entries) > self.maxsize:
+      self.discard(self.entries.popitem(last=False)[0])
+
+  def discard(self, entry: tuple) -> None:
+    self.entries.pop(entry, None)
+    key_entries = self.by_key.get(entry[3])
+    if key_entries is not None:
+      key_entries.discard(entry)
+      if not key_entries:
+        del self.by_key[entry[3]]
+
+  def invalidateKey(self, public_key: Any) -> None:
+    for entry in self.by_key.pop(public_key, set()):
+      self.entries.pop(entry, None)
+
+  def clear(self) -> None:
+    self.entries.clear()
+    self.by_key.clear()
+    self.hits = self.misses = 0
+
+"""
+Generates count key pairs, in worker processes (workers of them, None = one per CPU) when the scheme's keys can be pickled
+"""
+def generateKeys(signer: Signer, count: int, workers: None | int = None) -> list[tuple[Any, Any]]:
+  if count <= 1 or workers == 1 or not signer.picklable_keys:
+    return [signer.newkeys() for _ in range(count)]
+  with ProcessPoolExecutor(workers) as executor:
+    futures = [executor.submit(signer.newkeys) for _ in range(count)]
+    return [future.result() for future in futures]
+
+# shared by all nodes of the process, consulted by Node.verify
+verification_cache = VerificationCache()
+
+"""
+Measures sign and verify throughput (operations per second) of a signer over the given number of rounds
+"""
+def benchmark(signer: Signer, rounds: int = 500) -> dict[str, float]:
+  public_key, private_key = signer.newkeys()
+  messages = [str(i).encode('utf-8') for i in range(rounds)]
+  start = time.perf_counter()
+  signatures = [signer.sign(message, private_key) for message in messages]
+  sign_time = time.perf_counter() - start
+  start = time.perf_counter()
+  for message, signature in zip(messages, signatures):
+    assert signer.verify(message, signature, public_key)
+  verify_time = time.perf_counter() - start
+  return {'sign': rounds / sign_time, 'verify': rounds / verify_time}
+
+if __name__ == '__main__':
+  for name, signer_class in SIGNERS.items():
+    try:
+      signer = signer_class()
+    except ImportError as e:
+      print(name, "skipped:", e)
+      continue
+    result = benchmark(signer)
+    print("%-8s sign: %10.1f ops/s  verify: %10.1f ops/s" % (name, result['sign'], result['verify']))
@@ -0,0 +1,265 @@
+import argparse
+import contextlib
+import os
+import random
+import sys
+import time
+from typing import TypedDict
+from blockchain import Blockchain, Block, Node, NodeType, StateJournal, Transaction, current_active_nodes, MAX_IN_FLIGHT
+from signers import Signer, SIGNERS, DEFAULT_SIGNER
+
+# relative weights of the actions performed by the driver
+DEFAULT_MIX = {'start': 4, 'accept': 3, 'reject': 1, 'delete': 1, 'mine': 1}
+MANUFACTURER_ID = 9999
+
+"""
+Silences stdout inside the block: the blockchain reports every step on stdout, which would dominate the run time of the tools driving it
+"""
+@contextlib.contextmanager
+def quiet():
+  with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+    yield
+
+"""
+Report returned by a workload run
+**Fields**
+  steps: number of actions performed
+  actions: number of times each action was performed
+  transactions: transactions committed in mined blocks
+  blocks: blocks added to the chain
+  elapsed: wall time of the run in seconds
+  tps, bps: committed transactions and blocks per second
+  mean_latency: mean time from starting a transaction to its block being added (seconds)
+"""
+class WorkloadReport(TypedDict):
+  steps: int
+  actions: dict[str, int]
+  transactions: int
+  blocks: int
+  elapsed: float
+  tps: float
+  bps: float
+  mean_latency: float
+
+"""
+Drives a Blockchain through its public API without any prompts or sleeps, the same seed and parameters always produce the same sequence of actions
+**Fields**
+  rng: random generator used to choose actions (the blockchain's own voting uses the global random module, seeded too)
+  bc: the blockchain under test
+  started: id(transaction) => time it was started, removed once the transaction is committed
+  latencies: confirmation latencies of committed transactions
+  last_block: newest block seen by the driver
+**Methods**
+  run: perform the given number of actions, returns the report
+  (start|accept|reject|delete|mine): perform one action of the given kind, a no-op if no node can perform it
+"""
+class WorkloadDriver():
+  def __init__(self, seed: int, node_count: int, product_count: int, mix: dict[str, int] = DEFAULT_MIX, signer: Signer = DEFAULT_SIGNER) -> None:
+    if node_count < 4:
+      raise ValueError("the voting round needs at least 4 nodes")
+    random.seed(seed)
+    self.rng = random.Random(seed)
+    self.mix = mix
+    stocks: list[set[int]] = [set() for _ in range(node_count)]
+    for product in range(1, product_count + 1):
+      stocks[self.rng.randrange(node_count)].add(product)
+    current_active_nodes.clear()
+    with quiet():
+      self.bc = Blockchain(Node(100000000, MANUFACTURER_ID, stocks[0], NodeType.MANUFACTURER, signer))
+      self.bc.addNodes([{'id': MANUFACTURER_ID - i, 'stake': self.rng.randint(50, 1000), 'type': self.rng.choice(('client', 'distributor')), 'stock': stocks[i]}
+                        for i in range(1, node_count)])
+    self.started: dict[int, float] = dict()
+    self.latencies: list[float] = []
+    self.transactions = 0
+    self.blocks = 0
+    self.last_block = self.bc.newest_block
+
+  def run(self, steps: int) -> WorkloadReport:
+    actions = dict.fromkeys(self.mix, 0)
+    kinds, weights = list(self.mix), list(self.mix.values())
+    begin = time.perf_counter()
+    with quiet():
+      for _ in range(steps):
+        kind = self.rng.choices(kinds, weights)[0]
+        accepted = len(self.bc.accepted_transactions)
+        getattr(self, kind)()
+        actions[kind] += 1
+        self.collectBlocks()
+        # accepted transactions are only cleared by mining (which also runs when accepting fills a block)
+        if len(self.bc.accepted_transactions) < accepted:
+          self.dropUncommitted()
+    elapsed = time.perf_counter() - begin
+    return {
+      'steps': steps,
+      'actions': actions,
+      'transactions': self.transactions,
+      'blocks': self.blocks,
+      'elapsed': elapsed,
+      'tps': self.transactions / elapsed if elapsed else 0.0,
+      'bps': self.blocks / elapsed if elapsed else 0.0,
+      'mean_latency': sum(self.latencies) / len(self.latencies) if self.latencies else 0.0
+    }
+
+  """
+  Records the transactions of every block added since the last call
+  """
+  def collectBlocks(self) -> None:
+    if self.bc.newest_block == self.last_block:
+      return
+    now = time.perf_counter()
+    cur = self.bc.blockchain[self.bc.newest_block]
+    while cur.header_hash != self.last_block:
+      self.blocks += 1
+      for txn in self.bc.getBlock(cur.header_hash).transactions:
+        self.transactions += 1
+        if id(txn) in self.started:
+          self.latencies.append(now - self.started.pop(id(txn)))
+      cur = self.bc.blockchain[cur.previous_hash]
+    self.last_block = self.bc.newest_block
+
+  def pendingRequests(self) -> list[Transaction]:
+    return [txn for txns in self.bc.pending_transactions.values() for txn in txns.values()]
+
+  """
+  Stock of every node that can start a transaction, without the products reserved by its transactions in flight
+  """
+  def availableStock(self) -> dict[int, list[int]]:
+    reserved = self.bc.reserved
+    available = {id: [product for product in sorted(node.stock) if product not in reserved]
+                 for id, node in current_active_nodes.items() if len(self.bc.in_flight[id]) < MAX_IN_FLIGHT}
+    return {id: stock for id, stock in available.items() if stock}
+
+  def start(self) -> None:
+    available = self.availableStock()
+    if not available:
+      return
+    sender = self.rng.choice(sorted(available))
+    receiver = self.rng.choice(sorted(id for id in current_active_nodes if id != sender))
+    stock = available[sender]
+    products = set(self.rng.sample(stock, self.rng.randint(1, min(3, len(stock)))))
+    pending = len(self.bc.pending_transactions[receiver])
+    self.bc.changeParentNode(sender)
+    self.bc.startTransaction(receiver, products)
+    if len(self.bc.pending_transactions[receiver]) > pending:
+      self.started[id(next(reversed(self.bc.pending_transactions[receiver].values())))] = time.perf_counter()
+
+  def accept(self) -> None:
+    requests = self.pendingRequests()
+    if not requests:
+      return
+    txn = self.rng.choice(requests)
+    self.bc.changeParentNode(txn.receiver_id)
+    self.bc.acceptTransactionRequest(txn.sender_id, txn.nonce)
+
+  def reject(self) -> None:
+    requests = self.pendingRequests()
+    if not requests:
+      return
+    txn = self.rng.choice(requests)
+    self.started.pop(id(txn), None)
+    self.bc.changeParentNode(txn.receiver_id)
+    self.bc.rejectTransactionRequest(txn.sender_id, txn.nonce)
+
+  def delete(self) -> None:
+    requests = self.pendingRequests()
+    if not requests:
+      return
+    txn = self.rng.choice(requests)
+    self.started.pop(id(txn), None)
+    self.bc.changeParentNode(txn.sender_id)
+    self.bc.deleteTransactionRequest(txn.nonce)
+
+  def mine(self) -> None:
+    self.bc.mineBlock()
+
+  """
+  Forgets the start time of transactions dropped as invalid during mining, they are never committed
+  """
+  def dropUncommitted(self) -> None:
+    pending = {id(txn) for txn in self.pendingRequests()} | {id(txn) for txn in self.bc.accepted_transactions}
+    for key in [key for key in self.started if key not in pending]:
+      del self.started[key]
+
+"""
+Regression check of reorganisations: a stake change committed outside any block (a failed round's penalty) must survive undoing the block
+before it, a block must weigh the same in fork choice whether it was mined locally (changes already applied) or received, and a transaction
+orphaned by a reorganisation must leave the products reserved by a newer transaction in flight to it
+returns: descriptions of the failed checks (empty if all passed)
+"""
+def reorgCheck(signer: Signer = DEFAULT_SIGNER) -> list[str]:
+  failures = []
+  def newChain() -> Blockchain:
+    current_active_nodes.clear()
+    bc = Blockchain(Node(100000000, MANUFACTURER_ID, set(), NodeType.MANUFACTURER, signer))
+    bc.addNodes([{'id': 1, 'stake': 10, 'type': 'client', 'stock': ()}, {'id': 2, 'stake': 10, 'type': 'client', 'stock': ()}])
+    return bc
+  with quiet():
+    bc = newChain()
+    genesis = bc.newest_block
+    bc.addBlock(Block(genesis, 1, [], 1), [('stake', (1,), 200)])
+    # penalty of a failed round, committed outside any block journal
+    StateJournal(bc.nodes, bc.product_locations).apply([('stake', (1,), -20)])
+    # a heavier sibling branch undoes the block
+    sibling = Block(genesis, 1, [], 2)
+    bc.addBlock(sibling, [('stake', (2,), 200)])
+    bc.addBlock(Block(sibling.header_hash, 2, [], 2), [('stake', (2,), 200)])
+    if bc.heights[1] != sibling.header_hash:
+      failures.append("the heavier branch did not become canonical")
+    if bc.nodes[1]['stake'] != 100 - 20:
+      failures.append("stake after the reorganisation is %d instead of 80, the penalty outside the block was lost" % bc.nodes[1]['stake'])
+
+    weights = []
+    for mine in (False, True):
+      bc = newChain()
+      block = Block(bc.newest_block, 1, [], 1)
+      undo = StateJournal(bc.nodes, bc.product_locations).apply([('stake', (1,), 200)]) if mine else None
+      bc.addBlock(block, [('stake', (1,), 200)], undo)
+      weights.append(bc.weights[block.header_hash] - bc.weights[block.previous_hash])
+    if weights[0] != weights[1]:
+      failures.append("a received block weighs %d, the same block mined locally weighs %d" % tuple(weights))
+
+    # a transaction orphaned by a reorganisation must not take over the products of a newer transaction in flight
+    bc = newChain()
+    genesis = bc.newest_block
+    bc.addNodes([{'id': 3, 'stake': 10, 'type': 'client', 'stock': (5,)}, {'id': 4, 'stake': 10, 'type': 'client', 'stock': ()}])
+    bc.changeParentNode(3)
+    bc.startTransaction(1, {5})
+    bc.changeParentNode(1)
+    bc.acceptTransactionRequest(3)
+    bc.mineBlock()
+    # the receiver passes the product on, then a heavier branch without the first transfer orphans it
+    bc.startTransaction(2, {5})
+    newer = next(reversed(bc.pending_transactions[2].values()))
+    sibling = Block(genesis, 1, [], 4)
+    bc.addBlock(sibling, [('stake', (4,), 200)])
+    tip = sibling.header_hash
+    while bc.heights[1] != sibling.header_hash:
+      block = Block(tip, bc.blockchain[tip].height + 1, [], 4)
+      bc.addBlock(block, [('stake', (4,), 200)])
+      tip = block.header_hash
+    if bc.reserved.get(5) != newer.transaction_id:
+      failures.append("after the reorganisation product 5 is reserved by %s instead of the newer transaction" % bc.reserved.get(5))
+  current_active_nodes.clear()
+  return failures
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Run a headless workload against the blockchain')
+  parser.add_argument('--seed', default=0, type=int, help='seed for all random choices')
+  parser.add_argument('--nodes', default=10, type=int, help='number of nodes, including the manufacturer (at least 4)')
+  parser.add_argument('--products', default=100, type=int, help='number of products initially spread among the nodes')
+  parser.add_argument('--steps', default=1000, type=int, help='number of actions to perform')
+  parser.add_argument('--signer', default=DEFAULT_SIGNER.name, choices=SIGNERS, help='signature scheme of the chain')
+  parser.add_argument('--reorg-check', action='store_true', help='only run the reorganisation regression check, exit with status 1 if it fails')
+  for kind, weight in DEFAULT_MIX.items():
+    parser.add_argument('--' + kind, default=weight, type=int, help='relative weight of the ' + kind + ' action')
+  args = parser.parse_args()
+  if args.reorg_check:
+    failures = reorgCheck(SIGNERS[args.signer]())
+    print('\n'.join(failures) or "reorganisation check passed")
+    sys.exit(1 if failures else 0)
+  driver = WorkloadDriver(args.seed, args.nodes, args.products, {kind: getattr(args, kind) for kind in DEFAULT_MIX}, SIGNERS[args.signer]())
+  report = driver.run(args.steps)
+  print("Actions performed:", report['actions'])
+  print("Blocks mined:", report['blocks'], "Transactions committed:", report['transactions'], "in %.3f s" % report['elapsed'])
+  print("Throughput: %.2f transactions/s, %.2f blocks/s" % (report['tps'], report['bps']))
+  print("Mean confirmation latency: %.6f s" % report['mean_latency'])
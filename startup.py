@@ -0,0 +1,58 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# default budgets in seconds, exceeding one makes the benchmark exit with status 1
+IMPORT_BUDGET = 0.5
+PROMPT_BUDGET = 1.5
+# printed by main.py when it waits for the first menu selection
+PROMPT = b"Chooose an Operation to Perform: "
+
+"""
+Wall time of `import blockchain` in a fresh interpreter (seconds)
+"""
+def importTime() -> float:
+  code = "import time\nstart = time.perf_counter()\nimport blockchain\nprint(time.perf_counter() - start)"
+  result = subprocess.run([sys.executable, '-c', code], cwd=HERE, capture_output=True, check=True)
+  return float(result.stdout)
+
+"""
+Wall time from launching main.py until its first menu prompt (seconds), the CLI is then closed with option 11
+"""
+def promptTime() -> float:
+  start = time.perf_counter()
+  process = subprocess.Popen([sys.executable, '-u', 'main.py'], cwd=HERE, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+  output = b''
+  while PROMPT not in output:
+    chunk = os.read(process.stdout.fileno(), 4096)
+    if not chunk:
+      process.wait()
+      raise RuntimeError("main.py exited before showing the menu")
+    output += chunk
+  elapsed = time.perf_counter() - start
+  process.communicate(b'11\n')
+  return elapsed
+
+"""
+Median of the measurement over the given number of runs
+"""
+def measure(function, runs: int) -> float:
+  return statistics.median(function() for _ in range(runs))
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description="Measures the startup time of the CLI and checks it against a budget")
+  parser.add_argument('--runs', type=int, default=5)
+  parser.add_argument('--import-budget', type=float, default=IMPORT_BUDGET, help="budget for importing blockchain.py (seconds)")
+  parser.add_argument('--prompt-budget', type=float, default=PROMPT_BUDGET, help="budget for main.py to reach its first prompt (seconds)")
+  args = parser.parse_args()
+  failed = False
+  for name, function, budget in (('import blockchain', importTime, args.import_budget), ('main.py first prompt', promptTime, args.prompt_budget)):
+    elapsed = measure(function, args.runs)
+    status = 'ok' if elapsed <= budget else 'OVER BUDGET'
+    failed |= elapsed > budget
+    print("%-22s %8.3f s  (budget %.3f s)  %s" % (name, elapsed, budget, status))
+  sys.exit(1 if failed else 0)
@@ -0,0 +1,262 @@
+import struct
+import sys
+from collections.abc import Iterator
+from datetime import datetime
+from typing import Any
+
+"""
+Compact binary encoding of blocks and transactions, for persistence and node to node transfer
+
+Transaction record (little endian):
+  header: magic 'SCTX', version (u8), manufacturer_id, sender_id, receiver_id (i64), transaction_id (32 raw bytes),
+          salt (8 raw bytes), timestamp (i64 microseconds since the Unix epoch), product count (u32), sender / receiver signature lengths (u16, NO_SIGN if absent),
+          nonce (u64)
+  body: product ids (i64 each), sender signature, receiver signature
+Block record:
+  header: magic 'SCBK', version (u8), height (u64), miner_id (i64), timestamp (i64 microseconds since the Unix epoch),
+          previous_hash, merkle_root, header_hash (32 raw bytes each), transaction count (u32), bloom filter length (u32)
+  bloom filter: the bits of the block's bloom filter (covered by the header hash)
+  body: for each transaction its length (u32) followed by the transaction record
+
+Views read the fields straight out of a memoryview when they are accessed, the body is never copied; records of every earlier version
+can still be read (their missing fields get defaults), only the current version is written
+"""
+# version 2: transaction timestamps are numeric (version 1 stored them as formatted strings)
+# version 3: blocks carry a bloom filter of the product and node ids they touch
+# version 4: transactions carry their sender's nonce
+# version 5: node and product ids are signed (earlier versions stored them as u64, so negative ids could not be encoded)
+VERSION = 5
+TXN_MAGIC = b'SCTX'
+BLOCK_MAGIC = b'SCBK'
+TXN_HEADER = struct.Struct('<4sBqqq32s8sqIHHQ')
+BLOCK_HEADER = struct.Struct('<4sBQqq32s32s32sII')
+LENGTH = struct.Struct('<I')
+PRODUCT = struct.Struct('<q')
+# header layouts of each version that can be read
+TXN_HEADERS = {
+  1: struct.Struct('<4sBQQQ32s8s20sIHH'),
+  2: struct.Struct('<4sBQQQ32s8sqIHH'),
+  3: struct.Struct('<4sBQQQ32s8sqIHH'),
+  4: struct.Struct('<4sBQQQ32s8sqIHHQ'),
+  VERSION: TXN_HEADER,
+}
+BLOCK_HEADERS = {
+  1: struct.Struct('<4sBQQq32s32s32sI'),
+  2: struct.Struct('<4sBQQq32s32s32sI'),
+  3: struct.Struct('<4sBQQq32s32s32sII'),
+  4: struct.Struct('<4sBQQq32s32s32sII'),
+  VERSION: BLOCK_HEADER,
+}
+# version 1 stored transaction timestamps as local time in this format
+V1_TIMESTAMP = "%d|%m|%Y><%H:%M:%S"
+# signature length marking a missing signature
+NO_SIGN = 0xFFFF
+
+def encodeTransaction(txn: Any) -> bytes:
+  sender_sign = txn.sender_sign or b''
+  receiver_sign = txn.receiver_sign
+  products = sorted(txn.product_ids)
+  return b''.join((
+    TXN_HEADER.pack(TXN_MAGIC, VERSION, txn.manufacturer_id, txn.sender_id, txn.receiver_id, bytes.fromhex(txn.transaction_id), bytes.fromhex(txn.salt),
+                    txn.timestamp, len(products), len(sender_sign) if txn.sender_sign is not None else NO_SIGN,
+                    len(receiver_sign) if receiver_sign is not None else NO_SIGN, txn.nonce),
+    struct.pack('<%dq' % len(products), *products),
+    sender_sign,
+    receiver_sign or b''
+  ))
+
+def encodeBlock(block: Any) -> bytes:
+  parts = [BLOCK_HEADER.pack(BLOCK_MAGIC, VERSION, block.height, block.miner_id, block.timestamp, bytes.fromhex(block.previous_hash),
+                             bytes.fromhex(block.merkle_root), bytes.fromhex(block.header_hash), len(block.transactions), len(block.bloom.bits)),
+           block.bloom.bits]
+  for txn in block.transactions:
+    record = encodeTransaction(txn)
+    parts.append(LENGTH.pack(len(record)))
+    parts.append(record)
+  return b''.join(parts)
+
+"""
+Reads the header of a record in the layout of its version
+returns: the header fields and the size of the header
+"""
+def checkHeader(buf: memoryview, magic: bytes, headers: dict[int, struct.Struct]) -> tuple[tuple, int]:
+  if len(buf) < 5:
+    raise ValueError("truncated record")
+  if bytes(buf[:4]) != magic:
+    raise ValueError("not a " + magic.decode() + " record")
+  header = headers.get(buf[4])
+  if header is None:
+    raise ValueError("unsupported format version " + str(buf[4]))
+  if len(buf) < header.size:
+    raise ValueError("truncated record")
+  return header.unpack_from(buf), header.size
+
+"""
+Header fields of a transaction record in the current layout: version 1 timestamps are converted, records before version 4 get nonce 0
+"""
+def transactionHeader(buf: memoryview) -> tuple[tuple, int]:
+  fields, size = checkHeader(buf, TXN_MAGIC, TXN_HEADERS)
+  if fields[1] == 1:
+    moment = datetime.strptime(fields[7].rstrip(b'\0').decode('ascii'), V1_TIMESTAMP)
+    fields = fields[:7] + (round(moment.timestamp() * 1000000),) + fields[8:]
+  if fields[1] < 4:
+    fields += (0,)
+  return fields, size
+
+"""
+Header fields of a block record in the current layout: records before version 3 have no bloom filter (length 0)
+"""
+def blockHeader(buf: memoryview) -> tuple[tuple, int]:
+  fields, size = checkHeader(buf, BLOCK_MAGIC, BLOCK_HEADERS)
+  if fields[1] < 3:
+    fields += (0,)
+  return fields, size
+
+"""
+Lazy read-only view of an encoded transaction
+**Fields**
+  buf: memoryview over the record (shared, not copied)
+  manufacturer_id, sender_id, receiver_id, transaction_id, salt, timestamp, nonce: header fields
+  version: format version of the record
+  product_ids: the product ids, a memoryview of i64 on little endian machines (u64 before version 5)
+  sender_sign, receiver_sign: memoryviews over the signatures (None if absent)
+"""
+class TransactionView():
+  __slots__ = ('buf', 'header', 'size')
+
+  def __init__(self, data: bytes | bytearray | memoryview) -> None:
+    self.buf = memoryview(data)
+    self.header, self.size = transactionHeader(self.buf)
+
+  @property
+  def version(self) -> int:
+    return self.header[1]
+
+  @property
+  def manufacturer_id(self) -> int:
+    return self.header[2]
+
+  @property
+  def sender_id(self) -> int:
+    return self.header[3]
+
+  @property
+  def receiver_id(self) -> int:
+    return self.header[4]
+
+  @property
+  def transaction_id(self) -> str:
+    return self.header[5].hex()
+
+  @property
+  def salt(self) -> str:
+    return self.header[6].hex()
+
+  @property
+  def timestamp(self) -> int:
+    return self.header[7]
+
+  @property
+  def nonce(self) -> int:
+    return self.header[11]
+
+  @property
+  def product_ids(self) -> memoryview | tuple[int, ...]:
+    products = self.buf[self.size:self.size + self.header[8] * PRODUCT.size]
+    code = 'q' if self.version >= 5 else 'Q'
+    if sys.byteorder == 'little':
+      return products.cast(code)
+    return tuple(p for p, in struct.iter_unpack('<' + code, products))
+
+  def signature(self, index: int) -> None | memoryview:
+    length = self.header[9 + index]
+    if length == NO_SIGN:
+      return None
+    start = self.size + self.header[8] * PRODUCT.size
+    if index == 1 and self.header[9] != NO_SIGN:
+      start += self.header[9]
+    return self.buf[start:start + length]
+
+  @property
+  def sender_sign(self) -> None | memoryview:
+    return self.signature(0)
+
+  @property
+  def receiver_sign(self) -> None | memoryview:
+    return self.signature(1)
+
+"""
+Lazy read-only view of an encoded block; transactions are located on first access and decoded only when read
+**Fields**
+  buf: memoryview over the record (shared, not copied)
+  version: format version of the record
+  height, miner_id, timestamp, previous_hash, merkle_root, header_hash: header fields
+  transaction_count: number of transactions in the body
+  bloom: memoryview over the bits of the bloom filter (empty before version 3)
+**Methods**
+  transaction: view of the i-th transaction
+  transactions: iterate over views of all transactions
+"""
+class BlockView():
+  __slots__ = ('buf', 'header', 'size', 'offsets')
+
+  def __init__(self, data: bytes | bytearray | memoryview) -> None:
+    self.buf = memoryview(data)
+    self.header, self.size = blockHeader(self.buf)
+    self.offsets: None | list[tuple[int, int]] = None
+
+  @property
+  def version(self) -> int:
+    return self.header[1]
+
+  @property
+  def height(self) -> int:
+    return self.header[2]
+
+  @property
+  def miner_id(self) -> int:
+    return self.header[3]
+
+  @property
+  def timestamp(self) -> int:
+    return self.header[4]
+
+  @property
+  def previous_hash(self) -> str:
+    return self.header[5].hex()
+
+  @property
+  def merkle_root(self) -> str:
+    return self.header[6].hex()
+
+  @property
+  def header_hash(self) -> str:
+    return self.header[7].hex()
+
+  @property
+  def transaction_count(self) -> int:
+    return self.header[8]
+
+  @property
+  def bloom(self) -> memoryview:
+    return self.buf[self.size:self.size + self.header[9]]
+
+  def locate(self) -> list[tuple[int, int]]:
+    if self.offsets is None:
+      offsets = []
+      position = self.size + self.header[9]
+      for _ in range(self.transaction_count):
+        length, = LENGTH.unpack_from(self.buf, position)
+        position += LENGTH.size
+        offsets.append((position, position + length))
+        position += length
+      self.offsets = offsets
+    return self.offsets
+
+  def transaction(self, index: int) -> TransactionView:
+    start, end = self.locate()[index]
+    return TransactionView(self.buf[start:end])
+
+  def transactions(self) -> Iterator[TransactionView]:
+    for start, end in self.locate():
+      yield TransactionView(self.buf[start:end])